@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from config import ARCHIVE_DIR, ARCHIVE_SEGMENT_SIZE, STATE_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+INDEX_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5(
+    text, user_id, category, content='', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS locations (
+    id INTEGER PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS position (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+"""
+
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{6})\.jsonl$')
+
+# Matches counted per search at most; larger counts are shown as "1000+"
+SEARCH_COUNT_LIMIT = 1000
+
+# Search filters: "user:<id>" and "cat:<category key>"
+FILTER_PATTERN = re.compile(r'^(user|cat):(\S+)$')
+
+
+def _segment_name(number):
+    return f'segment-{number:06d}.jsonl'
+
+
+def build_query(terms):
+    """FTS5 query matching all terms (as prefixes) and the user:/cat: filters."""
+    parts = []
+    for term in terms:
+        match = FILTER_PATTERN.match(term)
+        if match:
+            column = 'user_id' if match.group(1) == 'user' else 'category'
+            parts.append(f'{column} : "{match.group(2).replace(chr(34), "")}"')
+            continue
+        term = term.replace('"', '')
+        if term.strip('*'):
+            parts.append(f'"{term.rstrip("*")}"*')
+    return ' AND '.join(parts)
+
+
+def _truncate_partial_line(path):
+    """Cut off an unterminated last line, left by a crash during an append."""
+    with open(path, 'r+b') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            chunk = f.read(end - start)
+            newline = chunk.rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+            logger.warning(f"Removed {size - end} bytes of an incomplete record from {path}")
+
+
+class TicketArchive:
+    """Append-only archive of tickets and dialog messages with a full-text index.
+
+    Records are JSON lines in numbered segment files that are never
+    rewritten; a new segment starts once the current one reaches
+    ``segment_size`` bytes. A contentless SQLite FTS5 index maps words, user
+    ids and categories to (segment, offset), so searches read only the
+    index pages and records they need. A background thread appends and
+    indexes records in batches and stores how far the index got, so
+    records written before a crash are indexed on the next start.
+    """
+
+    def __init__(self, directory=ARCHIVE_DIR, segment_size=ARCHIVE_SEGMENT_SIZE,
+                 flush_interval=STATE_FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.db'),
+                                     check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(INDEX_SCHEMA)
+        self._db_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        segments = self._segments()
+        self.segment = segments[-1] if segments else 1
+        path = os.path.join(directory, _segment_name(self.segment))
+        if segments:
+            _truncate_partial_line(path)
+        self._file = open(path, 'ab')
+        self._catch_up()
+
+    def _segments(self):
+        return sorted(int(match.group(1)) for match in
+                      map(SEGMENT_PATTERN.match, os.listdir(self.directory)) if match)
+
+    def _catch_up(self):
+        """Index records appended after the last indexed position."""
+        row = self._conn.execute("SELECT segment, offset FROM position").fetchone()
+        segment, offset = row if row else (1, 0)
+        batch = []
+        end = (segment, offset)
+        for number in self._segments():
+            if number < segment:
+                continue
+            with open(os.path.join(self.directory, _segment_name(number)), 'rb') as f:
+                f.seek(offset if number == segment else 0)
+                position = f.tell()
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        batch.append((number, position, json.loads(line)))
+                    except ValueError:
+                        logger.error(f"Skipping unreadable archive record at "
+                                     f"{_segment_name(number)}:{position}")
+                    position += len(line)
+                end = (number, position)
+        if end != (segment, offset):
+            # The position after the last line, so nothing is indexed twice
+            self._index(batch, *end)
+        if batch:
+            logger.info(f"Indexed {len(batch)} archived records missing from the index")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_loop, name="ArchiveWriter",
+                                            daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Write and index everything queued, then close the files."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+            self._thread = None
+        self._write_batch(self._take())
+        self._file.close()
+        with self._db_lock:
+            self._conn.close()
+
+    def append(self, kind, user_id, category, text, admin_id=None):
+        """Queue a record: kind is 'ticket', 'dialog' (from the user) or 'reply' (from an admin)."""
+        record = {'ts': round(time.time(), 3), 'kind': kind, 'user_id': user_id,
+                  'category': category, 'text': text}
+        if admin_id is not None:
+            record['admin_id'] = admin_id
+        self._queue.put(record)
+
+    def _take(self):
+        records = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                return records
+            if record is not None:
+                records.append(record)
+
+    def _write_loop(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            stop = first is None
+            records = ([] if stop else [first]) + self._take()
+            try:
+                self._write_batch(records)
+            except Exception as e:
+                logger.error(f"Failed to archive {len(records)} records: {e}")
+            if stop:
+                return
+
+    def _write_batch(self, records):
+        if not records:
+            return
+        batch = []
+        for record in records:
+            if self._file.tell() >= self.segment_size:
+                self._file.close()
+                self.segment += 1
+                self._file = open(os.path.join(self.directory, _segment_name(self.segment)), 'ab')
+            line = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            batch.append((self.segment, self._file.tell(), record))
+            self._file.write(line + b'\n')
+        self._file.flush()
+        self._index(batch, self.segment, self._file.tell())
+
+    def _index(self, batch, segment, offset):
+        with self._db_lock:
+            self._conn.execute("BEGIN")
+            try:
+                for number, position, record in batch:
+                    cursor = self._conn.execute(
+                        "INSERT INTO locations (segment, offset) VALUES (?, ?)",
+                        (number, position))
+                    self._conn.execute(
+                        "INSERT INTO entries (rowid, text, user_id, category) VALUES (?, ?, ?, ?)",
+                        (cursor.lastrowid, record['text'], str(record['user_id']),
+                         record['category']))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO position (id, segment, offset) VALUES (1, ?, ?)",
+                    (segment, offset))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def search(self, terms, limit=10):
+        """Newest records matching all terms; returns ``(records, total)``.
+
+        ``total`` stops at SEARCH_COUNT_LIMIT.
+        """
+        query = build_query(terms)
+        if not query:
+            return [], 0
+        with self._db_lock:
+            total = self._conn.execute(
+                "SELECT count(*) FROM (SELECT 1 FROM entries WHERE entries MATCH ? LIMIT ?)",
+                (query, SEARCH_COUNT_LIMIT)).fetchone()[0]
+            rows = self._conn.execute(
+                "SELECT l.segment, l.offset FROM entries JOIN locations l ON l.id = entries.rowid "
+                "WHERE entries MATCH ? ORDER BY entries.rowid DESC LIMIT ?",
+                (query, limit)).fetchall()
+        return [self._read(segment, offset) for segment, offset in rows], total
+
+    def _read(self, segment, offset):
+        with open(os.path.join(self.directory, _segment_name(segment)), 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline())
@@ -0,0 +1,61 @@
+import threading
+from config import OWNER_IDS, ASSIGNMENT_MODE, CATEGORY_ADMINS
+
+# Assignment modes (ASSIGNMENT_MODE)
+BROADCAST = "broadcast"
+LEAST_LOADED = "least_loaded"
+ROUND_ROBIN = "round_robin"
+CATEGORY = "category"
+MODES = (BROADCAST, LEAST_LOADED, ROUND_ROBIN, CATEGORY)
+
+
+class TicketAssigner:
+    """Picks the admin a new ticket is sent to.
+
+    ``least_loaded`` takes the admin with the fewest open dialogs (ties go
+    round robin), ``round_robin`` rotates through the admins and
+    ``category`` picks the least loaded admin listed for the ticket's
+    category in CATEGORY_ADMINS. In ``broadcast`` mode no admin is picked
+    and tickets go to everybody.
+    """
+
+    def __init__(self, registry, mode=ASSIGNMENT_MODE, owner_ids=OWNER_IDS,
+                 category_admins=CATEGORY_ADMINS):
+        if mode not in MODES:
+            raise ValueError(f"Unknown assignment mode {mode!r}, expected one of {MODES}")
+        self.registry = registry
+        self.mode = mode
+        self.owner_ids = list(owner_ids)
+        self.category_admins = {
+            category: [admin_id for admin_id in admins if admin_id in self.owner_ids]
+            for category, admins in category_admins.items()
+        }
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def broadcast(self):
+        return self.mode == BROADCAST
+
+    def _rotation(self, candidates):
+        """Candidates starting from the next round-robin position."""
+        with self._lock:
+            start = self._next % len(candidates)
+            self._next += 1
+        return candidates[start:] + candidates[:start]
+
+    def choose(self, user_id, category):
+        """Admin id for a new ticket, or None in broadcast mode."""
+        if self.broadcast:
+            return None
+        # Keep users with an open dialog with the admin they talk to
+        dialog = self.registry.get(user_id)
+        if dialog is not None:
+            return dialog.admin_id
+        if self.mode == ROUND_ROBIN:
+            return self._rotation(self.owner_ids)[0]
+        candidates = self.owner_ids
+        if self.mode == CATEGORY:
+            candidates = self.category_admins.get(category) or self.owner_ids
+        return min(self._rotation(candidates),
+                   key=self.registry.count_of)
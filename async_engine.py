@@ -0,0 +1,337 @@
+import asyncio
+import json
+import logging
+import ssl
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from telegram.error import (RetryAfter, TimedOut, NetworkError, BadRequest,
+                            Unauthorized, InvalidToken, Conflict)
+from config import ASYNC_MAX_CONNECTIONS, ASYNC_MAX_PENDING
+from metrics import InstrumentedRequest, api_latency, api_errors
+
+logger = logging.getLogger(__name__)
+
+# Calls the dispatcher does not wait for in asyncio mode; their results are
+# not used by the handlers (PTB returns True for them instead of a Message)
+DEFERRABLE_METHODS = frozenset({'sendMessage', 'editMessageText', 'answerCallbackQuery',
+                                'sendChatAction', 'copyMessage', 'deleteMessage'})
+
+# Retries of a deferred call that got RetryAfter
+DEFERRED_MAX_RETRIES = 3
+
+_local = threading.local()
+
+
+@contextmanager
+def wait_for_result():
+    """Make Bot API calls inside the block wait for Telegram's answer.
+
+    In asyncio mode calls from the dispatcher are otherwise sent in the
+    background; use this where a handler needs the result or the error.
+    """
+    previous = getattr(_local, 'blocking', False)
+    _local.blocking = True
+    try:
+        yield
+    finally:
+        _local.blocking = previous
+
+
+def _raise_for_status(status, body):
+    """Raise the TelegramError PTB's Request raises for a failed HTTP status."""
+    try:
+        message = str(InstrumentedRequest._parse(body))
+    except ValueError:
+        message = 'Unknown HTTPError'
+    if status in (401, 403):
+        raise Unauthorized(message)
+    if status == 400:
+        raise BadRequest(message)
+    if status == 404:
+        raise InvalidToken()
+    if status == 409:
+        raise Conflict(message)
+    if status == 502:
+        raise NetworkError('Bad Gateway')
+    raise NetworkError(f'{message} ({status})')
+
+
+def _json_body(data):
+    """Encode call parameters like Request.post does; None if files are involved."""
+    fields = {}
+    for key, value in (data or {}).items():
+        if key == 'media' or hasattr(value, 'field_tuple'):
+            return None
+        if isinstance(value, (float, int)) and not isinstance(value, bool):
+            value = str(value)
+        elif isinstance(value, list):
+            value = json.dumps(value)
+        fields[key] = value
+    return json.dumps(fields).encode('utf-8')
+
+
+class AsyncHTTPPool:
+    """Minimal asyncio HTTP/1.1 client with keep-alive connections per host.
+
+    At most ``max_connections`` requests are in flight; idle connections
+    are reused, and a request on a reused connection the server already
+    closed is retried once on a new one.
+    """
+
+    def __init__(self, max_connections=ASYNC_MAX_CONNECTIONS, connect_timeout=5.0):
+        self.connect_timeout = connect_timeout
+        self._semaphore = asyncio.Semaphore(max_connections)
+        self._idle = defaultdict(list)
+        self._ssl = ssl.create_default_context()
+
+    async def post(self, url, body, timeout):
+        """POST a JSON body; returns ``(status, response_body)``."""
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        host = parts.hostname
+        port = parts.port or (443 if https else 80)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        request = (f'POST {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n'
+                   f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n'
+                   f'Connection: keep-alive\r\n\r\n').encode('ascii') + body
+        key = (host, port, https)
+
+        async with self._semaphore:
+            for attempt in range(2):
+                reused = bool(self._idle[key])
+                if reused:
+                    reader, writer = self._idle[key].pop()
+                else:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(host, port, ssl=self._ssl if https else None),
+                        self.connect_timeout)
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    status, keep_alive, data = await asyncio.wait_for(
+                        self._read_response(reader), timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    self._idle[key].append((reader, writer))
+                else:
+                    writer.close()
+                return status, data
+
+    @staticmethod
+    async def _read_response(reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed by server')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        else:
+            data = await reader.read()
+            keep_alive = False
+        return status, keep_alive, data
+
+    def close(self):
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncEngine:
+    """Runs all Bot API traffic on one asyncio event loop.
+
+    Every call goes through a shared AsyncHTTPPool. Calls from the
+    dispatcher thread listed in DEFERRABLE_METHODS return at once and are
+    sent in the background, in order per chat, so the dispatcher goes on
+    with the next update while thousands of calls are in flight. At most
+    ``max_pending`` deferred calls are queued; beyond that the dispatcher
+    waits.
+    """
+
+    def __init__(self, max_connections=ASYNC_MAX_CONNECTIONS, max_pending=ASYNC_MAX_PENDING):
+        self.loop = asyncio.new_event_loop()
+        self.pool = None
+        self.max_connections = max_connections
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._chains = {}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(ready,),
+                                            name="AsyncEngine", daemon=True)
+            self._thread.start()
+            ready.wait()
+            logger.info(f"Asyncio engine started ({self.max_connections} connections)")
+        return self
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.pool = AsyncHTTPPool(self.max_connections)
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def stop(self, timeout=10):
+        """Wait for deferred calls, then stop the event loop."""
+        if self._thread is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._wait_chains(), self.loop)
+        try:
+            future.result(timeout)
+        except Exception as e:
+            logger.error(f"Deferred Bot API calls not finished on shutdown: {e}")
+        self.loop.call_soon_threadsafe(self.pool.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._thread = None
+
+    async def _wait_chains(self):
+        while self._chains:
+            await asyncio.gather(*self._chains.values(), return_exceptions=True)
+
+    def mark_dispatcher(self, update, context):
+        """TypeHandler callback marking the thread that processes updates."""
+        _local.dispatcher = True
+
+    @staticmethod
+    def should_defer(url):
+        return (getattr(_local, 'dispatcher', False) and not getattr(_local, 'blocking', False)
+                and url.rsplit('/', 1)[-1] in DEFERRABLE_METHODS)
+
+    def _chained(self, chat_id, coroutine):
+        """Schedule a coroutine after the calls already queued for the chat (on the loop).
+
+        Calls without a chat (getUpdates, getMe, ...) are not ordered.
+        """
+        if chat_id is None:
+            return self.loop.create_task(coroutine)
+        previous = self._chains.get(chat_id)
+
+        async def run():
+            if previous is not None:
+                await asyncio.gather(previous, return_exceptions=True)
+            return await coroutine
+
+        task = self.loop.create_task(run())
+        self._chains[chat_id] = task
+
+        def forget(_):
+            if self._chains.get(chat_id) is task:
+                del self._chains[chat_id]
+
+        task.add_done_callback(forget)
+        return task
+
+    def call(self, chat_id, url, body, timeout):
+        """Send a request from another thread and wait for ``(status, body)``."""
+        async def schedule():
+            return await self._chained(chat_id, self.pool.post(url, body, timeout))
+
+        future = asyncio.run_coroutine_threadsafe(schedule(), self.loop)
+        return future.result()
+
+    def defer(self, chat_id, url, body, timeout):
+        """Send a request in the background; failures are logged."""
+        self._pending.acquire()
+        self.loop.call_soon_threadsafe(
+            self._chained, chat_id, self._deferred(url, body, timeout))
+
+    async def _deferred(self, url, body, timeout):
+        labels = (url.rsplit('/', 1)[-1],)
+        try:
+            for attempt in range(DEFERRED_MAX_RETRIES + 1):
+                start = time.perf_counter()
+                try:
+                    status, data = await self.pool.post(url, body, timeout)
+                    if not 200 <= status <= 299:
+                        _raise_for_status(status, data)
+                    InstrumentedRequest._parse(data)
+                    return
+                except RetryAfter as e:
+                    api_errors.inc(labels + (type(e).__name__,))
+                    if attempt == DEFERRED_MAX_RETRIES:
+                        raise
+                    await asyncio.sleep(e.retry_after)
+                finally:
+                    api_latency.observe(time.perf_counter() - start, labels)
+        except BadRequest as e:
+            # e.g. editing a message to the text it already has
+            if 'not modified' not in str(e):
+                api_errors.inc(labels + (type(e).__name__,))
+                logger.error(f"Background {labels[0]} failed: {e}")
+        except Exception as e:
+            if not isinstance(e, RetryAfter):
+                api_errors.inc(labels + (type(e).__name__,))
+            logger.error(f"Background {labels[0]} failed: {e}")
+        finally:
+            self._pending.release()
+
+
+class AsyncRequest(InstrumentedRequest):
+    """PTB Request that sends JSON calls through an AsyncEngine.
+
+    Multipart uploads still use urllib3.
+    """
+
+    __slots__ = ('engine',)
+
+    def __init__(self, engine, **kwargs):
+        super().__init__(**kwargs)
+        self.engine = engine
+
+    def post(self, url, data, timeout=None):
+        if self.engine.should_defer(url):
+            body = _json_body(data)
+            if body is not None:
+                self.engine.defer(data.get('chat_id'), url, body,
+                                  timeout or self._connect_timeout + 5.0)
+                return True
+        return super().post(url, data, timeout)
+
+    def _request_wrapper(self, method, url, body=None, headers=None, fields=None, **kwargs):
+        if body is None:
+            return super()._request_wrapper(method, url, body=body, headers=headers,
+                                            fields=fields, **kwargs)
+        timeout = kwargs.get('timeout')
+        read_timeout = timeout.read_timeout if timeout is not None else None
+        chat_id = json.loads(body).get('chat_id')
+        try:
+            status, data = self.engine.call(chat_id, url, body,
+                                            read_timeout or self._connect_timeout + 5.0)
+        except asyncio.TimeoutError as error:
+            raise TimedOut() from error
+        except (OSError, asyncio.IncompleteReadError) as error:
+            raise NetworkError(f'Connection error {error!r}') from error
+        if 200 <= status <= 299:
+            return data
+        _raise_for_status(status, data)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Load test for the bot handlers against a local fake Bot API server.
+
+Synthetic users go through /start -> category -> message -> admin reply ->
+end_dialog. For every round the script prints updates/sec, user-facing
+latency (update pushed -> bot response), handler latency quantiles and
+memory growth.
+
+    python benchmark.py --users 200 --rounds 3 --latency 0.02
+
+With ``--backlog`` tickets are queued before the bot starts, as after
+downtime, and the time to drain them through polling.Poller is printed.
+"""
+import argparse
+import os
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from fake_telegram import BOT_USER, FakeTelegramServer
+
+FIRST_USER_ID = 1000000
+CATEGORY = 'questions'
+USER_ID_PATTERN = re.compile(r"🆔 ID: (\d+)")
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def rss_mb():
+    """Peak resident set size of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def prepare_environment(chat_rate, global_rate):
+    """Point the bot's configuration at throwaway state; call before importing bot.
+
+    The bot reads its configuration at import time.
+    """
+    workdir = tempfile.mkdtemp(prefix='botbench-')
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCHMARK')
+    os.environ['STATE_DB_PATH'] = os.path.join(workdir, 'state.db')
+    os.environ['ARCHIVE_DIR'] = os.path.join(workdir, 'archive')
+    os.environ['CAPTURE_PATH'] = ''
+    os.environ['FANOUT_CHAT_RATE'] = str(chat_rate)
+    os.environ['FANOUT_CHAT_BURST'] = str(max(1, int(chat_rate)))
+    os.environ['FANOUT_GLOBAL_RATE'] = str(global_rate)
+    return workdir
+
+
+def add_rate_arguments(parser):
+    parser.add_argument('--chat-rate', type=float, default=1000.0,
+                        help='fan-out messages per second per chat '
+                             '(Telegram allows about 1; high by default to measure the bot)')
+    parser.add_argument('--global-rate', type=float, default=1000.0,
+                        help='fan-out messages per second overall (Telegram allows about 30)')
+
+
+class Tracker:
+    """Collects bot responses seen by the fake server, per chat."""
+
+    def __init__(self, owner_ids):
+        self.owner_ids = set(owner_ids)
+        self.lock = threading.Lock()
+        self.responses = {}      # chat_id -> number of responses
+        self.last_message = {}   # chat_id -> last message sent to the chat
+        self.pushed_at = {}      # chat_id -> time the pending update was pushed
+        self.latencies = []
+        self.forwards = {}       # user_id -> {admin_id: message dict}
+
+    def __call__(self, method, chat_id, message):
+        now = time.perf_counter()
+        with self.lock:
+            if chat_id in self.owner_ids:
+                match = USER_ID_PATTERN.search(message.get('text', ''))
+                if match:
+                    self.forwards.setdefault(int(match.group(1)), {})[chat_id] = message
+                return
+            self.responses[chat_id] = self.responses.get(chat_id, 0) + 1
+            self.last_message[chat_id] = message
+            pushed = self.pushed_at.pop(chat_id, None)
+            if pushed is not None:
+                self.latencies.append(now - pushed)
+
+    def expect(self, chat_id):
+        with self.lock:
+            self.pushed_at[chat_id] = time.perf_counter()
+            return self.responses.get(chat_id, 0) + 1
+
+
+def user_dict(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}',
+            'username': f'user{user_id}'}
+
+
+def message_update(user_id, message_id, text, reply_to=None):
+    message = {'message_id': message_id, 'date': int(time.time()),
+               'chat': {'id': user_id, 'type': 'private'},
+               'from': user_dict(user_id), 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                'length': len(text.split()[0])}]
+    if reply_to is not None:
+        message['reply_to_message'] = reply_to
+    return {'message': message}
+
+
+def callback_update(user_id, data, message):
+    return {'callback_query': {'id': f'{user_id}-{time.monotonic_ns()}',
+                               'from': user_dict(user_id),
+                               'chat_instance': str(user_id),
+                               'message': message, 'data': data}}
+
+
+def run_phase(server, tracker, name, updates, timeout):
+    """Push (chat_id, update) pairs and wait for one response per chat.
+
+    Returns the elapsed time and the chats that got no response.
+    """
+    expected = {}
+    start = time.perf_counter()
+    for chat_id, update in updates:
+        expected[chat_id] = tracker.expect(chat_id)
+        server.push_update(update)
+
+    def done(_):
+        with tracker.lock:
+            return all(tracker.responses.get(chat_id, 0) >= count
+                       for chat_id, count in expected.items())
+
+    server.wait_for(done, timeout)
+    elapsed = time.perf_counter() - start
+    with tracker.lock:
+        missing = {chat_id for chat_id, count in expected.items()
+                   if tracker.responses.get(chat_id, 0) < count}
+    if missing:
+        print(f"  ! phase '{name}' timed out, {len(missing)} users got no response",
+              file=sys.stderr)
+    return elapsed, missing
+
+
+def run_round(server, tracker, owner_ids, users, message_seq, timeout):
+    """Drive every user through the full ticket flow once.
+
+    Users who got no response in a phase leave the round; returns the
+    number of updates, the elapsed time and the number of users lost.
+    """
+    elapsed = 0.0
+    updates = 0
+    users = list(users)
+    lost = 0
+
+    def run(name, phase):
+        nonlocal elapsed, updates, users, lost
+        phase_elapsed, missing = run_phase(server, tracker, name, phase, timeout)
+        elapsed += phase_elapsed
+        updates += len(phase)
+        if missing:
+            users = [user_id for user_id in users if user_id not in missing]
+            lost += len(missing)
+
+    run('start', [(user_id, message_update(user_id, message_seq, '/start'))
+                  for user_id in users])
+    run('category', [(user_id, callback_update(user_id, CATEGORY, tracker.last_message[user_id]))
+                     for user_id in users])
+    run('message', [(user_id, message_update(user_id, message_seq + 1, f'Ticket from {user_id}'))
+                    for user_id in users])
+
+    # Wait for the fan-out to deliver the tickets; with broadcast assignment
+    # the admins take turns answering
+    server.wait_for(lambda _: all(user_id in tracker.forwards for user_id in users), timeout)
+
+    phase = []
+    for i, user_id in enumerate(users):
+        received = tracker.forwards.pop(user_id, None)
+        if not received:
+            continue
+        admin_id = owner_ids[i % len(owner_ids)]
+        if admin_id not in received:
+            admin_id = next(iter(received))
+        forwarded = received[admin_id]
+        reply = message_update(admin_id, message_seq, f'Answer to {user_id}', forwarded)
+        reply['message']['from'] = user_dict(admin_id)
+        phase.append((user_id, reply))
+    # Users whose ticket never reached an admin
+    lost += len(users) - len(phase)
+    users = [user_id for user_id, _ in phase]
+    run('reply', phase)
+
+    run('end_dialog', [(user_id, callback_update(user_id, 'end_dialog',
+                                                 tracker.last_message[user_id]))
+                       for user_id in users])
+
+    return updates, elapsed, lost
+
+
+def push_backlog(server, users):
+    """Queue the full ticket flow of every user before the bot starts.
+
+    The category is pressed on a stand-in for the menu message, which the
+    bot has not sent yet; returns the number of updates queued.
+    """
+    for user_id in users:
+        menu = {'message_id': 1, 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER, 'text': ''}
+        server.push_update(message_update(user_id, 1, '/start'))
+        server.push_update(callback_update(user_id, CATEGORY, menu))
+        server.push_update(message_update(user_id, 2, f'Ticket from {user_id}'))
+    return 3 * len(users)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=100, help='synthetic users per round')
+    parser.add_argument('--rounds', type=int, default=3, help='number of rounds')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='fake Bot API latency per request (seconds)')
+    parser.add_argument('--backlog', type=int, default=0,
+                        help='users whose tickets are queued before the bot starts '
+                             'and drained on start')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests to admin chats answered with 429 '
+                             '(these go through the outbox and are retried)')
+    add_rate_arguments(parser)
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='max seconds to wait for each phase')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='measure Python heap growth (slower)')
+    args = parser.parse_args()
+
+    prepare_environment(args.chat_rate, args.global_rate)
+
+    import metrics
+    from logsetup import setup_logging
+    from bot import create_bot
+    from config import OWNER_IDS
+    from handlers import fanout
+
+    setup_logging()
+    # Handler replies to users are not retried by the bot, so a 429 on them
+    # would only lose the user for the round
+    server = FakeTelegramServer(latency=args.latency, error_rate=args.error_rate,
+                                error_chats=OWNER_IDS).start()
+    tracker = Tracker(OWNER_IDS)
+    server.listeners.append(tracker)
+
+    bot = create_bot(base_url=server.base_url)
+    bot.store.start()
+    bot.archive.start()
+
+    backlog_users = [FIRST_USER_ID - 1 - i for i in range(args.backlog)]
+    backlog = push_backlog(server, backlog_users)
+    start = time.perf_counter()
+    bot.start_polling()
+    if backlog:
+        # Every ticket of the backlog has to reach the admins
+        drained = server.wait_for(
+            lambda _: all(user_id in tracker.forwards for user_id in backlog_users),
+            args.timeout)
+        elapsed = time.perf_counter() - start
+        print(f"backlog: {backlog} updates drained in {elapsed:.2f}s "
+              f"({backlog / elapsed:.1f} updates/s), tickets delivered "
+              f"{sum(user_id in tracker.forwards for user_id in backlog_users)}"
+              f"/{len(backlog_users)}" + ("" if drained else " (timed out)"))
+        for user_id in backlog_users:
+            tracker.forwards.pop(user_id, None)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    baseline_rss = rss_mb()
+    baseline_heap = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+
+    print(f"{args.users} users/round, {len(OWNER_IDS)} owners, "
+          f"API latency {args.latency * 1000:.0f} ms, 429 rate {args.error_rate:.0%}")
+    total_updates = 0
+    total_elapsed = 0.0
+    try:
+        for round_no in range(args.rounds):
+            users = [FIRST_USER_ID + round_no * args.users + i for i in range(args.users)]
+            tracker.latencies = []
+            updates, elapsed, lost = run_round(server, tracker, OWNER_IDS, users,
+                                         message_seq=round_no * 10 + 1,
+                                         timeout=args.timeout)
+            total_updates += updates
+            total_elapsed += elapsed
+            heap = ''
+            if args.tracemalloc:
+                heap_mb = (tracemalloc.get_traced_memory()[0] - baseline_heap) / 2 ** 20
+                heap = f", heap +{heap_mb:.2f} MB"
+            print(f"round {round_no + 1}: {updates / elapsed:8.1f} updates/s, "
+                  f"e2e p50 {percentile(tracker.latencies, 0.5) * 1000:7.2f} ms, "
+                  f"p99 {percentile(tracker.latencies, 0.99) * 1000:7.2f} ms, "
+                  f"RSS +{rss_mb() - baseline_rss:.1f} MB{heap}, "
+                  f"reply index {len(bot.tenant.reply_index)}, "
+                  f"dialogs {len(bot.tenant.active_dialogs)}"
+                  + (f", users lost {lost}" if lost else ""))
+    finally:
+        bot.updater.stop()
+        fanout.shutdown(wait=True)
+        bot.store.close()
+        bot.archive.close()
+        server.stop()
+
+    print(f"\ntotal: {total_updates} updates in {total_elapsed:.2f}s "
+          f"({total_updates / total_elapsed:.1f} updates/s)")
+    p50 = metrics.handler_latency.quantile(0.5)
+    p99 = metrics.handler_latency.quantile(0.99)
+    if p50 is not None:
+        print(f"handler latency: p50 {p50 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms")
+    print(f"API calls: {dict(server.calls)}, throttled: {server.throttled}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,73 +1,295 @@
 import logging
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, ConversationHandler, Filters
-from config import BOT_TOKEN
+import warnings
+from queue import Queue
+from threading import Event
+from telegram import Update
+from telegram.ext import (Updater, CommandHandler, CallbackQueryHandler, MessageHandler,
+                          ConversationHandler, Filters, TypeHandler, ExtBot, JobQueue)
+from config import (BOT_API_BASE_URL, CAPTURE_PATH, FANOUT_WORKERS, LANE_FAST_WORKERS,
+                    LANE_BULK_WORKERS, WEBHOOK_URL, WEBHOOK_SECRET,
+                    WEBHOOK_MAX_CONNECTIONS, DIALOG_EXPIRY_TICK, TICKET_DIGEST_INTERVAL,
+                    STATUS_DIGEST_INTERVAL, OUTBOX_RETRY_INTERVAL, OUTBOX_DRAIN_TIMEOUT,
+                    BOT_ENGINE, STATS_SAVE_INTERVAL, MENU_CHECK_INTERVAL)
 from handlers import (start_command, button_callback, handle_user_message,
-                      cancel_conversation, help_command, dialogs_command,
-                      handle_owner_reply, handle_direct_message,
+                      cancel_conversation, help_command, dialogs_command, dialogs_page_callback,
+                      transfer_command, expire_dialogs, flood_guard, send_digest, flush_digest,
+                      retry_outbox, search_command, stats_command, save_stats,
+                      broadcast_command, broadcast_stop_command, reload_command, check_menu,
+                      handle_owner_reply, handle_direct_message, fanout,
                       WAITING_FOR_MESSAGE)
+from tenant import Tenant, tenants, tenant_path
+from storage import StateStore, SQLitePersistence
+from keep_alive import attach_webhook, detach_webhook, webhook_path
+from metrics import registry, instrument, count_update, InstrumentedRequest
+from capture import UpdateRecorder
+from async_engine import AsyncEngine, AsyncRequest
+from polling import Poller
+from archive import TicketArchive
+from media import MEDIA_FILTER
+from lanes import Lanes, LaneDispatcher, FAST, BULK
 
-# Set up logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Handlers never use run_async, so dispatchers run without worker threads
+warnings.filterwarnings('ignore', 'Asynchronous callbacks can not be processed')
+
+# Dispatchers of every bot in this process, for the update queue gauge
+dispatchers = []
+
+# Worker lanes running the updates of all dispatchers (see lanes.py)
+lanes = Lanes()
+
+
+def create_request(engine=BOT_ENGINE, bots=1):
+    """The engine (None for "threads") and the Request shared by the bots of a process.
+
+    The connection pool is shared by the lane workers, pollers and fan-out senders.
+    """
+    if engine == "asyncio":
+        async_engine = AsyncEngine().start()
+        return async_engine, AsyncRequest(async_engine, con_pool_size=4)
+    if engine == "threads":
+        workers = FANOUT_WORKERS + LANE_FAST_WORKERS + LANE_BULK_WORKERS
+        return None, InstrumentedRequest(con_pool_size=workers + 2 + 2 * bots)
+    raise ValueError(f"Unknown BOT_ENGINE {engine!r}, expected 'threads' or 'asyncio'")
+
 
 class TelegramBot:
 
-    def __init__(self):
-        """Initialize the Telegram bot."""
-        self.updater = Updater(token=BOT_TOKEN, use_context=True)
-        self.dispatcher = self.updater.dispatcher
+    def __init__(self, tenant=None, base_url=BOT_API_BASE_URL, capture_path=CAPTURE_PATH,
+                 engine=BOT_ENGINE, shared=None):
+        """Initialize the Telegram bot of a tenant (the one from config.py by default).
+
+        ``shared`` is the ``(engine, request)`` pair of a BotHost; without it
+        the bot creates and stops its own.
+        """
+        self.tenant = tenant or Tenant(fanout)
+        # Menus from the menu file if there is one; an invalid file stops the start
+        if self.tenant.menu_changed():
+            self.tenant.reload_menu()
+        self.owns_request = shared is None
+        self.engine, request = shared or create_request(engine)
+
+        # Durable state: dialogs, reply mappings, user_data and conversations
+        self.store = StateStore(self.tenant.state_db_path)
+        self.persistence = SQLitePersistence(self.store)
+        self.tenant.attach_store(self.store)
+        self.archive = TicketArchive(self.tenant.archive_dir)
+        self.tenant.attach_archive(self.archive)
+
+        # Optional recording of incoming updates for replay (see capture.py)
+        self.recorder = None
+        if capture_path:
+            self.recorder = UpdateRecorder(tenant_path(capture_path, self.tenant.name))
+
+        bot = ExtBot(token=self.tenant.token, base_url=base_url, request=request)
+        self.tenant.attach_bot(bot)
+        # The dispatcher thread only routes (and records) updates; handlers run in the lanes
+        job_queue = JobQueue()
+        self.dispatcher = LaneDispatcher(bot, Queue(), workers=0, job_queue=job_queue,
+                                         persistence=self.persistence, use_context=True,
+                                         lanes=lanes, recorder=self.recorder)
+        job_queue.set_dispatcher(self.dispatcher)
+        self.updater = Updater(dispatcher=self.dispatcher, workers=None)
+        # Handlers and jobs find their tenant here (see tenant.tenant_of)
+        self.dispatcher.bot_data['tenant'] = self.tenant
+        dispatchers.append(self.dispatcher)
+
+        if self.engine:
+            # Lets the engine send the dispatcher's calls in the background
+            self.dispatcher.add_handler(TypeHandler(Update, self.engine.mark_dispatcher),
+                                        group=-10)
+
+        # Polling that only confirms processed updates
+        self.poller = Poller(self.updater, self.store)
+
+        self.setup_metrics()
         self.setup_handlers()
+        self.setup_jobs()
+
+    @staticmethod
+    def setup_metrics():
+        """Register gauges exported on the /metrics route, summed over all tenants."""
+        registry.gauge('bot_active_dialogs', 'Open admin-user dialogs.',
+                       lambda: sum(len(t.active_dialogs) for t in tenants))
+        registry.gauge('bot_reply_index_size', 'Forwarded messages admins can reply to.',
+                       lambda: sum(len(t.reply_index) for t in tenants))
+        registry.counter_function('bot_reply_index_hits_total',
+                                  'Reply index lookups that found a user.',
+                                  lambda: sum(t.reply_index.hits for t in tenants))
+        registry.counter_function('bot_reply_index_misses_total',
+                                  'Reply index lookups that found nothing.',
+                                  lambda: sum(t.reply_index.misses for t in tenants))
+        registry.counter_function('bot_dialogs_expired_total',
+                                  'Dialogs closed for inactivity.',
+                                  lambda: sum(t.dialog_expiry.expired for t in tenants))
+        registry.gauge('bot_flood_tracked_users', 'Users with flood control state.',
+                       lambda: sum(len(t.flood_control) for t in tenants))
+        registry.gauge('bot_outbox_in_flight', 'Outbox messages queued or being sent.',
+                       lambda: sum(len(t.outbox) for t in tenants))
+        registry.gauge('bot_fanout_queue_depth', 'Sends waiting in the fan-out queue.',
+                       fanout.queue_depth)
+        registry.gauge('bot_update_queue_depth', 'Updates waiting for the dispatchers.',
+                       lambda: sum(d.update_queue.qsize() for d in dispatchers))
+        registry.gauge('bot_fast_lane_queue_depth',
+                       'Button presses and menu commands waiting for a worker.',
+                       lambda: lanes.queue_depth(FAST))
+        registry.gauge('bot_bulk_lane_queue_depth', 'Messages waiting for a worker.',
+                       lambda: lanes.queue_depth(BULK))
 
     def setup_handlers(self):
         """Set up all bot handlers."""
 
         # Conversation handler for collecting user messages
         conversation_handler = ConversationHandler(
-            entry_points=[CallbackQueryHandler(button_callback)],
+            entry_points=[CallbackQueryHandler(instrument(button_callback))],
             states={
                 WAITING_FOR_MESSAGE: [
-                    MessageHandler(Filters.text & ~Filters.command,
-                                   handle_user_message),
-                    CallbackQueryHandler(button_callback)
+                    MessageHandler((Filters.text | MEDIA_FILTER) & ~Filters.command,
+                                   instrument(handle_user_message)),
+                    CallbackQueryHandler(instrument(button_callback))
                 ]
             },
             fallbacks=[
-                CommandHandler("cancel", cancel_conversation),
-                CallbackQueryHandler(button_callback)
+                CommandHandler("cancel", instrument(cancel_conversation)),
+                CallbackQueryHandler(instrument(button_callback))
             ],
-            per_message=False)
+            per_message=False,
+            name="feedback_conversation",
+            persistent=True)
+
+        # Count every update before the regular handlers see it
+        self.dispatcher.add_handler(TypeHandler(Update, count_update), group=-2)
+        # Flood control stops rejected updates before any handler that could reply
+        self.dispatcher.add_handler(TypeHandler(Update, instrument(flood_guard)), group=-1)
 
         # Add handlers to dispatcher
-        self.dispatcher.add_handler(CommandHandler("start", start_command))
-        self.dispatcher.add_handler(CommandHandler("help", help_command))
-        self.dispatcher.add_handler(CommandHandler("dialogs", dialogs_command))
+        self.dispatcher.add_handler(CommandHandler("start", instrument(start_command)))
+        self.dispatcher.add_handler(CommandHandler("help", instrument(help_command)))
+        self.dispatcher.add_handler(CommandHandler("dialogs", instrument(dialogs_command)))
+        self.dispatcher.add_handler(CommandHandler("transfer", instrument(transfer_command)))
+        self.dispatcher.add_handler(CommandHandler("search", instrument(search_command)))
+        self.dispatcher.add_handler(CommandHandler("stats", instrument(stats_command)))
+        self.dispatcher.add_handler(CommandHandler("broadcast", instrument(broadcast_command)))
+        self.dispatcher.add_handler(CommandHandler("broadcast_stop",
+                                                   instrument(broadcast_stop_command)))
+        self.dispatcher.add_handler(CommandHandler("reload", instrument(reload_command)))
+        # Dashboard paging buttons, matched before the conversation's catch-all callbacks
+        self.dispatcher.add_handler(CallbackQueryHandler(instrument(dialogs_page_callback),
+                                                         pattern=r"^dlg:\d+:[01]$"))
         self.dispatcher.add_handler(conversation_handler)
 
         # Handle owner replies to users
         self.dispatcher.add_handler(
-            MessageHandler(Filters.reply & Filters.text & ~Filters.command,
-                           handle_owner_reply))
+            MessageHandler(Filters.reply & (Filters.text | MEDIA_FILTER) & ~Filters.command,
+                           instrument(handle_owner_reply)))
 
-        # Handle direct messages and group messages (AI works only in groups)
+        # Handle direct messages, attachments and group messages (AI works only in groups)
         self.dispatcher.add_handler(
-            MessageHandler(Filters.text & ~Filters.command,
-                           handle_direct_message))
+            MessageHandler((Filters.text | MEDIA_FILTER) & ~Filters.command,
+                           instrument(handle_direct_message)))
 
         # Handle callback queries that are not part of conversation
-        self.dispatcher.add_handler(CallbackQueryHandler(button_callback))
+        self.dispatcher.add_handler(CallbackQueryHandler(instrument(button_callback)))
 
         logger.info("Bot handlers set up successfully")
 
+    def setup_jobs(self):
+        """Schedule periodic jobs."""
+        # One repeating job advances the expiry timer wheel for all dialogs
+        self.updater.job_queue.run_repeating(
+            expire_dialogs, interval=DIALOG_EXPIRY_TICK, first=DIALOG_EXPIRY_TICK,
+            name="dialog_expiry")
+        # Sends messages left in the outbox by a previous run, then retries failed ones
+        self.updater.job_queue.run_repeating(
+            retry_outbox, interval=OUTBOX_RETRY_INTERVAL, first=0, name="outbox_retry")
+        # Notifications for colleagues are batched into one message per admin and interval
+        self.updater.job_queue.run_repeating(
+            send_digest, interval=STATUS_DIGEST_INTERVAL, first=STATUS_DIGEST_INTERVAL,
+            context=self.tenant.status_digest, name="status_digest")
+        self.updater.job_queue.run_repeating(
+            save_stats, interval=STATS_SAVE_INTERVAL, first=STATS_SAVE_INTERVAL,
+            name="stats_save")
+        if MENU_CHECK_INTERVAL:
+            self.updater.job_queue.run_repeating(
+                check_menu, interval=MENU_CHECK_INTERVAL, first=MENU_CHECK_INTERVAL,
+                name="menu_check")
+        if not self.tenant.ticket_assigner.broadcast:
+            self.updater.job_queue.run_repeating(
+                send_digest, interval=TICKET_DIGEST_INTERVAL, first=TICKET_DIGEST_INTERVAL,
+                context=self.tenant.ticket_digest, name="ticket_digest")
+
+    def start_webhook(self):
+        """Receive updates through the keep-alive web server's webhook route.
+
+        Returns False if the webhook could not be registered with Telegram.
+        """
+        url = WEBHOOK_URL + webhook_path(self.tenant.name)
+        attach_webhook(self.dispatcher, WEBHOOK_SECRET, self.tenant.name)
+        try:
+            self.updater.bot.set_webhook(
+                url=url,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS)
+        except Exception as e:
+            logger.error(f"Failed to set webhook {url}: {e}")
+            detach_webhook(self.tenant.name)
+            return False
+
+        self.start_dispatcher()
+        logger.info(f"Receiving updates via webhook {url}")
+        return True
+
+    def start_polling(self):
+        """Receive updates by long polling from the stored offset (see polling.py)."""
+        self.start_dispatcher()
+        self.poller.start()
+
+    def start_dispatcher(self):
+        """Run the dispatcher and job queue the same way Updater.start_polling does,
+        so idle() and stop() work unchanged."""
+        self.updater.running = True
+        self.updater.job_queue.start()
+        dispatcher_ready = Event()
+        self.updater._init_thread(self.dispatcher.start, "dispatcher",
+                                  ready=dispatcher_ready)
+        dispatcher_ready.wait()
+
+    def start(self):
+        """Start receiving updates using a webhook if configured, otherwise polling."""
+        self.store.start()
+        self.archive.start()
+        if not (WEBHOOK_URL and self.start_webhook()):
+            # Start polling (this also removes any previously set webhook)
+            self.start_polling()
+        self.tenant.broadcaster.resume()
+
+    def shutdown(self):
+        """Stop the updater and send what is still queued for this tenant."""
+        detach_webhook(self.tenant.name)
+        self.updater.stop()
+        # Pauses a running broadcast; it continues on the next start
+        self.tenant.broadcaster.stop()
+        for digest in (self.tenant.status_digest, self.tenant.ticket_digest):
+            flush_digest(self.tenant, digest)
+        # Deliver queued messages before persisting state; whatever is
+        # left stays in the outbox and is sent on the next start
+        self.tenant.outbox.drain(OUTBOX_DRAIN_TIMEOUT)
+
+    def close(self):
+        """Persist and close the tenant's state once nothing is sent any more."""
+        self.tenant.support_stats.save()
+        self.store.close()
+        self.archive.close()
+        if self.recorder:
+            self.recorder.close()
+
     def run(self):
-        """Run the bot using polling."""
+        """Run the bot until it is stopped."""
         logger.info("Starting bot...")
 
         try:
-            # Start polling
-            self.updater.start_polling()
+            self.start()
             logger.info("Bot started successfully")
 
             # Keep the bot running
@@ -78,12 +300,79 @@ class TelegramBot:
         except Exception as e:
             logger.error(f"Error running bot: {e}")
             raise
+        finally:
+            self.shutdown()
+            if self.owns_request:
+                lanes.shutdown()
+                fanout.shutdown(wait=True, cancel_pending=True)
+                if self.engine:
+                    self.engine.stop()
+            self.close()
 
     def run_sync(self):
         """Run the bot in sync mode (for backwards compatibility)."""
         self.run()
 
 
-def create_bot():
-    """Factory function to create a bot instance."""
-    return TelegramBot()
+class BotHost:
+    """Several tenants' bots in one process.
+
+    The bots share the fan-out sender, the worker lanes, the HTTP connection
+    pool (or the asyncio engine) and the keep-alive web server; each tenant keeps its own
+    Updater, state database, archive and outbox; the fan-out limits are
+    kept per bot token. Per tenant this costs a dispatcher thread, a job
+    queue thread, a polling thread (none in webhook mode, where tenants are
+    served at WEBHOOK_PATH/<name>), the state store's flusher and the
+    archive writer, plus a broadcaster thread while a /broadcast runs.
+    """
+
+    def __init__(self, tenant_configs, base_url=BOT_API_BASE_URL, capture_path=CAPTURE_PATH,
+                 engine=BOT_ENGINE):
+        self.engine, request = create_request(engine, len(tenant_configs))
+        self.bots = [TelegramBot(Tenant(fanout, **config), base_url=base_url,
+                                 capture_path=capture_path, shared=(self.engine, request))
+                     for config in tenant_configs]
+
+    def run(self):
+        """Run all bots until the process is stopped."""
+        logger.info(f"Starting {len(self.bots)} bots...")
+
+        try:
+            for bot in self.bots:
+                bot.start()
+            logger.info("Bots started successfully")
+
+            # Signals stop the first updater; the others are stopped below
+            self.bots[0].updater.idle()
+
+        except KeyboardInterrupt:
+            logger.info("Bots stopped by user")
+        except Exception as e:
+            logger.error(f"Error running bots: {e}")
+            raise
+        finally:
+            for bot in self.bots:
+                bot.shutdown()
+            lanes.shutdown()
+            fanout.shutdown(wait=True, cancel_pending=True)
+            if self.engine:
+                self.engine.stop()
+            for bot in self.bots:
+                bot.close()
+
+    def run_sync(self):
+        """Run the bots in sync mode (for backwards compatibility)."""
+        self.run()
+
+
+def create_bot(base_url=BOT_API_BASE_URL, capture_path=CAPTURE_PATH, engine=BOT_ENGINE,
+               tenants=None):
+    """Factory function to create a bot instance.
+
+    With ``tenants`` (configs as returned by tenant.load_tenants) all of
+    them are served by one BotHost; otherwise one bot uses the tenant from
+    config.py.
+    """
+    if tenants:
+        return BotHost(tenants, base_url=base_url, capture_path=capture_path, engine=engine)
+    return TelegramBot(base_url=base_url, capture_path=capture_path, engine=engine)
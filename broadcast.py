@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from concurrent.futures import wait
+from telegram.error import BadRequest, TelegramError
+from config import BROADCAST_RATE, BROADCAST_BATCH
+from fanout import TokenBucket
+from async_engine import wait_for_result
+from render import broadcast_status_text
+
+logger = logging.getLogger(__name__)
+
+# Key of the current (or last) broadcast in the state store's meta table
+BROADCAST_KEY = 'broadcast'
+
+
+class Broadcaster:
+    """Sends an announcement from an admin to every user in the store.
+
+    Recipients are read in pages of ``batch`` ids in ascending order, so
+    the list is never loaded at once. Sends are paced by a token bucket of
+    ``rate`` per second and go through the FanoutSender, which adds the
+    global and per-chat limits and retries. After each page the last user
+    id and the counters are saved to the meta table and the admin's status
+    message is edited; after a restart ``resume`` continues after that id,
+    so at most one page can get the announcement twice.
+    """
+
+    def __init__(self, sender, rate=BROADCAST_RATE, batch=BROADCAST_BATCH):
+        self.store = None
+        self.sender = sender
+        self.bot = None
+        self.bucket = TokenBucket(rate, 1)
+        self.batch = batch
+        self.state = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def attach_store(self, store):
+        self.store = store
+        self.state = store.load_meta(BROADCAST_KEY)
+
+    def attach_bot(self, bot):
+        self.bot = bot
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, text, admin_id):
+        """Begin a broadcast; returns False if one is already running."""
+        with self._lock:
+            if self.running:
+                return False
+            # Users seen moments ago may still be in the write-behind queue
+            self.store.flush()
+            self.state = {'text': text, 'admin_id': admin_id, 'status_message_id': None,
+                          'total': self.store.count_users(), 'last_user_id': 0,
+                          'sent': 0, 'failed': 0, 'started_at': time.time(),
+                          'finished_at': None, 'cancelled': False}
+            with wait_for_result():
+                status = self.bot.send_message(admin_id, broadcast_status_text(self.state))
+            self.state['status_message_id'] = status.message_id
+            self.store.save_meta(BROADCAST_KEY, self.state)
+            self._spawn()
+        logger.info(f"Admin {admin_id} started a broadcast to {self.state['total']} users")
+        return True
+
+    def resume(self):
+        """Continue a broadcast interrupted by a restart; returns True if there was one."""
+        with self._lock:
+            state = self.state
+            if self.running or not state or state['finished_at'] or state['cancelled']:
+                return False
+            self._spawn()
+        logger.info(f"Resuming broadcast after user {state['last_user_id']} "
+                    f"({state['sent']} of {state['total']} sent)")
+        return True
+
+    def cancel(self):
+        """Stop the running broadcast for good after the current page.
+
+        Returns False if none was running.
+        """
+        with self._lock:
+            if not self.running:
+                return False
+            self.state['cancelled'] = True
+            self._stop.set()
+        return True
+
+    def stop(self, timeout=30):
+        """Stop after the current page; an uncancelled broadcast is resumed on the next start."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _spawn(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="Broadcaster", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        state = self.state
+        try:
+            while not self._stop.is_set():
+                user_ids = self.store.users_after(state['last_user_id'], self.batch)
+                if not user_ids:
+                    state['finished_at'] = time.time()
+                    break
+                futures = []
+                for user_id in user_ids:
+                    if self._stop.is_set():
+                        break
+                    self.bucket.acquire()
+                    futures.append(self.sender.send(self.bot.send_message, user_id,
+                                                    token=self.bot.token, text=state['text']))
+                    state['last_user_id'] = user_id
+                wait(futures)
+                sent = sum(future.result() is not None for future in futures)
+                state['sent'] += sent
+                state['failed'] += len(futures) - sent
+                self._checkpoint()
+        except Exception as e:
+            logger.error(f"Broadcast stopped after user {state['last_user_id']}: {e}")
+            self._checkpoint()
+        if state['finished_at']:
+            self._checkpoint()
+            logger.info(f"Broadcast finished: {state['sent']} sent, {state['failed']} failed")
+
+    def _checkpoint(self):
+        """Save the progress and show it in the admin's status message."""
+        state = self.state
+        self.store.save_meta(BROADCAST_KEY, state)
+        try:
+            self.bot.edit_message_text(broadcast_status_text(state), chat_id=state['admin_id'],
+                                       message_id=state['status_message_id'])
+        except BadRequest as e:
+            if 'not modified' not in str(e):
+                logger.error(f"Failed to update broadcast status: {e}")
+        except TelegramError as e:
+            logger.error(f"Failed to update broadcast status: {e}")
@@ -0,0 +1,54 @@
+import gzip
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class UpdateRecorder:
+    """Appends incoming updates to a capture file in the order they arrive.
+
+    Each line is a compact JSON array ``[timestamp, update]``. Files ending
+    in ``.gz`` are gzip-compressed; every run appends a new gzip member.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = _open(path, 'a')
+        self._compressed = path.endswith('.gz')
+        self._lock = threading.Lock()
+        self.recorded = 0
+        logger.info(f"Recording updates to {path}")
+
+    def record(self, update, context=None):
+        """TypeHandler callback writing one update to the capture."""
+        line = json.dumps([round(time.time(), 3), update.to_dict()],
+                          ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            if not self._compressed:
+                self._file.flush()
+            self.recorded += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        logger.info(f"Recorded {self.recorded} updates to {self.path}")
+
+
+def read_capture(path):
+    """Yield ``(timestamp, update_dict)`` pairs from a capture file."""
+    with _open(path, 'r') as capture:
+        for line in capture:
+            line = line.strip()
+            if line:
+                timestamp, update = json.loads(line)
+                yield timestamp, update
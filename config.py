@@ -1,9 +1,13 @@
 import os
+import secrets
 
 # Bot configuration
 BOT_TOKEN = os.getenv("BOT_TOKEN",
                       "AAGfoLBzDW4x7UBZp6lbOt3SiUima0UTrGY")
 
+# Bot API endpoint (override to use a local Bot API server or a test stub)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "https://api.telegram.org/bot")
+
 
 # Support for multiple owners - add both owner IDs
 OWNER_IDS = [
@@ -16,7 +20,7 @@ OWNER_IDS = [
 # Backward compatibility
 OWNER_ID = OWNER_IDS[0]
 
-# Categories for the menu
+# Default categories for the menu (MENU_FILE below takes precedence)
 CATEGORIES = {
     "joining": "Вступление во флуд",
     "questions": "Интересующие вопросы",
@@ -42,3 +46,154 @@ CATEGORY_INSTRUCTIONS = {
     "complaints": "Опишите вашу жалобу. Мы обязательно рассмотрим ее.",
     "other": "Напишите ваше сообщение по любому другому вопросу."
 }
+
+# Reply mapping index: how long admins can reply to a forwarded message
+# (seconds) and how many forwarded messages are remembered at most
+REPLY_INDEX_TTL = int(os.getenv("REPLY_INDEX_TTL", str(7 * 24 * 60 * 60)))
+REPLY_INDEX_MAX_SIZE = int(os.getenv("REPLY_INDEX_MAX_SIZE", "50000"))
+
+# Persistent state (dialogs, reply mappings, user data)
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+# Pending writes are flushed every STATE_FLUSH_INTERVAL seconds or as soon as
+# STATE_FLUSH_BATCH changes are waiting
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))
+STATE_FLUSH_BATCH = int(os.getenv("STATE_FLUSH_BATCH", "500"))
+
+# Parallel fan-out of messages to several chats (see fanout.py).
+# Telegram allows about 30 messages per second overall and about one
+# message per second in a single chat.
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "8"))
+FANOUT_GLOBAL_RATE = float(os.getenv("FANOUT_GLOBAL_RATE", "30"))
+FANOUT_CHAT_RATE = float(os.getenv("FANOUT_CHAT_RATE", "1"))
+FANOUT_CHAT_BURST = int(os.getenv("FANOUT_CHAT_BURST", "3"))
+FANOUT_MAX_RETRIES = int(os.getenv("FANOUT_MAX_RETRIES", "5"))
+FANOUT_RETRY_BACKOFF = float(os.getenv("FANOUT_RETRY_BACKOFF", "1.0"))
+
+# Webhook mode: when WEBHOOK_URL (public https base URL of the keep-alive web
+# server) is set, Telegram pushes updates to WEBHOOK_URL + WEBHOOK_PATH
+# instead of the bot long-polling for them
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Telegram sends this back in a header so we can reject forged requests
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_hex(16)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Record every incoming update to this file for later replay (see capture.py);
+# empty disables recording. A ".gz" suffix enables compression.
+CAPTURE_PATH = os.getenv("CAPTURE_PATH", "")
+
+# Number of locks guarding the dialog registry (operations on different
+# users rarely share a lock)
+DIALOG_LOCK_STRIPES = int(os.getenv("DIALOG_LOCK_STRIPES", "64"))
+
+# Dialogs with no messages for this long (seconds) are closed automatically;
+# DIALOG_TIMEOUTS overrides the timeout for single categories
+DIALOG_TIMEOUT = int(os.getenv("DIALOG_TIMEOUT", str(24 * 60 * 60)))
+DIALOG_TIMEOUTS = {
+    "questions": 6 * 60 * 60,
+    "rest": 3 * 24 * 60 * 60,
+}
+# How often (seconds) expired dialogs are looked for
+DIALOG_EXPIRY_TICK = float(os.getenv("DIALOG_EXPIRY_TICK", "60"))
+
+# Dialogs shown per page of the /dialogs dashboard
+DIALOGS_PAGE_SIZE = int(os.getenv("DIALOGS_PAGE_SIZE", "10"))
+
+# How new tickets reach the admins: "broadcast" sends every ticket to all
+# admins; "least_loaded", "round_robin" and "category" send it to one admin
+# (see assignment.py) and the others only get a periodic digest
+ASSIGNMENT_MODE = os.getenv("ASSIGNMENT_MODE", "broadcast")
+# Admins preferred for a category in "category" mode, e.g.
+# {"joining": [OWNER_IDS[0]], "unions": [OWNER_IDS[0], OWNER_IDS[1]]};
+# categories not listed go to the least loaded admin
+CATEGORY_ADMINS = {}
+# How often (seconds) the digest of tickets assigned to colleagues is sent
+TICKET_DIGEST_INTERVAL = float(os.getenv("TICKET_DIGEST_INTERVAL", "300"))
+# How often (seconds) other admins get the digest of dialog starts and ends
+STATUS_DIGEST_INTERVAL = float(os.getenv("STATUS_DIGEST_INTERVAL", "60"))
+
+# Flood control for non-admin users: FLOOD_BURST messages at once, then
+# FLOOD_RATE per second; state of users idle for FLOOD_STATE_TTL seconds is dropped
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "0.2"))
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "5"))
+FLOOD_STATE_TTL = float(os.getenv("FLOOD_STATE_TTL", "3600"))
+# Button presses have their own budget: FLOOD_CALLBACK_BURST at once, then
+# FLOOD_CALLBACK_RATE per second
+FLOOD_CALLBACK_RATE = float(os.getenv("FLOOD_CALLBACK_RATE", "1"))
+FLOOD_CALLBACK_BURST = int(os.getenv("FLOOD_CALLBACK_BURST", "10"))
+# The same text sent again within this many seconds is dropped
+DUPLICATE_WINDOW = float(os.getenv("DUPLICATE_WINDOW", "600"))
+
+# Outgoing messages are stored in the state database before they are sent
+# and retried until delivered (see outbox.py). Keys of delivered messages
+# are kept this long (seconds) so the same message is not sent twice.
+OUTBOX_KEY_TTL = float(os.getenv("OUTBOX_KEY_TTL", str(24 * 60 * 60)))
+# How often (seconds) messages whose retries ran out are tried again
+OUTBOX_RETRY_INTERVAL = float(os.getenv("OUTBOX_RETRY_INTERVAL", "60"))
+# How long (seconds) shutdown waits for queued messages to go out
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", "30"))
+
+# "threads" runs Bot API calls on PTB's blocking urllib3 pool; "asyncio" sends
+# them from one event loop and lets the dispatcher move on without waiting for
+# calls whose results the handlers don't use (see async_engine.py)
+BOT_ENGINE = os.getenv("BOT_ENGINE", "threads")
+# Connections to the Bot API kept by the asyncio engine
+ASYNC_MAX_CONNECTIONS = int(os.getenv("ASYNC_MAX_CONNECTIONS", "100"))
+# Background calls the dispatcher may queue before it waits for them
+ASYNC_MAX_PENDING = int(os.getenv("ASYNC_MAX_PENDING", "10000"))
+
+# Polling (when no webhook is used): long-poll timeout in seconds; on start
+# the backlog of updates is first pulled in batches of DRAIN_BATCH (100 is
+# Telegram's maximum), dropping stale button presses and repeated messages
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "10"))
+DRAIN_ON_START = os.getenv("DRAIN_ON_START", "1") == "1"
+DRAIN_BATCH = int(os.getenv("DRAIN_BATCH", "100"))
+
+# Archive of tickets and dialog messages searchable with /search (see archive.py);
+# records go to segment files of up to ARCHIVE_SEGMENT_SIZE bytes
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", str(16 * 1024 * 1024)))
+# Results shown per /search
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "10"))
+
+# How often (seconds) the /stats counters are saved to the state store
+STATS_SAVE_INTERVAL = float(os.getenv("STATS_SAVE_INTERVAL", "60"))
+
+# /broadcast sends this many messages per second at most, leaving part of
+# FANOUT_GLOBAL_RATE to regular replies, and saves its progress after every
+# BROADCAST_BATCH recipients (see broadcast.py)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "100"))
+
+# Seconds to wait for the rest of an album (photos sent together) before
+# relaying it as one batch
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT", "1.0"))
+
+# Serve several bots from one process: a JSON file with a list of tenants, each
+# {"name", "token", "owner_ids"} and optionally "categories", "instructions",
+# "assignment_mode" and "category_admins" (see tenant.py). Empty runs the
+# single bot configured above.
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")
+
+# Logging goes through a queue to a background thread (see logsetup.py).
+# LOG_FORMAT is "json" (one object per line with the update id, user id,
+# handler and duration) or "text"; LOG_FILE adds a log file next to stderr.
+# Of high-volume info lines only one in LOG_SAMPLE_EVERY is written.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_FILE = os.getenv("LOG_FILE", "")
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "10"))
+
+# Menus can be changed without a restart: categories and instructions are
+# read from MENU_FILE (JSON: {"categories": {...}, "instructions": {...}}) if
+# it exists, instead of the defaults above. Owners apply changes with /reload;
+# the file is also checked for changes every MENU_CHECK_INTERVAL seconds (0
+# disables the check).
+MENU_FILE = os.getenv("MENU_FILE", "menu.json")
+MENU_CHECK_INTERVAL = float(os.getenv("MENU_CHECK_INTERVAL", "30"))
+
+# Updates are handled on two worker pools (see lanes.py): button presses and
+# menu commands in the fast lane, messages (tickets, dialogs, admin replies)
+# in the bulk lane, so menus stay responsive during bursts of tickets
+LANE_FAST_WORKERS = int(os.getenv("LANE_FAST_WORKERS", "4"))
+LANE_BULK_WORKERS = int(os.getenv("LANE_BULK_WORKERS", "4"))
@@ -0,0 +1,167 @@
+import threading
+import time
+from itertools import islice
+from config import DIALOG_LOCK_STRIPES
+
+
+class Dialog:
+    """An open conversation between a user and the admin who claimed it."""
+
+    __slots__ = ('user_id', 'admin_id', 'category', 'started_at', 'last_activity')
+
+    def __init__(self, user_id, admin_id, category, started_at=None, last_activity=None):
+        self.user_id = user_id
+        self.admin_id = admin_id
+        self.category = category
+        self.started_at = started_at or time.time()
+        self.last_activity = last_activity or self.started_at
+
+
+class DialogRegistry:
+    """Thread-safe registry of active dialogs.
+
+    Operations on a user's dialog are serialized by one of ``stripes``
+    locks chosen by user id, so handlers working on different users do not
+    contend. A secondary index maps each admin to the users they talk to.
+    """
+
+    def __init__(self, stripes=DIALOG_LOCK_STRIPES):
+        self._dialogs = {}
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._by_admin = {}
+        self._admin_lock = threading.Lock()
+        self.store = None
+
+    def attach_store(self, store):
+        """Restore dialogs from a StateStore and persist further changes to it."""
+        self.store = store
+        for dialog in store.load_dialogs():
+            self._dialogs[dialog.user_id] = dialog
+            self._index_add(dialog.admin_id, dialog.user_id)
+
+    def _lock_for(self, user_id):
+        return self._locks[hash(user_id) % len(self._locks)]
+
+    def _index_add(self, admin_id, user_id):
+        with self._admin_lock:
+            self._by_admin.setdefault(admin_id, set()).add(user_id)
+
+    def _index_remove(self, admin_id, user_id):
+        with self._admin_lock:
+            users = self._by_admin.get(admin_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._by_admin[admin_id]
+
+    def _save(self, dialog):
+        if self.store is not None:
+            self.store.save_dialog(dialog)
+
+    def _remove(self, dialog):
+        del self._dialogs[dialog.user_id]
+        self._index_remove(dialog.admin_id, dialog.user_id)
+        if self.store is not None:
+            self.store.delete_dialog(dialog.user_id)
+
+    def get(self, user_id):
+        """Return the user's dialog or None."""
+        return self._dialogs.get(user_id)
+
+    def claim(self, user_id, admin_id, category):
+        """Atomically take a user's dialog for an admin.
+
+        Returns ``(dialog, started)``. If another admin already owns the
+        dialog it is returned unchanged (check ``dialog.admin_id``);
+        ``started`` is True only when a new dialog was opened.
+        """
+        with self._lock_for(user_id):
+            dialog = self._dialogs.get(user_id)
+            if dialog is not None:
+                if dialog.admin_id == admin_id:
+                    dialog.last_activity = time.time()
+                    self._save(dialog)
+                return dialog, False
+            dialog = Dialog(user_id, admin_id, category)
+            self._dialogs[user_id] = dialog
+            self._index_add(admin_id, user_id)
+            self._save(dialog)
+            return dialog, True
+
+    def release(self, user_id, admin_id=None):
+        """Close a user's dialog; returns it, or None if there was none.
+
+        When ``admin_id`` is given, the dialog is only closed if that admin owns it.
+        """
+        with self._lock_for(user_id):
+            dialog = self._dialogs.get(user_id)
+            if dialog is None or (admin_id is not None and dialog.admin_id != admin_id):
+                return None
+            self._remove(dialog)
+            return dialog
+
+    def release_inactive(self, user_id, inactive_since):
+        """Close a user's dialog if it had no activity after ``inactive_since``."""
+        with self._lock_for(user_id):
+            dialog = self._dialogs.get(user_id)
+            if dialog is None or dialog.last_activity > inactive_since:
+                return None
+            self._remove(dialog)
+            return dialog
+
+    def transfer(self, user_id, from_admin_id, to_admin_id):
+        """Hand a dialog over to another admin; returns False if not owned by from_admin_id."""
+        with self._lock_for(user_id):
+            dialog = self._dialogs.get(user_id)
+            if dialog is None or dialog.admin_id != from_admin_id:
+                return False
+            dialog.admin_id = to_admin_id
+            dialog.last_activity = time.time()
+            self._index_remove(from_admin_id, user_id)
+            self._index_add(to_admin_id, user_id)
+            self._save(dialog)
+            return True
+
+    def touch(self, user_id):
+        """Record activity in a user's dialog; returns the dialog or None."""
+        with self._lock_for(user_id):
+            dialog = self._dialogs.get(user_id)
+            if dialog is not None:
+                dialog.last_activity = time.time()
+                self._save(dialog)
+            return dialog
+
+    def users_of(self, admin_id):
+        """User ids of the dialogs an admin owns."""
+        with self._admin_lock:
+            return list(self._by_admin.get(admin_id, ()))
+
+    def count_of(self, admin_id):
+        """Number of dialogs an admin owns."""
+        with self._admin_lock:
+            return len(self._by_admin.get(admin_id, ()))
+
+    def page(self, offset, limit, admin_id=None):
+        """One page of open dialogs and the number of dialogs to page through.
+
+        With ``admin_id`` only that admin's dialogs are listed, taken from
+        the per-admin index. Otherwise dialogs are listed in the order they
+        were opened and only the dialogs up to the page end are visited.
+        """
+        if admin_id is not None:
+            user_ids = sorted(self.users_of(admin_id))
+            dialogs = [self._dialogs.get(user_id) for user_id in user_ids[offset:offset + limit]]
+            return [dialog for dialog in dialogs if dialog is not None], len(user_ids)
+        # list(islice(...)) runs without releasing the GIL, so it cannot see
+        # the dict change size mid-iteration
+        return list(islice(self._dialogs.values(), offset, offset + limit)), len(self._dialogs)
+
+    def snapshot(self):
+        """List of all open dialogs."""
+        return list(self._dialogs.values())
+
+    def __contains__(self, user_id):
+        return user_id in self._dialogs
+
+    def __len__(self):
+        return len(self._dialogs)
@@ -0,0 +1,47 @@
+import threading
+
+# Telegram rejects messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+
+class DigestBuffer:
+    """Collects notification lines per chat and hands them out as digests.
+
+    ``add`` only appends to a list; a periodic job calls ``drain`` and sends
+    one message per chat, so the number of messages depends on how often
+    the buffer is drained rather than on how many events happened.
+    """
+
+    def __init__(self, title, max_lines=50):
+        self.title = title
+        self.max_lines = max_lines
+        self._lines = {}  # chat_id -> [line, ...]
+        self._lock = threading.Lock()
+
+    def add(self, chat_id, line):
+        with self._lock:
+            self._lines.setdefault(chat_id, []).append(line)
+
+    def add_many(self, chat_ids, line):
+        with self._lock:
+            for chat_id in chat_ids:
+                self._lines.setdefault(chat_id, []).append(line)
+
+    def drain(self):
+        """Take the buffered lines; returns ``[(chat_id, text), ...]``."""
+        with self._lock:
+            pending, self._lines = self._lines, {}
+        return [(chat_id, self._render(lines)) for chat_id, lines in pending.items()]
+
+    def _render(self, lines):
+        shown = lines[:self.max_lines]
+        text = self.title + "\n\n" + "\n".join(shown)
+        if len(lines) > len(shown):
+            text += f"\n…и ещё {len(lines) - len(shown)}"
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = text[:MAX_MESSAGE_LENGTH - 1] + "…"
+        return text
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(lines) for lines in self._lines.values())
@@ -0,0 +1,99 @@
+import math
+import threading
+import time
+from config import DIALOG_TIMEOUT, DIALOG_TIMEOUTS, DIALOG_EXPIRY_TICK
+
+
+class TimerWheel:
+    """Hashed timer wheel: keys are bucketed by the tick they are due in.
+
+    Advancing the wheel only looks at the slots of the ticks that passed, so
+    its cost depends on how many keys fall due, not on how many are waiting.
+    A key is scheduled at most once; scheduling it again for a later time
+    keeps the earlier entry, and the owner reschedules it when it fires.
+    """
+
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._due = {}  # key -> absolute tick number
+        self._position = int(time.time() // tick)
+        self._lock = threading.Lock()
+
+    def schedule(self, key, when):
+        """Fire ``key`` at the first tick at or after the timestamp ``when``."""
+        tick_no = math.ceil(when / self.tick)
+        with self._lock:
+            # Keys further out than one revolution fire early and get rescheduled
+            tick_no = min(max(tick_no, self._position + 1),
+                          self._position + len(self._slots))
+            current = self._due.get(key)
+            if current is not None:
+                if current <= tick_no:
+                    return
+                self._slots[current % len(self._slots)].discard(key)
+            self._due[key] = tick_no
+            self._slots[tick_no % len(self._slots)].add(key)
+
+    def advance(self, now):
+        """Move the wheel up to ``now``; returns the keys that fell due."""
+        fired = []
+        with self._lock:
+            target = int(now // self.tick)
+            start = max(self._position + 1, target - len(self._slots) + 1)
+            for tick_no in range(start, target + 1):
+                slot = self._slots[tick_no % len(self._slots)]
+                for key in slot:
+                    del self._due[key]
+                fired.extend(slot)
+                slot.clear()
+            self._position = max(self._position, target)
+        return fired
+
+    def __len__(self):
+        return len(self._due)
+
+
+class DialogExpiry:
+    """Closes dialogs that had no activity for their category's timeout.
+
+    Dialogs are put on a TimerWheel when they open; activity does not touch
+    the wheel. When a dialog's entry fires, its deadline is recomputed from
+    ``last_activity`` and the dialog is either closed or rescheduled.
+    """
+
+    def __init__(self, registry, timeouts=None, default_timeout=DIALOG_TIMEOUT,
+                 tick=DIALOG_EXPIRY_TICK):
+        self.registry = registry
+        self.timeouts = dict(DIALOG_TIMEOUTS if timeouts is None else timeouts)
+        self.default_timeout = default_timeout
+        longest = max([default_timeout, *self.timeouts.values()])
+        self.wheel = TimerWheel(tick, math.ceil(longest / tick) + 1)
+        self.expired = 0
+
+    def timeout_for(self, category):
+        return self.timeouts.get(category, self.default_timeout)
+
+    def watch(self, dialog):
+        """Start tracking a dialog's inactivity."""
+        self.wheel.schedule(dialog.user_id,
+                            dialog.last_activity + self.timeout_for(dialog.category))
+
+    def expire_due(self, now=None):
+        """Close the dialogs whose timeout passed; returns them."""
+        now = now or time.time()
+        expired = []
+        for user_id in self.wheel.advance(now):
+            dialog = self.registry.get(user_id)
+            if dialog is None:
+                continue
+            timeout = self.timeout_for(dialog.category)
+            closed = self.registry.release_inactive(user_id, now - timeout)
+            if closed is not None:
+                expired.append(closed)
+                continue
+            dialog = self.registry.get(user_id)
+            if dialog is not None:
+                self.watch(dialog)
+        self.expired += len(expired)
+        return expired
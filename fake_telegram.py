@@ -0,0 +1,228 @@
+import json
+from email.parser import BytesParser
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {'id': 100000, 'is_bot': True, 'first_name': 'FakeBot',
+            'username': 'fake_bot'}
+
+
+def _parse_multipart(content_type, body):
+    """Form fields of a multipart body (PTB posts sendMediaGroup this way)."""
+    message = BytesParser().parsebytes(
+        f'Content-Type: {content_type}\r\n\r\n'.encode('latin-1') + body)
+    return {part.get_param('name', header='content-disposition'):
+            part.get_payload(decode=True).decode('utf-8')
+            for part in message.get_payload()}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type') or ''
+        try:
+            if content_type.startswith('multipart/form-data'):
+                params = _parse_multipart(content_type, body)
+            else:
+                params = json.loads(body) if body else {}
+        except ValueError:
+            params = {}
+        method = self.path.rsplit('/', 1)[-1]
+        status, payload = self.server.api.handle(method, params)
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramServer:
+    """In-process stand-in for the Telegram Bot API, used for load tests.
+
+    Implements the endpoints the bot relies on (getUpdates, sendMessage,
+    editMessageText, answerCallbackQuery and a few bootstrap calls).
+    ``latency`` delays every response and ``error_rate`` is the share of
+    requests (other than getUpdates) answered with 429 Too Many Requests;
+    with ``error_chats`` only requests to those chats get 429s.
+    Point the bot at it with ``create_bot(base_url=server.base_url)``.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 error_chats=None, retry_after=1, history=10000):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_chats = set(error_chats) if error_chats is not None else None
+        self.retry_after = retry_after
+        self._updates = deque()
+        self._next_update_id = 1
+        self._next_message_id = defaultdict(lambda: 1)
+        self._cond = threading.Condition()
+        # Recent outgoing messages: (method, chat_id, message dict)
+        self.sent = deque(maxlen=history)
+        self.calls = defaultdict(int)
+        self.throttled = 0
+        # Callables invoked as listener(method, chat_id, message) on every send
+        self.listeners = []
+        self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.api = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever,
+                                        name="FakeTelegramServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    # Driving the bot
+
+    def push_update(self, update):
+        """Queue an update dict for getUpdates; returns it with its update_id."""
+        with self._cond:
+            update['update_id'] = self._next_update_id
+            self._next_update_id += 1
+            self._updates.append(update)
+            self._cond.notify_all()
+        return update
+
+    def wait_for(self, predicate, timeout=30.0):
+        """Block until ``predicate(sent)`` is true; returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not predicate(self.sent):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # Bot API
+
+    def handle(self, method, params):
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and self._may_fail(params) and random.random() < self.error_rate:
+            self.throttled += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f'Too Many Requests: retry after {self.retry_after}',
+                         'parameters': {'retry_after': self.retry_after}}
+
+        handler = getattr(self, f'_api_{method}', None)
+        if handler is None:
+            return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        return 200, {'ok': True, 'result': handler(params)}
+
+    def _may_fail(self, params):
+        if self.error_chats is None:
+            return True
+        chat_id = params.get('chat_id')
+        return chat_id is not None and int(chat_id) in self.error_chats
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            # Updates below the offset are confirmed and can be dropped
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+                while self._updates and self._updates[0]['update_id'] < offset:
+                    self._updates.popleft()
+            return [self._updates[i] for i in range(min(limit, len(self._updates)))]
+
+    def _record(self, method, chat_id, message):
+        for listener in self.listeners:
+            listener(method, chat_id, message)
+        with self._cond:
+            self.sent.append((method, chat_id, message))
+            self._cond.notify_all()
+
+    def _new_message(self, params):
+        chat_id = int(params['chat_id'])
+        with self._cond:
+            message_id = self._next_message_id[chat_id]
+            self._next_message_id[chat_id] += 1
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private'},
+                   'from': BOT_USER, 'text': params.get('text', '')}
+        if params.get('reply_markup'):
+            markup = params['reply_markup']
+            message['reply_markup'] = json.loads(markup) if isinstance(markup, str) else markup
+        return message
+
+    def _api_getMe(self, params):
+        return BOT_USER
+
+    def _api_deleteWebhook(self, params):
+        return True
+
+    def _api_setWebhook(self, params):
+        return True
+
+    def _api_sendMessage(self, params):
+        message = self._new_message(params)
+        self._record('sendMessage', message['chat']['id'], message)
+        return message
+
+    def _api_copyMessage(self, params):
+        message = self._new_message(params)
+        message['text'] = params.get('caption', '')
+        self._record('copyMessage', message['chat']['id'], message)
+        return {'message_id': message['message_id']}
+
+    def _api_sendMediaGroup(self, params):
+        media = params.get('media') or '[]'
+        messages = []
+        for item in json.loads(media) if isinstance(media, str) else media:
+            message = self._new_message(params)
+            message['text'] = item.get('caption', '')
+            message['media_type'] = item.get('type')
+            messages.append(message)
+            self._record('sendMediaGroup', message['chat']['id'], message)
+        return messages
+
+    def _api_editMessageText(self, params):
+        message = {'message_id': int(params.get('message_id') or 0),
+                   'date': int(time.time()),
+                   'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+                   'from': BOT_USER, 'text': params.get('text', '')}
+        self._record('editMessageText', message['chat']['id'], message)
+        return message
+
+    def _api_answerCallbackQuery(self, params):
+        return True
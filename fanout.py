@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import (RetryAfter, BadRequest, TimedOut, NetworkError,
+                            TelegramError)
+from config import (FANOUT_WORKERS, FANOUT_GLOBAL_RATE, FANOUT_CHAT_RATE,
+                    FANOUT_CHAT_BURST, FANOUT_MAX_RETRIES, FANOUT_RETRY_BACKOFF)
+
+logger = logging.getLogger(__name__)
+
+# Per-chat buckets idle for this long are dropped (seconds)
+CHAT_BUCKET_IDLE = 10 * 60
+
+
+class TokenBucket:
+    """Thread-safe token bucket: ``rate`` tokens per second, up to ``capacity``."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if available; return 0 or the seconds to wait otherwise."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available."""
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class FanoutSender:
+    """Sends Bot API requests to many chats in parallel.
+
+    Every send waits for a token from its chat's bucket and from the global
+    bucket, so we stay under Telegram's flood limits. The limits apply per
+    bot: sends passing a bot ``token`` use that bot's buckets, so bots
+    sharing the sender do not share a budget. ``RetryAfter`` is honoured
+    and network errors are retried with exponential backoff.
+    """
+
+    def __init__(self, workers=FANOUT_WORKERS, global_rate=FANOUT_GLOBAL_RATE,
+                 chat_rate=FANOUT_CHAT_RATE, chat_burst=FANOUT_CHAT_BURST,
+                 max_retries=FANOUT_MAX_RETRIES, retry_backoff=FANOUT_RETRY_BACKOFF):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="Fanout")
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        # bot token -> global bucket of the bot
+        self._global_buckets = {}
+        # (bot token, chat_id) -> bucket
+        self._chat_buckets = {}
+        self._bucket_lock = threading.Lock()
+        self._last_cleanup = time.monotonic()
+
+    def _global_bucket(self, token):
+        with self._bucket_lock:
+            bucket = self._global_buckets.get(token)
+            if bucket is None:
+                bucket = self._global_buckets[token] = TokenBucket(self.global_rate)
+            return bucket
+
+    def _chat_bucket(self, token, chat_id):
+        with self._bucket_lock:
+            now = time.monotonic()
+            if now - self._last_cleanup > CHAT_BUCKET_IDLE:
+                self._chat_buckets = {
+                    key: bucket for key, bucket in self._chat_buckets.items()
+                    if now - bucket.updated < CHAT_BUCKET_IDLE
+                }
+                self._last_cleanup = now
+            bucket = self._chat_buckets.get((token, chat_id))
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._chat_buckets[(token, chat_id)] = bucket
+            return bucket
+
+    def send(self, method, chat_id, on_success=None, on_failure=None, token=None, **kwargs):
+        """Queue ``method(chat_id=chat_id, **kwargs)`` and return a Future.
+
+        ``on_success`` is called with the API result once the call succeeds,
+        ``on_failure`` with ``permanent`` (False if retries ran out) when we give up.
+        ``token`` is the token of the bot that sends, whose limits apply.
+        """
+        return self.executor.submit(self._deliver, method, chat_id,
+                                    on_success, on_failure, token, kwargs)
+
+    def broadcast(self, method, chat_ids, on_success=None, token=None, **kwargs):
+        """Queue the same call for several chats.
+
+        ``on_success`` is called as ``on_success(chat_id, result)``.
+        """
+        futures = []
+        for chat_id in chat_ids:
+            callback = None
+            if on_success is not None:
+                callback = (lambda result, chat_id=chat_id:
+                            on_success(chat_id, result))
+            futures.append(self.send(method, chat_id, callback, token=token, **kwargs))
+        return futures
+
+    def _deliver(self, method, chat_id, on_success, on_failure, token, kwargs):
+        chat_bucket = self._chat_bucket(token, chat_id)
+        global_bucket = self._global_bucket(token)
+        attempt = 0
+        while True:
+            chat_bucket.acquire()
+            global_bucket.acquire()
+            try:
+                result = method(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                delay = e.retry_after
+            except BadRequest as e:
+                logger.error(f"Failed to send message to {chat_id}: {e}")
+                self._failed(on_failure, chat_id, True)
+                return None
+            except (TimedOut, NetworkError) as e:
+                delay = self.retry_backoff * (2 ** attempt)
+                logger.warning(f"Send to {chat_id} failed ({e}), retrying in {delay:.1f}s")
+            except TelegramError as e:
+                logger.error(f"Failed to send message to {chat_id}: {e}")
+                self._failed(on_failure, chat_id, True)
+                return None
+            else:
+                if on_success is not None:
+                    try:
+                        on_success(result)
+                    except Exception as e:
+                        logger.error(f"Send callback for {chat_id} failed: {e}")
+                return result
+
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.error(f"Giving up sending to {chat_id} after {attempt} attempts")
+                self._failed(on_failure, chat_id, False)
+                return None
+            time.sleep(delay)
+
+    def _failed(self, on_failure, chat_id, permanent):
+        if on_failure is not None:
+            try:
+                on_failure(permanent)
+            except Exception as e:
+                logger.error(f"Failure callback for {chat_id} failed: {e}")
+
+    def queue_depth(self):
+        """Number of sends waiting for a worker."""
+        return self.executor._work_queue.qsize()
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """Stop accepting sends and optionally wait for queued ones.
+
+        With ``cancel_pending`` sends that have not started yet are dropped.
+        """
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_pending)
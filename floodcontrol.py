@@ -0,0 +1,129 @@
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from config import (FLOOD_RATE, FLOOD_BURST, FLOOD_CALLBACK_RATE, FLOOD_CALLBACK_BURST,
+                    DUPLICATE_WINDOW, FLOOD_STATE_TTL)
+
+# Check results
+ALLOWED = None
+RATE_LIMITED = 'rate'
+DUPLICATE = 'duplicate'
+
+# Characters ignored when comparing texts for duplicates
+_NOISE = re.compile(r'[\W_]+')
+
+
+def content_hash(text):
+    """Hash of a text that ignores case, whitespace and punctuation.
+
+    None for texts with nothing else (emoji, "?"), which are never treated
+    as repeats of each other.
+    """
+    normalized = _NOISE.sub('', text.casefold())
+    if not normalized:
+        return None
+    return zlib.crc32(normalized.encode('utf-8'))
+
+
+class _UserState:
+    __slots__ = ('tokens', 'callback_tokens', 'updated', 'last_hash', 'last_hash_at', 'warned')
+
+    def __init__(self, tokens, callback_tokens, now):
+        self.tokens = tokens
+        self.callback_tokens = callback_tokens
+        self.updated = now
+        self.last_hash = None
+        self.last_hash_at = 0.0
+        self.warned = False
+
+
+class FloodControl:
+    """Per-user token bucket plus suppression of repeated tickets.
+
+    Users get ``burst`` messages at once and ``rate`` per second after that;
+    button presses are counted in a separate bucket of ``callback_burst``
+    and ``callback_rate``.
+    State is kept in least-recently-seen order and users not seen for
+    ``ttl`` seconds are dropped on later checks, so memory follows the
+    number of recently active users.
+    """
+
+    def __init__(self, rate=FLOOD_RATE, burst=FLOOD_BURST,
+                 callback_rate=FLOOD_CALLBACK_RATE, callback_burst=FLOOD_CALLBACK_BURST,
+                 duplicate_window=DUPLICATE_WINDOW, ttl=FLOOD_STATE_TTL):
+        self.rate = rate
+        self.burst = burst
+        self.callback_rate = callback_rate
+        self.callback_burst = callback_burst
+        self.duplicate_window = duplicate_window
+        self.ttl = ttl
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, user_id, text=None, callback=False):
+        """ALLOWED, RATE_LIMITED or DUPLICATE for a message (or callback) from a user.
+
+        Returns ``(result, notify)``; ``notify`` is True for the first
+        rejection after an allowed message, so a user is warned only once.
+        Callbacks are only rate limited, in their own bucket, and never notify.
+        ``text`` is compared with the last one passed to ``remember``.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            state = self._users.get(user_id)
+            if state is None:
+                state = self._users[user_id] = _UserState(self.burst, self.callback_burst, now)
+            else:
+                self._users.move_to_end(user_id)
+                elapsed = now - state.updated
+                state.tokens = min(self.burst, state.tokens + elapsed * self.rate)
+                state.callback_tokens = min(self.callback_burst,
+                                            state.callback_tokens + elapsed * self.callback_rate)
+                state.updated = now
+
+            if callback:
+                if state.callback_tokens < 1:
+                    return RATE_LIMITED, False
+                state.callback_tokens -= 1
+                return ALLOWED, False
+
+            result = ALLOWED
+            digest = content_hash(text) if text else None
+            if state.tokens < 1:
+                result = RATE_LIMITED
+            elif (digest is not None and digest == state.last_hash
+                  and now - state.last_hash_at < self.duplicate_window):
+                result = DUPLICATE
+            else:
+                state.tokens -= 1
+
+            if result is ALLOWED:
+                state.warned = False
+                return result, False
+            notify = not state.warned
+            state.warned = True
+            return result, notify
+
+    def remember(self, user_id, text):
+        """Record a text that became a ticket; the same text is a DUPLICATE for a while."""
+        digest = content_hash(text)
+        if digest is None:
+            return
+        with self._lock:
+            state = self._users.get(user_id)
+            if state is not None:
+                state.last_hash = digest
+                state.last_hash_at = time.monotonic()
+
+    def _prune(self, now):
+        while self._users:
+            user_id, state = next(iter(self._users.items()))
+            if now - state.updated < self.ttl:
+                break
+            del self._users[user_id]
+
+    def __len__(self):
+        return len(self._users)
@@ -1,34 +1,86 @@
 import logging
 import re
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CallbackContext, ConversationHandler
-from config import CATEGORIES, CATEGORY_INSTRUCTIONS, OWNER_IDS
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.ext import CallbackContext, ConversationHandler, DispatcherHandlerStop
+from config import DIALOGS_PAGE_SIZE, SEARCH_RESULTS, ALBUM_WAIT
+from fanout import FanoutSender
+from async_engine import wait_for_result
+from archive import SEARCH_COUNT_LIMIT
+from digest import DigestBuffer
+from floodcontrol import ALLOWED, RATE_LIMITED
+from media import media_of, caption_text
+from metrics import flood_rejections
+from tenant import Tenant, tenant_of
+from render import (dialogs_page, search_results_text, stats_text, ticket_text, attachment_text, dialog_message_text, admin_reply_text,
+                    BACK_TO_MENU_KEYBOARD, RETURN_TO_MENU_KEYBOARD, DIALOG_KEYBOARD)
+from logsetup import SAMPLED
 # AI module removed - all messages go to admins
 
-# Set up logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 # Conversation states
 WAITING_FOR_MESSAGE = 1
 IN_DIALOG = 2
 
-# Global storage for active dialogs
-# Format: {user_id: {'admin_id': admin_id, 'category': category}}
-active_dialogs = {}
+# Parallel, rate-limited sender shared by all tenants (see tenant.py)
+fanout = FanoutSender()
 
-def start_command(update: Update, context: CallbackContext) -> None:
-    """Handle the /start command and show the main menu."""
-    keyboard = []
+def flood_guard(update: Update, context: CallbackContext) -> None:
+    """Drop updates from users who send too much or repeat themselves.
+
+    Runs in a group before the regular handlers; a rejected update stops
+    there and costs at most one warning per streak of rejections.
+    """
+    tenant = tenant_of(context)
+    user = update.effective_user
+    if not user or user.id in tenant.owner_ids:
+        return
+    message = update.message
+    query = update.callback_query
+    if message is None and query is None:
+        return
+    if message and message.media_group_id in tenant.album_collector:
+        # The rest of an album counts as one message with its first item
+        return
     
-    # Create inline keyboard with category buttons
-    for key, value in CATEGORIES.items():
-        keyboard.append([InlineKeyboardButton(value, callback_data=key)])
+    # Only texts sent as a ticket (after choosing a category) are checked for
+    # repeats; dialog replies such as "да" may well be sent twice
+    text = None
+    if (message and message.text and not message.text.startswith('/')
+            and context.user_data.get('selected_category')
+            and user.id not in tenant.active_dialogs):
+        text = message.text
+    result, notify = tenant.flood_control.check(user.id, text, callback=query is not None)
+    if result is ALLOWED:
+        return
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    flood_rejections.inc((result,))
+    if query:
+        # Stop the button's spinner; pressing again later works
+        query.answer()
+    elif notify:
+        if result == RATE_LIMITED:
+            warning = "⏳ Слишком много сообщений. Пожалуйста, подождите немного и попробуйте снова."
+        else:
+            warning = "♻️ Это сообщение уже отправлено администраторам. Ожидайте ответа."
+        message.reply_text(warning)
+        logger.info(f"Flood control dropping updates from user {user.id}: {result}")
+    raise DispatcherHandlerStop
+
+def archive_message(tenant: Tenant, kind: str, user_id: int, category: str, text: str, admin_id: int = None) -> None:
+    if tenant.ticket_archive is not None:
+        tenant.ticket_archive.append(kind, user_id, category, text, admin_id)
+
+def remember_user(tenant: Tenant, user_id: int) -> None:
+    """Add a user to the recipients of /broadcast."""
+    if tenant.state_store is not None:
+        tenant.state_store.save_user(user_id)
+
+def start_command(update: Update, context: CallbackContext) -> None:
+    """Handle the /start command and show the main menu."""
+    # Category keyboard is prebuilt from the config
+    reply_markup = tenant_of(context).render.main_menu_keyboard
     
     welcome_text = (
         "🤖 Добро пожаловать!\n\n"
@@ -45,38 +97,26 @@ def button_callback(update: Update, context: CallbackContext) -> int:
         query.answer()
         
         category = query.data
+        tenant = tenant_of(context)
+        render = tenant.render
         
-        if category in CATEGORIES:
+        if category in render.categories:
             # Store the selected category in user context
             context.user_data['selected_category'] = category
             
-            # Get instruction for the selected category
-            instruction = CATEGORY_INSTRUCTIONS.get(category, "Напишите ваше сообщение.")
-            
-            # Create back button
-            keyboard = [[InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            response_text = (
-                f"📝 Категория: {CATEGORIES[category]}\n\n"
-                f"{instruction}\n\n"
-                "Отправьте ваше сообщение:"
-            )
-            
-            query.edit_message_text(response_text, reply_markup=reply_markup)
+            # Category instruction screen with a back button
+            query.edit_message_text(render.category_screens[category],
+                                    reply_markup=BACK_TO_MENU_KEYBOARD)
             return WAITING_FOR_MESSAGE
         
         elif category == "back_to_menu":
             # End any active dialog and return to main menu
             user = update.effective_user
-            if user and user.id in active_dialogs:
-                del active_dialogs[user.id]
-            
-            keyboard = []
-            for key, value in CATEGORIES.items():
-                keyboard.append([InlineKeyboardButton(value, callback_data=key)])
+            dialog = tenant.active_dialogs.release(user.id) if user else None
+            if dialog:
+                tenant.support_stats.dialog_closed(dialog)
             
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            reply_markup = render.main_menu_keyboard
             
             welcome_text = (
                 "🤖 Главное меню\n\n"
@@ -89,29 +129,14 @@ def button_callback(update: Update, context: CallbackContext) -> int:
         elif category == "end_dialog":
             # End active dialog
             user = update.effective_user
-            if user and user.id in active_dialogs:
-                admin_id = active_dialogs[user.id]['admin_id']
-                del active_dialogs[user.id]
-                
-                # Notify admin about dialog end
-                try:
-                    context.bot.send_message(
-                        chat_id=admin_id,
-                        text=f"💬 Пользователь {user.first_name} ({user.id}) завершил диалог."
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to notify admin {admin_id} about dialog end: {e}")
-                
-                # Notify other admins that dialog is ended and user is available
-                for other_admin_id in OWNER_IDS:
-                    if other_admin_id != admin_id:
-                        try:
-                            context.bot.send_message(
-                                chat_id=other_admin_id,
-                                text=f"✅ Диалог с пользователем {user.first_name} ({user.id}) завершен. Пользователь снова доступен для новых обращений."
-                            )
-                        except Exception as e:
-                            logger.error(f"Failed to notify admin {other_admin_id} about dialog end: {e}")
+            dialog = tenant.active_dialogs.release(user.id) if user else None
+            if dialog:
+                tenant.support_stats.dialog_closed(dialog)
+                notify_dialog_closed(
+                    tenant, dialog,
+                    f"💬 Пользователь {user.first_name} ({user.id}) завершил диалог.",
+                    f"{user.first_name} ({user.id})"
+                )
                 
                 query.edit_message_text(
                     "✅ Диалог завершен.\n\n"
@@ -123,50 +148,183 @@ def button_callback(update: Update, context: CallbackContext) -> int:
     
     return ConversationHandler.END
 
+def notify_dialog_closed(tenant: Tenant, dialog, admin_text: str, user_label: str) -> None:
+    """Tell the dialog's admin and the other admins that a dialog was closed."""
+    # Notify admin about dialog end
+    tenant.outbox.send("send_message", dialog.admin_id, text=admin_text)
+    
+    # Tell other admins in the next status digest that the user is available
+    tenant.status_digest.add_many(
+        [other_admin_id for other_admin_id in tenant.owner_ids if other_admin_id != dialog.admin_id],
+        f"✅ Диалог с пользователем {user_label} завершен, пользователь снова доступен"
+    )
+
+def expire_dialogs(context: CallbackContext) -> None:
+    """JobQueue callback closing dialogs that timed out."""
+    tenant = tenant_of(context)
+    for dialog in tenant.dialog_expiry.expire_due():
+        tenant.support_stats.dialog_closed(dialog)
+        notify_dialog_closed(
+            tenant, dialog,
+            f"⌛ Диалог с пользователем {dialog.user_id} закрыт из-за неактивности.",
+            str(dialog.user_id)
+        )
+        tenant.outbox.send(
+            "send_message", dialog.user_id,
+            text="⌛ Диалог завершен из-за отсутствия активности.\n\n"
+                 "При необходимости используйте /start для нового обращения."
+        )
+        logger.info(f"Dialog with user {dialog.user_id} expired (admin {dialog.admin_id})")
+
+def flush_digest(tenant: Tenant, digest: DigestBuffer) -> None:
+    """Send everything buffered in a digest, one message per admin."""
+    for chat_id, text in digest.drain():
+        tenant.outbox.send("send_message", chat_id, text=text)
+
+def send_digest(context: CallbackContext) -> None:
+    """JobQueue callback flushing the DigestBuffer in ``context.job.context``."""
+    flush_digest(tenant_of(context), context.job.context)
+
+def save_stats(context: CallbackContext) -> None:
+    """JobQueue callback saving the /stats counters."""
+    tenant_of(context).support_stats.save()
+
+def retry_outbox(context: CallbackContext) -> None:
+    """JobQueue callback re-sending outbox messages whose retries ran out."""
+    resent = tenant_of(context).outbox.retry_pending()
+    if resent:
+        logger.info(f"Re-sending {resent} messages from the outbox")
+
+def message_text(message) -> str:
+    """Text of a message, or a label of its attachment followed by the caption."""
+    media = media_of(message)
+    if media is None:
+        return message.text
+    return attachment_text([media[0]], message.caption)
+
+def relay_media(tenant: Tenant, chat_ids, key: str, caption: str, media, reply_args=None) -> None:
+    """Queue an attachment copied by reference, or album items by file_id, for chats.
+
+    ``media`` is ``(from_chat_id, message_id)`` for one attachment or a list
+    of album items; ``caption`` goes with it. With ``reply_args`` replies
+    to the relayed messages are mapped back to the user.
+    """
+    caption = caption_text(caption)
+    for chat_id in chat_ids:
+        if isinstance(media, list):
+            items = [dict(item) for item in media]
+            items[0]['caption'] = caption
+            tenant.outbox.send("send_album", chat_id, key=f"{key}:{chat_id}",
+                               callback="remember_album" if reply_args else None,
+                               callback_args=reply_args or (), media=items)
+        else:
+            tenant.outbox.send("copy_message", chat_id, key=f"{key}:{chat_id}",
+                               callback="remember_copy" if reply_args else None,
+                               callback_args=(chat_id,) + tuple(reply_args) if reply_args else (),
+                               from_chat_id=media[0], message_id=media[1], caption=caption)
+
+def collect_album_item(tenant: Tenant, message) -> bool:
+    """Add a message to an album that is being collected; True if it belonged to one."""
+    return bool(message.media_group_id) and tenant.album_collector.add(message) is not None
+
+def open_album(message, context: CallbackContext, target: tuple) -> bool:
+    """Start collecting an album; flush_album relays it once the rest arrived."""
+    tenant = tenant_of(context)
+    if not message.media_group_id or tenant.album_collector.add(message, target) != 'opened':
+        return False
+    context.job_queue.run_once(flush_album, ALBUM_WAIT, context=message.media_group_id)
+    return True
+
+def flush_album(context: CallbackContext) -> None:
+    """JobQueue callback relaying a collected album as one batch."""
+    tenant = tenant_of(context)
+    album = tenant.album_collector.pop(context.job.context)
+    if album is None:
+        return
+    (kind, *args), items, caption = album
+    text = attachment_text([item['type'] for item in items], caption)
+    try:
+        if kind == 'ticket':
+            user, message_id, category = args
+            submit_ticket(tenant, user, message_id, category, text, items)
+        elif kind == 'dialog':
+            user, message_id = args
+            dialog = tenant.active_dialogs.get(user.id)
+            if dialog:
+                submit_dialog_message(tenant, user, dialog, message_id, text, items)
+        else:
+            user_id, admin_id, message_id, category = args
+            relay_media(tenant, [user_id], f"reply:{admin_id}:{message_id}",
+                        admin_reply_text(text), items)
+            archive_message(tenant, 'reply', user_id, category, text, admin_id=admin_id)
+    except Exception as e:
+        logger.error(f"Failed to relay album {context.job.context}: {e}")
+
+def submit_ticket(tenant: Tenant, user, telegram_message_id: int, category: str, text: str, media=None) -> None:
+    """Send a ticket to its admin (or all admins) and record it.
+
+    ``media`` is None for a text ticket, otherwise it is relayed with the
+    ticket text as caption (see relay_media).
+    """
+    category_name = tenant.render.category_name(category)
+    
+    # Create message to forward to owners with unique ID for replies
+    message_id = f"msg_{user.id}_{telegram_message_id}"
+    forward_message = ticket_text(user, message_id, category_name, text)
+    
+    # The key makes a redelivered update produce no second ticket
+    ticket_key = f"ticket:{user.id}:{telegram_message_id}"
+    reply_args = (user.id, message_id, category)
+    
+    admin_id = tenant.ticket_assigner.choose(user.id, category)
+    admin_ids = tenant.owner_ids if admin_id is None else [admin_id]
+    if media is not None:
+        # Attachments are passed by reference; no file goes through the bot
+        relay_media(tenant, admin_ids, ticket_key, forward_message, media, reply_args)
+    elif admin_id is None:
+        # Forward message to all owners in parallel; the user does not wait for delivery
+        tenant.outbox.broadcast("send_message", tenant.owner_ids, key=ticket_key,
+                                callback="remember_reply", callback_args=reply_args,
+                                text=forward_message)
+    else:
+        tenant.outbox.send("send_message", admin_id, key=ticket_key,
+                           callback="remember_reply", callback_args=reply_args,
+                           text=forward_message)
+    if admin_id is not None:
+        # Only the assigned admin gets the ticket; the others see it in the digest
+        tenant.ticket_digest.add_many(
+            [other_admin_id for other_admin_id in tenant.owner_ids if other_admin_id != admin_id],
+            f"• {message_id} от {user.first_name} ({user.id}), {category_name} → {admin_id}"
+        )
+    
+    if media is None:
+        # Only a queued ticket makes the same text a repeat (see flood_guard)
+        tenant.flood_control.remember(user.id, text)
+    archive_message(tenant, 'ticket', user.id, category, text)
+    tenant.support_stats.ticket(category)
+    remember_user(tenant, user.id)
+    logger.info("Message from user %s (%s) queued for owners", user.id, user.username,
+                extra=SAMPLED)
+
 def handle_user_message(update: Update, context: CallbackContext) -> int:
-    """Handle user messages and forward them to owners."""
+    """Handle user messages and attachments and forward them to owners."""
     user = update.effective_user
-    if not user or not update.message or not update.message.text:
+    message = update.message
+    if not user or not message or not (message.text or media_of(message)):
         return ConversationHandler.END
-        
-    message_text = update.message.text
-    user_name = f"{user.first_name}{' ' + user.last_name if user.last_name else ''}"
     
     # In private chats (conversation flow), all messages go to admins
     # AI only works in groups, not in private conversation flow
     selected_category = 'other'
     if context.user_data:
         selected_category = context.user_data.get('selected_category', 'other')
-    category_name = CATEGORIES.get(selected_category, 'Прочее')
-    
-    # Create message to forward to owners with unique ID for replies
-    message_id = f"msg_{user.id}_{update.message.message_id}"
-    forward_message = (
-        f"📨 Новое обращение #{message_id}\n\n"
-        f"👤 От: {user.first_name}"
-        f"{' ' + user.last_name if user.last_name else ''}\n"
-        f"🆔 ID: {user.id}\n"
-        f"👤 Username: @{user.username if user.username else 'не указан'}\n"
-        f"📂 Категория: {category_name}\n\n"
-        f"💬 Сообщение:\n{message_text}\n\n"
-        f"📋 Для ответа пользователю ответьте на это сообщение"
-    )
     
     try:
-        # Forward message to all owners
-        for owner_id in OWNER_IDS:
-            try:
-                sent_message = context.bot.send_message(
-                    chat_id=owner_id,
-                    text=forward_message
-                )
-                # Store mapping for replies
-                context.bot_data[f"reply_{sent_message.message_id}"] = {
-                    'user_id': user.id,
-                    'original_message_id': message_id
-                }
-            except Exception as e:
-                logger.error(f"Failed to send message to owner {owner_id}: {e}")
+        # The rest of an album arrives as separate updates; flush_album sends it as one ticket
+        if not open_album(message, context, ('ticket', user, message.message_id, selected_category)):
+            media = media_of(message) and (message.chat_id, message.message_id)
+            submit_ticket(tenant_of(context), user, message.message_id, selected_category,
+                          message_text(message), media)
         
         # Send confirmation to user
         confirmation_text = (
@@ -175,9 +333,7 @@ def handle_user_message(update: Update, context: CallbackContext) -> int:
             "Ожидайте ответа!"
         )
         
-        update.message.reply_text(confirmation_text)
-        
-        logger.info(f"Message from user {user.id} ({user.username}) forwarded to owners")
+        message.reply_text(confirmation_text)
         
     except Exception as e:
         logger.error(f"Failed to forward message to owners: {e}")
@@ -187,11 +343,7 @@ def handle_user_message(update: Update, context: CallbackContext) -> int:
             "Пожалуйста, попробуйте позже."
         )
         
-        keyboard = [[InlineKeyboardButton("🔙 Вернуться в меню", callback_data="back_to_menu")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        if update.message:
-            update.message.reply_text(error_text, reply_markup=reply_markup)
+        message.reply_text(error_text, reply_markup=RETURN_TO_MENU_KEYBOARD)
     
     # Clear the selected category
     context.user_data.clear()
@@ -206,22 +358,41 @@ def cancel_conversation(update: Update, context: CallbackContext) -> int:
 
 def help_command(update: Update, context: CallbackContext) -> None:
     """Handle the /help command."""
+    tenant = tenant_of(context)
     user = update.effective_user
     
-    if user and user.id in OWNER_IDS:
+    if user and user.id in tenant.owner_ids:
+        if tenant.ticket_assigner.broadcast:
+            dialog_steps = (
+                "1. Пользователь отправляет обращение\n"
+                "2. Отвечайте на сообщение (reply) для начала диалога\n"
+                "3. Только первый ответивший админ ведет диалог\n"
+                "4. Остальные админы получают уведомления\n"
+                "5. Пользователь может закончить диалог кнопкой"
+            )
+        else:
+            dialog_steps = (
+                "1. Пользователь отправляет обращение\n"
+                "2. Обращение получает один админ, остальные видят его в сводке\n"
+                "3. Отвечайте на сообщение (reply) для начала диалога\n"
+                "4. Остальные админы получают уведомления\n"
+                "5. Пользователь может закончить диалог кнопкой"
+            )
         # Admin help
         help_text = (
             "🤖 Помощь для администраторов\n\n"
             "Команды:\n"
             "/start - Показать главное меню\n"
             "/help - Показать эту справку\n"
-            "/dialogs - Показать активные диалоги\n\n"
+            "/dialogs - Показать активные диалоги\n"
+            "/transfer <пользователь> <админ> - Передать диалог коллеге\n"
+            "/search <слова> [user:<id>] [cat:<категория>] - Поиск по архиву обращений\n"
+            "/stats - Статистика обращений и ответов\n"
+            "/broadcast <текст> - Разослать объявление всем пользователям\n"
+            "/broadcast_stop - Остановить рассылку\n"
+            "/reload - Перечитать категории и инструкции из файла меню\n\n"
             "Как работать с диалогами:\n"
-            "1. Пользователь отправляет обращение\n"
-            "2. Отвечайте на сообщение (reply) для начала диалога\n"
-            "3. Только первый ответивший админ ведет диалог\n"
-            "4. Остальные админы получают уведомления\n"
-            "5. Пользователь может закончить диалог кнопкой"
+            f"{dialog_steps}"
         )
     else:
         # User help
@@ -232,189 +403,322 @@ def help_command(update: Update, context: CallbackContext) -> None:
             "/help - Показать эту справку\n\n"
             "Как использовать:\n"
             "1. Выберите категорию обращения\n"
-            "2. Напишите ваше сообщение\n"
+            "2. Напишите ваше сообщение (можно приложить фото, видео, документ или голосовое)\n"
             "3. Сообщение будет отправлено администраторам\n\n"
             "Доступные категории:\n"
-            "• Вступление во флуд\n"
-            "• Интересующие вопросы\n"
-            "• Критика\n"
-            "• Предложения\n"
-            "• Союзы\n"
-            "• Рест\n"
-            "• Жалобы\n"
-            "• Прочее"
+            f"{tenant.render.user_help_categories}"
         )
     
     if update.message:
         update.message.reply_text(help_text)
 
+def build_dialogs_page(tenant: Tenant, user_id: int, page: int, mine: bool):
+    """Text and keyboard of a /dialogs page; the page number is clamped to the last page."""
+    total = tenant.active_dialogs.count_of(user_id) if mine else len(tenant.active_dialogs)
+    pages = max(1, -(-total // DIALOGS_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    dialogs, total = tenant.active_dialogs.page(page * DIALOGS_PAGE_SIZE, DIALOGS_PAGE_SIZE,
+                                                user_id if mine else None)
+    return dialogs_page(dialogs, user_id, page, pages, total, mine, tenant.render)
+
 def dialogs_command(update: Update, context: CallbackContext) -> None:
     """Show active dialogs to admin."""
+    tenant = tenant_of(context)
     user = update.effective_user
-    if not user or user.id not in OWNER_IDS:
+    if not user or user.id not in tenant.owner_ids:
         return
     
-    if not active_dialogs:
+    if not len(tenant.active_dialogs):
         update.message.reply_text("📭 Активных диалогов нет.")
         return
     
-    dialog_list = "💬 Активные диалоги:\n\n"
-    for user_id, dialog_info in active_dialogs.items():
-        admin_id = dialog_info['admin_id']
-        category = dialog_info.get('category', 'other')
-        category_name = CATEGORIES.get(category, 'Прочее')
-        
-        dialog_list += (
-            f"👤 Пользователь: {user_id}\n"
-            f"👨‍💼 Администратор: {admin_id}\n"
-            f"📂 Категория: {category_name}\n"
-            f"{'🟢 Ваш диалог' if admin_id == user.id else '🔴 Диалог коллеги'}\n\n"
-        )
+    text, keyboard = build_dialogs_page(tenant, user.id, 0, False)
+    update.message.reply_text(text, reply_markup=keyboard)
+
+def dialogs_page_callback(update: Update, context: CallbackContext) -> None:
+    """Switch the /dialogs dashboard page in place (callback data dlg:<page>:<mine>)."""
+    tenant = tenant_of(context)
+    query = update.callback_query
+    user = update.effective_user
+    if not user or user.id not in tenant.owner_ids:
+        query.answer()
+        return
+    
+    _, page, mine = query.data.split(":")
+    text, keyboard = build_dialogs_page(tenant, user.id, int(page), mine == "1")
+    query.answer()
+    try:
+        query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest as e:
+        # Pressing the page counter when nothing changed
+        if "not modified" not in str(e):
+            raise
+
+def transfer_command(update: Update, context: CallbackContext) -> None:
+    """Hand one of your dialogs over to another admin: /transfer <user_id> <admin_id>."""
+    tenant = tenant_of(context)
+    user = update.effective_user
+    if not user or user.id not in tenant.owner_ids or not update.message:
+        return
+    
+    try:
+        user_id, new_admin_id = (int(arg) for arg in context.args)
+    except ValueError:
+        update.message.reply_text("Использование: /transfer <ID пользователя> <ID администратора>")
+        return
+    
+    if new_admin_id not in tenant.owner_ids:
+        update.message.reply_text("❌ Этот пользователь не является администратором.")
+        return
+    
+    if not tenant.active_dialogs.transfer(user_id, user.id, new_admin_id):
+        update.message.reply_text("❌ У вас нет активного диалога с этим пользователем.")
+        return
+    
+    tenant.outbox.send(
+        "send_message", new_admin_id,
+        text=f"🔄 Администратор {user.first_name} ({user.id}) передал вам диалог с пользователем {user_id}."
+    )
+    update.message.reply_text(f"✅ Диалог с пользователем {user_id} передан администратору {new_admin_id}.")
+    logger.info(f"Owner {user.id} transferred dialog with user {user_id} to {new_admin_id}")
+
+def search_command(update: Update, context: CallbackContext) -> None:
+    """Search the ticket archive: /search <terms> [user:<id>] [cat:<category>]."""
+    tenant = tenant_of(context)
+    user = update.effective_user
+    if not user or user.id not in tenant.owner_ids or not update.message:
+        return
+    
+    if not context.args:
+        update.message.reply_text(
+            "Использование: /search <слова> [user:<id>] [cat:<категория>]")
+        return
+    if tenant.ticket_archive is None:
+        update.message.reply_text("❌ Архив обращений недоступен.")
+        return
+    
+    records, total = tenant.ticket_archive.search(context.args, SEARCH_RESULTS)
+    if not records:
+        update.message.reply_text("🔎 Ничего не найдено.")
+        return
+    
+    update.message.reply_text(search_results_text(records, total, SEARCH_COUNT_LIMIT, tenant.render))
+
+def stats_command(update: Update, context: CallbackContext) -> None:
+    """Show ticket, dialog and response time statistics to admins."""
+    tenant = tenant_of(context)
+    user = update.effective_user
+    if not user or user.id not in tenant.owner_ids or not update.message:
+        return
+    
+    update.message.reply_text(stats_text(tenant.support_stats.summary(), tenant.render))
+
+def broadcast_command(update: Update, context: CallbackContext) -> None:
+    """Send an announcement to every user who ever wrote to the bot: /broadcast <text>."""
+    tenant = tenant_of(context)
+    user = update.effective_user
+    if not user or user.id not in tenant.owner_ids or not update.message:
+        return
+    
+    parts = update.message.text.split(None, 1)
+    if len(parts) < 2:
+        update.message.reply_text("Использование: /broadcast <текст объявления>")
+        return
+    
+    if not tenant.broadcaster.start(parts[1], user.id):
+        update.message.reply_text("⚠️ Рассылка уже идёт. Остановить её: /broadcast_stop")
+
+def broadcast_stop_command(update: Update, context: CallbackContext) -> None:
+    """Cancel the running broadcast."""
+    tenant = tenant_of(context)
+    user = update.effective_user
+    if not user or user.id not in tenant.owner_ids or not update.message:
+        return
     
-    update.message.reply_text(dialog_list)
+    if tenant.broadcaster.cancel():
+        update.message.reply_text("⏹ Рассылка будет остановлена.")
+        logger.info(f"Owner {user.id} cancelled the broadcast")
+    else:
+        update.message.reply_text("📭 Сейчас рассылки нет.")
+
+def reload_command(update: Update, context: CallbackContext) -> None:
+    """Apply changes of the menu file without a restart."""
+    tenant = tenant_of(context)
+    user = update.effective_user
+    if not user or user.id not in tenant.owner_ids or not update.message:
+        return
+    
+    try:
+        render = tenant.reload_menu()
+    except (OSError, ValueError) as e:
+        logger.error(f"Owner {user.id} failed to reload the menu: {e}")
+        update.message.reply_text(f"❌ Меню не обновлено, действует прежнее.\n\n{e}")
+        return
+    
+    update.message.reply_text(f"✅ Меню обновлено: категорий — {len(render.categories)}.")
+    logger.info(f"Owner {user.id} reloaded the menu from {tenant.menu_file}")
+
+def check_menu(context: CallbackContext) -> None:
+    """Reload the menus when the menu file changed."""
+    tenant = tenant_of(context)
+    if not tenant.menu_changed():
+        return
+    try:
+        render = tenant.reload_menu()
+    except (OSError, ValueError) as e:
+        logger.error(f"Menu file {tenant.menu_file} not reloaded: {e}")
+        return
+    logger.info(f"Reloaded {len(render.categories)} menu categories from {tenant.menu_file}")
 
 def handle_owner_reply(update: Update, context: CallbackContext) -> None:
-    """Handle replies from owners to user messages."""
+    """Handle replies (text or attachments) from owners to user messages."""
+    tenant = tenant_of(context)
     user = update.effective_user
-    if not user or user.id not in OWNER_IDS:
+    if not user or user.id not in tenant.owner_ids:
         return
     
     if not update.message or not update.message.reply_to_message:
         return
+    if collect_album_item(tenant, update.message):
+        return
     
     reply_to_message_id = update.message.reply_to_message.message_id
-    reply_data = context.bot_data.get(f"reply_{reply_to_message_id}")
+    reply_data = tenant.reply_index.get(update.message.chat_id, reply_to_message_id)
     
     if not reply_data:
         update.message.reply_text("❌ Не удалось найти исходное сообщение пользователя.")
         return
     
-    user_id = reply_data['user_id']
-    message_id = reply_data['original_message_id']
-    reply_text = update.message.text
+    user_id = reply_data.user_id
+    message_id = reply_data.original_message_id
+    reply_text = message_text(update.message)
+    if not reply_text:
+        return
     
-    # Check if user already has active dialog with another admin
-    if user_id in active_dialogs and active_dialogs[user_id]['admin_id'] != user.id:
-        existing_admin_id = active_dialogs[user_id]['admin_id']
+    # Start or continue the dialog; only the first admin to reply owns it
+    dialog, started = tenant.active_dialogs.claim(user_id, user.id, reply_data.category)
+    if started:
+        tenant.dialog_expiry.watch(dialog)
+    if dialog.admin_id != user.id:
         update.message.reply_text(
-            f"⚠️ Пользователь уже ведет диалог с администратором {existing_admin_id}.\n"
+            f"⚠️ Пользователь уже ведет диалог с администратором {dialog.admin_id}.\n"
             f"Дождитесь завершения диалога или свяжитесь с коллегой."
         )
         return
     
     try:
-        # Start or continue dialog session
-        active_dialogs[user_id] = {
-            'admin_id': user.id,
-            'category': reply_data.get('category', 'other')
-        }
-        
-        # Send reply to user with dialog controls
-        response_message = (
-            f"📬 Ответ от администратора:\n\n"
-            f"{reply_text}\n\n"
-            f"💬 Диалог начат! Можете продолжить общение."
-        )
-        
-        # Create dialog control buttons
-        keyboard = [
-            [InlineKeyboardButton("✅ Завершить диалог", callback_data="end_dialog")],
-            [InlineKeyboardButton("🔙 Вернуться в меню", callback_data="back_to_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        context.bot.send_message(
-            chat_id=user_id,
-            text=response_message,
-            reply_markup=reply_markup
-        )
-        
-        # Notify other admins about started dialog
-        for admin_id in OWNER_IDS:
-            if admin_id != user.id:
-                try:
+        # An album is sent and archived by flush_album once all of it arrived
+        album_target = ('reply', user_id, user.id, update.message.message_id, dialog.category)
+        if not open_album(update.message, context, album_target):
+            # Send reply to user with dialog controls; wait for it so failures reach the admin
+            with wait_for_result():
+                if media_of(update.message):
+                    # The attachment is copied by reference, with the reply as caption
+                    context.bot.copy_message(
+                        chat_id=user_id,
+                        from_chat_id=update.message.chat_id,
+                        message_id=update.message.message_id,
+                        caption=caption_text(admin_reply_text(reply_text)),
+                        reply_markup=DIALOG_KEYBOARD
+                    )
+                else:
                     context.bot.send_message(
-                        chat_id=admin_id,
-                        text=f"💬 Администратор {user.first_name} ({user.id}) начал диалог с пользователем {user_id}."
+                        chat_id=user_id,
+                        text=admin_reply_text(reply_text),
+                        reply_markup=DIALOG_KEYBOARD
                     )
-                except Exception as e:
-                    logger.error(f"Failed to notify admin {admin_id} about dialog start: {e}")
+            archive_message(tenant, 'reply', user_id, dialog.category, reply_text, admin_id=user.id)
         
-        # Confirm to owner
-        update.message.reply_text("✅ Ответ отправлен пользователю! Диалог начат. Другие админы уведомлены.")
+        # First response time: from the forwarded ticket to the reply opening the dialog
+        first_response = None
+        if started and message_id.startswith("msg_"):
+            first_response = (update.message.date
+                              - update.message.reply_to_message.date).total_seconds()
+        tenant.support_stats.reply(user.id, dialog.category, started, first_response)
         
-        logger.info(f"Owner {user.id} started dialog with user {user_id} for message {message_id}")
+        if started:
+            # Tell other admins about the started dialog in the next status digest
+            tenant.status_digest.add_many(
+                [admin_id for admin_id in tenant.owner_ids if admin_id != user.id],
+                f"💬 Администратор {user.first_name} ({user.id}) начал диалог с пользователем {user_id}"
+            )
+            
+            # Confirm to owner
+            update.message.reply_text("✅ Ответ отправлен пользователю! Диалог начат. Другие админы уведомлены.")
+            
+            logger.info("Owner %s started dialog with user %s for message %s",
+                        user.id, user_id, message_id, extra=SAMPLED)
+        else:
+            update.message.reply_text("✅ Ответ отправлен пользователю!")
         
     except Exception as e:
         logger.error(f"Failed to send reply to user {user_id}: {e}")
+        if started:
+            # Don't keep the user locked to an admin whose first reply never arrived
+            tenant.active_dialogs.release(user_id, user.id)
         update.message.reply_text("❌ Ошибка при отправке ответа пользователю.")
 
+def submit_dialog_message(tenant: Tenant, user, dialog, telegram_message_id: int, text: str, media=None) -> None:
+    """Forward a user's message in a dialog to its admin and record it."""
+    forward_message = dialog_message_text(user, text)
+    key = f"dialog:{user.id}:{telegram_message_id}"
+    # Admin replies are mapped back to the user once the message is delivered
+    reply_args = (user.id, f"dialog_{user.id}_{telegram_message_id}", dialog.category)
+    if media is not None:
+        relay_media(tenant, [dialog.admin_id], key, forward_message, media, reply_args)
+    else:
+        tenant.outbox.send("send_message", dialog.admin_id, key=key,
+                           callback="remember_reply", callback_args=reply_args,
+                           text=forward_message)
+    
+    archive_message(tenant, 'dialog', user.id, dialog.category, text)
+    remember_user(tenant, user.id)
+    logger.info("Dialog message from user %s forwarded to admin %s",
+                user.id, dialog.admin_id, extra=SAMPLED)
+
 def handle_dialog_message(update: Update, context: CallbackContext) -> None:
-    """Handle messages in active dialog."""
+    """Handle messages and attachments in active dialog."""
+    tenant = tenant_of(context)
     user = update.effective_user
-    if not user or not update.message or not update.message.text:
+    message = update.message
+    if not user or not message or not (message.text or media_of(message)):
         return
     
     # Check if user is in active dialog
-    if user.id not in active_dialogs:
+    dialog = tenant.active_dialogs.touch(user.id)
+    if not dialog:
         return
     
-    dialog_info = active_dialogs[user.id]
-    admin_id = dialog_info['admin_id']
-    message_text = update.message.text
-    
     try:
-        # Forward message to admin
-        forward_message = (
-            f"💬 Продолжение диалога\n\n"
-            f"👤 От: {user.first_name}"
-            f"{' ' + user.last_name if user.last_name else ''}\n"
-            f"🆔 ID: {user.id}\n"
-            f"👤 Username: @{user.username if user.username else 'не указан'}\n\n"
-            f"💬 Сообщение:\n{message_text}\n\n"
-            f"📋 Ответьте на это сообщение для продолжения диалога"
-        )
-        
-        sent_message = context.bot.send_message(
-            chat_id=admin_id,
-            text=forward_message
-        )
-        
-        # Store mapping for admin replies
-        context.bot_data[f"reply_{sent_message.message_id}"] = {
-            'user_id': user.id,
-            'original_message_id': f"dialog_{user.id}_{update.message.message_id}",
-            'category': dialog_info['category']
-        }
+        if not open_album(message, context, ('dialog', user, message.message_id)):
+            media = media_of(message) and (message.chat_id, message.message_id)
+            submit_dialog_message(tenant, user, dialog, message.message_id, message_text(message), media)
         
         # Confirm to user
         confirmation_text = "✅ Сообщение отправлено администратору!"
         
         # Add dialog control buttons
-        keyboard = [
-            [InlineKeyboardButton("✅ Завершить диалог", callback_data="end_dialog")],
-            [InlineKeyboardButton("🔙 Вернуться в меню", callback_data="back_to_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        update.message.reply_text(confirmation_text, reply_markup=reply_markup)
-        
-        logger.info(f"Dialog message from user {user.id} forwarded to admin {admin_id}")
+        message.reply_text(confirmation_text, reply_markup=DIALOG_KEYBOARD)
         
     except Exception as e:
         logger.error(f"Failed to forward dialog message: {e}")
-        update.message.reply_text("❌ Ошибка при отправке сообщения администратору.")
+        message.reply_text("❌ Ошибка при отправке сообщения администратору.")
 
 def handle_direct_message(update: Update, context: CallbackContext) -> None:
     """Handle direct messages outside of conversation."""
+    tenant = tenant_of(context)
     user = update.effective_user
-    if not user or not update.message or not update.message.text:
+    if not user or not update.message:
+        return
+    if collect_album_item(tenant, update.message):
+        return
+    if not (update.message.text or media_of(update.message)):
         return
     
     chat = update.effective_chat
     
     # Check if user is in active dialog
-    if user.id in active_dialogs:
+    if user.id in tenant.active_dialogs:
         handle_dialog_message(update, context)
         return
     
@@ -1,12 +1,22 @@
-from flask import Flask
+from flask import Flask, Response, request
 from threading import Thread
 import logging
+from telegram import Update
+from config import WEBHOOK_PATH
+from metrics import registry
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
 app = Flask('')
 
+# Dispatchers fed by the webhook routes in webhook mode, with their secrets, by
+# tenant name: '' is served at WEBHOOK_PATH, other tenants at WEBHOOK_PATH/<name>
+webhooks = {}
+
+# Web server thread (the server is started only once per process)
+server_thread = None
+
 @app.route('/')
 def home():
     """Simple health check endpoint."""
@@ -26,6 +36,42 @@ def health():
     """Health check for monitoring services."""
     return "OK"
 
+@app.route('/metrics')
+def metrics():
+    """Bot metrics in the Prometheus text exposition format."""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route(WEBHOOK_PATH, methods=['POST'], defaults={'name': ''})
+@app.route(WEBHOOK_PATH + '/<name>', methods=['POST'])
+def webhook(name):
+    """Receive updates pushed by Telegram and queue them for the tenant's dispatcher."""
+    hook = webhooks.get(name)
+    if hook is None:
+        return "Webhook is not active", 503
+    
+    webhook_dispatcher, webhook_secret = hook
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != webhook_secret:
+        return "Forbidden", 403
+    
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return "Bad Request", 400
+    
+    webhook_dispatcher.update_queue.put(Update.de_json(data, webhook_dispatcher.bot))
+    return "OK"
+
+def webhook_path(name=''):
+    """Route of a tenant's webhook."""
+    return f"{WEBHOOK_PATH}/{name}" if name else WEBHOOK_PATH
+
+def attach_webhook(dispatcher, secret, name=''):
+    """Start feeding a tenant's webhook updates into the dispatcher's update queue."""
+    webhooks[name] = (dispatcher, secret)
+
+def detach_webhook(name=''):
+    """Stop accepting a tenant's webhook updates."""
+    webhooks.pop(name, None)
+
 def run():
     """Run the Flask web server."""
     try:
@@ -35,8 +81,11 @@ def run():
 
 def keep_alive():
     """Start the keep-alive web server in a separate thread."""
+    global server_thread
+    if server_thread is not None:
+        return
     logger.info("Starting keep-alive web server...")
-    t = Thread(target=run)
-    t.daemon = True  # Dies when main thread dies
-    t.start()
-    logger.info("Keep-alive web server started on port 5000")
\ No newline at end of file
+    server_thread = Thread(target=run)
+    server_thread.daemon = True  # Dies when main thread dies
+    server_thread.start()
+    logger.info("Keep-alive web server started on port 8080")
\ No newline at end of file
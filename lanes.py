@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Update
+from telegram.ext import Dispatcher
+from config import LANE_FAST_WORKERS, LANE_BULK_WORKERS
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+FAST = 'fast'
+BULK = 'bulk'
+
+# Commands answered from memory, served in the fast lane with button presses
+FAST_COMMANDS = ('start', 'help', 'cancel', 'dialogs')
+
+lane_wait = registry.histogram(
+    'bot_lane_wait_seconds', 'Time updates waited for a lane worker.', ['lane'])
+
+
+def lane_of(update):
+    """FAST for button presses and menu commands, BULK for everything else."""
+    if update.callback_query:
+        return FAST
+    message = update.message
+    if message and message.text and message.text.startswith('/'):
+        command = message.text[1:].split(None, 1)[0].split('@', 1)[0]
+        if command in FAST_COMMANDS:
+            return FAST
+    return BULK
+
+
+class Lanes:
+    """Runs updates on two worker pools so button presses never queue behind tickets.
+
+    The fast lane takes callback queries and menu commands, which only
+    answer and edit; the bulk lane takes messages, whose handlers forward
+    to several admins, write archives and wait for sends. Updates of one
+    user still run one at a time and in order: an update arriving while
+    the user's previous one runs waits for it, then goes to its own lane.
+    """
+
+    def __init__(self, fast_workers=LANE_FAST_WORKERS, bulk_workers=LANE_BULK_WORKERS):
+        self.executors = {
+            FAST: ThreadPoolExecutor(max_workers=fast_workers, thread_name_prefix="LaneFast"),
+            BULK: ThreadPoolExecutor(max_workers=bulk_workers, thread_name_prefix="LaneBulk"),
+        }
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        # (dispatcher, user_id) -> updates waiting for the user's running one
+        self._chains = {}
+        # dispatcher -> updates submitted and not finished yet
+        self._in_flight = {}
+
+    def submit(self, dispatcher, update):
+        """Queue an update for its lane, behind the same user's running update."""
+        lane = lane_of(update)
+        user = update.effective_user
+        key = (dispatcher, user.id) if user else None
+        with self._lock:
+            self._in_flight[dispatcher] = self._in_flight.get(dispatcher, 0) + 1
+            if key is not None:
+                chain = self._chains.get(key)
+                if chain is not None:
+                    chain.append((lane, update))
+                    return
+                self._chains[key] = deque()
+        self._start(lane, dispatcher, update, key)
+
+    def _start(self, lane, dispatcher, update, key):
+        self.executors[lane].submit(self._run, lane, dispatcher, update, key,
+                                    time.perf_counter())
+
+    def _run(self, lane, dispatcher, update, key, queued_at):
+        lane_wait.observe(time.perf_counter() - queued_at, (lane,))
+        try:
+            dispatcher.handle(update)
+        except Exception as e:
+            logger.error(f"Update {update.update_id} failed in the {lane} lane: {e}")
+        finally:
+            following = None
+            with self._lock:
+                if key is not None:
+                    chain = self._chains[key]
+                    if chain:
+                        following = chain.popleft()
+                    else:
+                        del self._chains[key]
+                self._in_flight[dispatcher] -= 1
+                self._idle.notify_all()
+            if following is not None:
+                self._start(following[0], dispatcher, following[1], key)
+
+    def wait_idle(self, dispatcher):
+        """Block until every update submitted for the dispatcher is handled."""
+        with self._idle:
+            while self._in_flight.get(dispatcher):
+                self._idle.wait()
+
+    def queue_depth(self, lane):
+        """Number of updates waiting for a worker of the lane."""
+        return self.executors[lane]._work_queue.qsize()
+
+    def shutdown(self, wait=True):
+        for executor in self.executors.values():
+            executor.shutdown(wait=wait)
+
+
+class LaneDispatcher(Dispatcher):
+    """Dispatcher whose thread only hands updates to the lanes.
+
+    Updates are recorded (see capture.py) here, in arrival order and before
+    any lane wait. Anything else put on the update queue (the poller's
+    batch markers, errors) is processed on the dispatcher thread once all
+    updates before it were handled, so it still sees the batch as done.
+    """
+
+    def __init__(self, *args, lanes, recorder=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lanes = lanes
+        self.recorder = recorder
+
+    def process_update(self, update):
+        if isinstance(update, Update):
+            if self.recorder is not None:
+                self.recorder.record(update)
+            self.lanes.submit(self, update)
+            return
+        self.lanes.wait_idle(self)
+        super().process_update(update)
+
+    def handle(self, update):
+        """Run the handlers for an update; called on a lane worker."""
+        super().process_update(update)
+
+    def stop(self):
+        super().stop()
+        self.lanes.wait_idle(self)
@@ -0,0 +1,119 @@
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from contextvars import ContextVar
+from config import LOG_LEVEL, LOG_FORMAT, LOG_FILE, LOG_SAMPLE_EVERY
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Pass as ``extra=SAMPLED`` on high-volume info lines; only one in
+# LOG_SAMPLE_EVERY of them (per message template) is written
+SAMPLED = {'sampled': True}
+
+# Loggers that report every routine step at INFO
+NOISY_LOGGERS = ('apscheduler', 'werkzeug')
+
+# Attributes of the update being handled, set by metrics.instrument
+log_context = ContextVar('log_context', default=None)
+
+# Fields copied from records to JSON output when present
+CONTEXT_FIELDS = ('update_id', 'user_id', 'handler', 'duration_ms', 'sample_weight')
+
+_listener = None
+
+
+class ContextFilter(logging.Filter):
+    """Attach the current update's context and drop sampled-out records.
+
+    Runs on the logging thread, so it only sets attributes and counts;
+    formatting happens later on the listener thread.
+    """
+
+    def __init__(self, sample_every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.sample_every = max(1, sample_every)
+        self._counters = {}
+
+    def filter(self, record):
+        if getattr(record, 'sampled', False) and self.sample_every > 1:
+            counter = self._counters.get(record.msg)
+            if counter is None:
+                counter = self._counters.setdefault(record.msg, itertools.count())
+            if next(counter) % self.sample_every:
+                return False
+            record.sample_weight = self.sample_every
+        context = log_context.get()
+        if context:
+            for name, value in context.items():
+                if not hasattr(record, name):
+                    setattr(record, name, value)
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting to the listener thread.
+
+    The stock handler merges the message and its arguments before
+    queueing; here the record is queued as it is, so arguments should not
+    be mutated after the call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line with the update context of the record."""
+
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname,
+                 'logger': record.name, 'msg': record.getMessage()}
+        for name in CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT, log_file=LOG_FILE):
+    """Route all logging through a queue to a background writer thread.
+
+    Safe to call more than once; only the first call configures logging.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    formatter = JSONFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # An unbounded queue, so logging never waits for the writer
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(max(logging.WARNING, root.level))
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -2,20 +2,23 @@
 import logging
 import sys
 from bot import create_bot
-from config import BOT_TOKEN, OWNER_ID
+from config import BOT_TOKEN, OWNER_ID, TENANTS_FILE
+from tenant import load_tenants
 from keep_alive import keep_alive
-keep_alive()
+from logsetup import setup_logging
 
+# Set up logging (written by a background thread, see logsetup.py)
+setup_logging()
+keep_alive()
 
-# Set up logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 def validate_config():
     """Validate bot configuration."""
+    if TENANTS_FILE:
+        # Each tenant brings its own token and owners
+        return True
+    
     if not BOT_TOKEN or BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
         logger.error("BOT_TOKEN is not set! Please set the BOT_TOKEN environment variable.")
         return False
@@ -38,8 +41,11 @@ def main():
         logger.error("Configuration validation failed. Exiting...")
         sys.exit(1)
     
-    # Create and run bot
-    bot = create_bot()
+    # Create and run bot (or all tenants' bots)
+    tenants = load_tenants(TENANTS_FILE) if TENANTS_FILE else None
+    if tenants:
+        logger.info(f"Serving {len(tenants)} tenants from {TENANTS_FILE}")
+    bot = create_bot(tenants=tenants)
     
     try:
         bot.run()
@@ -0,0 +1,95 @@
+import threading
+from telegram import InputMediaPhoto, InputMediaVideo, InputMediaDocument
+from telegram.ext import Filters
+
+# Attachments relayed between users and admins
+MEDIA_FILTER = Filters.photo | Filters.document | Filters.voice | Filters.video
+
+# Album item types and the InputMedia used to send them again by file_id
+INPUT_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo,
+               'document': InputMediaDocument}
+
+# Telegram's limit for media captions
+CAPTION_LIMIT = 1024
+
+
+def media_of(message):
+    """``(kind, file_id)`` of a message's attachment, or None for other messages."""
+    if message.photo:
+        # Sizes are listed smallest first
+        return 'photo', message.photo[-1].file_id
+    for kind in ('video', 'document', 'voice'):
+        attachment = getattr(message, kind)
+        if attachment:
+            return kind, attachment.file_id
+    return None
+
+
+def caption_text(text):
+    """Cut a text to the caption limit."""
+    return text if len(text) <= CAPTION_LIMIT else text[:CAPTION_LIMIT - 1] + "…"
+
+
+def album_media(items):
+    """InputMedia list for ``send_media_group`` from stored album items."""
+    return [INPUT_MEDIA[item['type']](item['media'], caption=item.get('caption'))
+            for item in items]
+
+
+class _Album:
+    __slots__ = ('target', 'items', 'captions')
+
+    def __init__(self, target):
+        self.target = target
+        self.items = []
+        self.captions = []
+
+
+class AlbumCollector:
+    """Collects the messages of an album (one media_group_id) into one batch.
+
+    Telegram delivers every album item as its own update. The first item
+    opens a group with a target describing where the album goes; later
+    items are added to it, and the caller flushes the group once after a
+    short wait, so the album is relayed as one sendMediaGroup call.
+    """
+
+    def __init__(self):
+        self._albums = {}
+        self._lock = threading.Lock()
+
+    def add(self, message, target=None):
+        """Add an album message to its group, opening the group if ``target`` is given.
+
+        Returns 'opened' for the first item, 'added' for later ones and
+        None if the message belongs to no known album.
+        """
+        media = media_of(message)
+        if media is None or media[0] not in INPUT_MEDIA:
+            return None
+        with self._lock:
+            album = self._albums.get(message.media_group_id)
+            result = 'added'
+            if album is None:
+                if target is None:
+                    return None
+                album = self._albums[message.media_group_id] = _Album(target)
+                result = 'opened'
+            album.items.append({'type': media[0], 'media': media[1]})
+            if message.caption:
+                album.captions.append(message.caption)
+            return result
+
+    def __contains__(self, media_group_id):
+        return media_group_id in self._albums
+
+    def pop(self, media_group_id):
+        """Remove a group; returns ``(target, items, caption)`` or None."""
+        with self._lock:
+            album = self._albums.pop(media_group_id, None)
+        if album is None:
+            return None
+        return album.target, album.items, '\n'.join(album.captions)
+
+    def __len__(self):
+        return len(self._albums)
@@ -0,0 +1,240 @@
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from telegram.ext import DispatcherHandlerStop
+from telegram.utils.request import Request
+from logsetup import log_context, SAMPLED
+
+logger = logging.getLogger(__name__)
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Update fields checked (in this order) to find the type of an update
+UPDATE_TYPES = ('message', 'edited_message', 'callback_query', 'channel_post',
+                'edited_channel_post', 'inline_query', 'chosen_inline_result',
+                'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class FunctionMetric:
+    """Gauge (or counter) whose value is read from a callback at scrape time."""
+
+    def __init__(self, name, documentation, function, kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.kind = kind
+
+    def collect(self):
+        yield f"{self.name} {self.function()}"
+
+
+class Histogram:
+    """Histogram with fixed buckets and optional labels.
+
+    ``observe`` only bumps a single bucket; cumulative counts are computed
+    when the metrics are rendered.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [per-bucket counts..., +Inf count, sum]
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def quantile(self, q, labels=None):
+        """Estimate a quantile from the buckets (all label sets if labels is None)."""
+        with self._lock:
+            if labels is None:
+                series = [sum(column) for column in zip(*self._series.values())]
+            else:
+                series = list(self._series.get(labels, ()))
+        if not series:
+            return None
+        counts = series[:-1]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                # Linear interpolation inside the bucket
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+    def collect(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                label_str = _format_labels(self.labelnames, labels, ('le', bound))
+                yield f"{self.name}_bucket{label_str} {cumulative}"
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {series[-1]}"
+            yield f"{self.name}_count{label_str} {cumulative}"
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, function):
+        return self.register(FunctionMetric(name, documentation, function))
+
+    def counter_function(self, name, documentation, function):
+        return self.register(FunctionMetric(name, documentation, function, 'counter'))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handler_latency = registry.histogram(
+    'bot_handler_duration_seconds', 'Time spent in update handlers.', ['handler'])
+handler_errors = registry.counter(
+    'bot_handler_errors_total', 'Exceptions raised by update handlers.', ['handler'])
+updates_total = registry.counter(
+    'bot_updates_total', 'Updates received, by type.', ['type'])
+api_latency = registry.histogram(
+    'bot_api_request_duration_seconds', 'Bot API request latency.', ['method'])
+api_errors = registry.counter(
+    'bot_api_errors_total', 'Failed Bot API requests.', ['method', 'error'])
+flood_rejections = registry.counter(
+    'bot_flood_rejections_total', 'Updates dropped by flood control.', ['reason'])
+
+
+def instrument(callback):
+    """Wrap a handler callback to record its latency and errors.
+
+    Log records made by the handler carry the update id, user id and
+    handler name (see logsetup.py).
+    """
+    name = callback.__name__
+    labels = (name,)
+
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        user = update.effective_user
+        token = log_context.set({'update_id': update.update_id,
+                                 'user_id': user.id if user else None, 'handler': name})
+        start = time.perf_counter()
+        try:
+            return callback(update, context)
+        except DispatcherHandlerStop:
+            raise
+        except Exception:
+            handler_errors.inc(labels)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            handler_latency.observe(duration, labels)
+            logger.info("Handled update in %s", name,
+                        extra=dict(SAMPLED, duration_ms=round(duration * 1000, 2)))
+            log_context.reset(token)
+
+    return wrapper
+
+
+def count_update(update, context):
+    """TypeHandler callback counting every incoming update by type."""
+    for update_type in UPDATE_TYPES:
+        if getattr(update, update_type, None) is not None:
+            break
+    else:
+        update_type = 'other'
+    updates_total.inc((update_type,))
+
+
+class InstrumentedRequest(Request):
+    """Request that records the latency and failures of every Bot API call."""
+
+    def post(self, url, data, timeout=None):
+        labels = (url.rsplit('/', 1)[-1],)
+        start = time.perf_counter()
+        try:
+            return super().post(url, data, timeout)
+        except Exception as e:
+            api_errors.inc(labels + (type(e).__name__,))
+            raise
+        finally:
+            api_latency.observe(time.perf_counter() - start, labels)
@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+import uuid
+from logsetup import SAMPLED
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """Durable queue of outgoing Bot API calls.
+
+    A call is written to the StateStore before it is handed to the
+    FanoutSender, and marked done once Telegram accepted it (or rejected it
+    for good). Calls whose retries ran out, or that were still queued when
+    the process stopped, are sent again by ``retry_pending``.
+
+    Every call has a key; a call whose key is already stored is not queued
+    again, so handlers can pass keys derived from the update they serve.
+    Success callbacks are registered by name and get JSON arguments, so
+    they still run for calls recovered after a restart.
+    """
+
+    def __init__(self, sender):
+        self.store = None
+        self.sender = sender
+        self.bot = None
+        self.callbacks = {}
+        self.methods = {}
+        self._in_flight = set()
+        self._idle = threading.Condition()
+
+    def attach_store(self, store):
+        self.store = store
+
+    def attach_bot(self, bot):
+        """Bot whose methods are called; needed before anything is sent."""
+        self.bot = bot
+
+    def register_callback(self, name, function):
+        """Make ``function(result, *args)`` available as a success callback."""
+        self.callbacks[name] = function
+
+    def register_method(self, name, function):
+        """Make ``function(chat_id=..., **params)`` available as a method besides the Bot's."""
+        self.methods[name] = function
+
+    def send(self, method, chat_id, key=None, callback=None, callback_args=(), **params):
+        """Store and queue ``bot.<method>(chat_id=chat_id, **params)``.
+
+        ``method`` may also name a function added with ``register_method``.
+
+        Returns False if a call with the same key was queued before.
+        """
+        key = key or uuid.uuid4().hex
+        outbox_id = self.store.add_outbox(key, method, chat_id, params,
+                                          callback, list(callback_args))
+        if outbox_id is None:
+            logger.info("Skipping duplicate outgoing %s %s", method, key, extra=SAMPLED)
+            return False
+        self._submit(outbox_id, method, chat_id, params, callback, callback_args)
+        return True
+
+    def broadcast(self, method, chat_ids, key=None, callback=None, callback_args=(), **params):
+        """``send`` the same call to several chats; keys get the chat id appended."""
+        key = key or uuid.uuid4().hex
+        for chat_id in chat_ids:
+            self.send(method, chat_id, f"{key}:{chat_id}", callback, callback_args, **params)
+
+    def _submit(self, outbox_id, method, chat_id, params, callback, callback_args):
+        with self._idle:
+            if outbox_id in self._in_flight:
+                return False
+            self._in_flight.add(outbox_id)
+
+        def on_success(result):
+            self.store.mark_outbox_sent(outbox_id)
+            try:
+                if callback:
+                    self.callbacks[callback](result, *callback_args)
+            finally:
+                self._done(outbox_id)
+
+        def on_failure(permanent):
+            if permanent:
+                # Telegram will never accept this call
+                self.store.mark_outbox_sent(outbox_id)
+            self._done(outbox_id)
+
+        function = self.methods.get(method) or getattr(self.bot, method)
+        self.sender.send(function, chat_id, on_success=on_success,
+                         on_failure=on_failure, token=self.bot.token, **params)
+        return True
+
+    def _done(self, outbox_id):
+        with self._idle:
+            self._in_flight.discard(outbox_id)
+            if not self._in_flight:
+                self._idle.notify_all()
+
+    def retry_pending(self):
+        """Queue stored calls that are not done and not in flight; returns how many."""
+        return sum(self._submit(*row) for row in self.store.load_outbox())
+
+    def drain(self, timeout):
+        """Wait up to ``timeout`` seconds for queued calls; returns True if none are left."""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"{len(self._in_flight)} outgoing messages left in the outbox")
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def __len__(self):
+        with self._idle:
+            return len(self._in_flight)
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+from telegram.error import TelegramError, Conflict
+from telegram.ext import TypeHandler
+from config import POLL_TIMEOUT, DRAIN_ON_START, DRAIN_BATCH
+from floodcontrol import content_hash
+
+logger = logging.getLogger(__name__)
+
+# Key of the next update id to fetch in the state store's meta table
+OFFSET_KEY = 'update_offset'
+
+# Seconds to wait after a failed getUpdates, doubled up to the maximum
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+
+
+class BatchProcessed:
+    """Queued after a batch of updates; set once the dispatcher reaches it."""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+
+def pressed_message(query):
+    """The message a button press belongs to, or None if it is not known."""
+    if query.inline_message_id:
+        return query.inline_message_id
+    if query.message:
+        return query.message.chat_id, query.message.message_id
+    return None
+
+
+def fold_backlog(updates, seen):
+    """Drop backlog updates that are no longer worth handling.
+
+    A callback query is stale when the same user pressed another button of
+    the same message later in the batch (the later press replaces the
+    screen anyway); presses followed by messages are kept, since the
+    messages depend on them. A text message is dropped when the user
+    already sent the same text during the drain (``seen`` holds
+    ``(user_id, hash)``); texts of only emoji or punctuation are never folded.
+    Returns ``(kept, stale_callbacks, folded_messages)``.
+    """
+    last_press = {}
+    for update in updates:
+        query = update.callback_query
+        if query and update.effective_user:
+            key = (update.effective_user.id, pressed_message(query))
+            last_press[key] = update.update_id
+
+    kept = []
+    stale = folded = 0
+    for update in updates:
+        user = update.effective_user
+        query = update.callback_query
+        if query and user:
+            message_key = pressed_message(query)
+            if (message_key is not None
+                    and last_press[(user.id, message_key)] != update.update_id):
+                stale += 1
+                continue
+        message = update.message
+        if message and message.text and user and not message.text.startswith('/'):
+            digest = content_hash(message.text)
+            # Emoji- or punctuation-only answers have no hash and are all kept
+            if digest is not None:
+                key = (user.id, digest)
+                if key in seen:
+                    folded += 1
+                    continue
+                seen.add(key)
+        kept.append(update)
+    return kept, stale, folded
+
+
+class Poller:
+    """Long polling that only confirms updates the dispatcher has processed.
+
+    Each batch from getUpdates is handed to the dispatcher, followed by a
+    BatchProcessed marker; the next offset is requested (which confirms
+    the batch to Telegram) and stored only after the marker was reached.
+    The next getUpdates therefore waits until the whole batch was handled.
+    After a crash polling resumes from the stored offset: no update is
+    lost, but the batch that was being handled is handled again (tickets
+    are not sent twice, see the outbox keys). The backlog drained on start
+    is folded first (see fold_backlog).
+    """
+
+    def __init__(self, updater, store, timeout=POLL_TIMEOUT, drain=DRAIN_ON_START,
+                 drain_batch=DRAIN_BATCH):
+        self.updater = updater
+        self.bot = updater.bot
+        self.dispatcher = updater.dispatcher
+        self.store = store
+        self.timeout = timeout
+        self.drain = drain
+        self.drain_batch = drain_batch
+        self.offset = store.load_meta(OFFSET_KEY)
+        self.dispatcher.add_handler(TypeHandler(BatchProcessed, self._batch_processed),
+                                    group=-1000)
+
+    @staticmethod
+    def _batch_processed(marker, context):
+        marker.event.set()
+
+    def start(self):
+        """Run the polling loop in a thread managed by the Updater (stopped by Updater.stop)."""
+        self.bot.delete_webhook()
+        self.updater._init_thread(self.run, "poller")
+
+    def _fetch(self, timeout, limit=100):
+        delay = RETRY_DELAY
+        while self.updater.running:
+            try:
+                return self.bot.get_updates(offset=self.offset, limit=limit, timeout=timeout,
+                                            read_latency=2.0)
+            except Conflict as e:
+                logger.error(f"Another bot instance is polling: {e}")
+            except TelegramError as e:
+                logger.error(f"getUpdates failed: {e}")
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+        return []
+
+    def _process(self, updates):
+        """Hand updates to the dispatcher and wait until it handled them."""
+        marker = BatchProcessed()
+        for update in updates:
+            self.dispatcher.update_queue.put(update)
+        self.dispatcher.update_queue.put(marker)
+        while not marker.event.wait(1.0):
+            if not self.updater.running:
+                return False
+        return True
+
+    def _advance(self, updates):
+        self.offset = updates[-1].update_id + 1
+        self.store.save_meta(OFFSET_KEY, self.offset)
+
+    def run(self):
+        if self.drain:
+            self.drain_backlog()
+        logger.info(f"Polling for updates (offset {self.offset})")
+        while self.updater.running:
+            updates = self._fetch(self.timeout)
+            if updates and self._process(updates):
+                self._advance(updates)
+
+    def drain_backlog(self):
+        """Pull pending updates in full batches until the backlog is empty."""
+        seen = set()
+        total = stale = folded = 0
+        while self.updater.running:
+            updates = self._fetch(0, self.drain_batch)
+            if not updates:
+                break
+            kept, batch_stale, batch_folded = fold_backlog(updates, seen)
+            if not self._process(kept):
+                return
+            self._advance(updates)
+            total += len(updates)
+            stale += batch_stale
+            folded += batch_folded
+            if len(updates) < self.drain_batch:
+                break
+        if total:
+            logger.info(f"Drained backlog of {total} updates: skipped {stale} stale "
+                        f"button presses, folded {folded} repeated messages")
@@ -0,0 +1,311 @@
+import json
+import re
+import threading
+import time
+from types import MappingProxyType
+from config import CATEGORIES, CATEGORY_INSTRUCTIONS
+
+# Message templates (filled with str.format)
+TICKET_TEMPLATE = (
+    "📨 Новое обращение #{message_id}\n\n"
+    "👤 От: {name}\n"
+    "🆔 ID: {user_id}\n"
+    "👤 Username: @{username}\n"
+    "📂 Категория: {category}\n\n"
+    "💬 Сообщение:\n{text}\n\n"
+    "📋 Для ответа пользователю ответьте на это сообщение"
+)
+DIALOG_MESSAGE_TEMPLATE = (
+    "💬 Продолжение диалога\n\n"
+    "👤 От: {name}\n"
+    "🆔 ID: {user_id}\n"
+    "👤 Username: @{username}\n\n"
+    "💬 Сообщение:\n{text}\n\n"
+    "📋 Ответьте на это сообщение для продолжения диалога"
+)
+ADMIN_REPLY_TEMPLATE = (
+    "📬 Ответ от администратора:\n\n"
+    "{text}\n\n"
+    "💬 Диалог начат! Можете продолжить общение."
+)
+# Labels of attachments in ticket and dialog texts (see media.py)
+MEDIA_LABELS = {'photo': '🖼 Фото', 'video': '🎬 Видео', 'document': '📎 Документ',
+                'voice': '🎤 Голосовое сообщение'}
+SEARCH_RESULT_TEMPLATE = (
+    "{kind} {date} · 👤 {user_id} · 📂 {category}\n"
+    "{text}"
+)
+SEARCH_RESULT_KINDS = {'ticket': '📨', 'dialog': '💬', 'reply': '📬'}
+# Characters of each found message shown in /search results
+SEARCH_SNIPPET_LENGTH = 300
+CATEGORY_SCREEN_TEMPLATE = (
+    "📝 Категория: {category}\n\n"
+    "{instruction}\n\n"
+    "Отправьте ваше сообщение:"
+)
+DEFAULT_INSTRUCTION = "Напишите ваше сообщение."
+DIALOG_ENTRY_TEMPLATE = (
+    "👤 Пользователь: {user_id}\n"
+    "👨‍💼 Администратор: {admin_id}\n"
+    "📂 Категория: {category}\n"
+    "{owner}"
+)
+
+
+def keyboard_json(rows):
+    """Serialize inline keyboard rows of (text, callback_data) pairs.
+
+    The resulting JSON string can be passed as ``reply_markup`` as is, so
+    the keyboard is not rebuilt or re-serialized for every message.
+    """
+    return json.dumps(
+        {'inline_keyboard': [[{'text': text, 'callback_data': data} for text, data in row]
+                             for row in rows]},
+        separators=(',', ':'))
+
+
+# Keyboards that do not depend on the category config
+BACK_TO_MENU_KEYBOARD = keyboard_json([[("🔙 Назад в меню", "back_to_menu")]])
+RETURN_TO_MENU_KEYBOARD = keyboard_json([[("🔙 Вернуться в меню", "back_to_menu")]])
+DIALOG_KEYBOARD = keyboard_json([
+    [("✅ Завершить диалог", "end_dialog")],
+    [("🔙 Вернуться в меню", "back_to_menu")]
+])
+
+
+def display_name(user):
+    """First name plus last name, if any."""
+    return f"{user.first_name}{' ' + user.last_name if user.last_name else ''}"
+
+
+def ticket_text(user, message_id, category_name, text):
+    return TICKET_TEMPLATE.format(
+        message_id=message_id, name=display_name(user), user_id=user.id,
+        username=user.username or 'не указан', category=category_name, text=text)
+
+
+def dialog_message_text(user, text):
+    return DIALOG_MESSAGE_TEMPLATE.format(
+        name=display_name(user), user_id=user.id,
+        username=user.username or 'не указан', text=text)
+
+
+def admin_reply_text(text):
+    return ADMIN_REPLY_TEMPLATE.format(text=text)
+
+
+def attachment_text(kinds, caption=None):
+    """Message text for attachments: "[🖼 Фото ×2, 🎬 Видео]" followed by the caption."""
+    counts = {}
+    for kind in kinds:
+        counts[kind] = counts.get(kind, 0) + 1
+    labels = ', '.join(MEDIA_LABELS[kind] + (f" ×{count}" if count > 1 else "")
+                       for kind, count in counts.items())
+    return f"[{labels}] {caption}" if caption else f"[{labels}]"
+
+
+def dialogs_page(dialogs, viewer_id, page, pages, total, mine, render=None):
+    """Text and keyboard of one /dialogs dashboard page.
+
+    Buttons carry ``dlg:<page>:<mine>`` callback data.
+    """
+    render = render or get_render()
+    title = "💬 Ваши диалоги" if mine else "💬 Активные диалоги"
+    entries = [
+        DIALOG_ENTRY_TEMPLATE.format(
+            user_id=dialog.user_id, admin_id=dialog.admin_id,
+            category=render.category_name(dialog.category),
+            owner='🟢 Ваш диалог' if dialog.admin_id == viewer_id else '🔴 Диалог коллеги')
+        for dialog in dialogs
+    ]
+    if entries:
+        text = f"{title} ({total}):\n\n" + "\n\n".join(entries)
+    else:
+        text = "📭 У вас нет активных диалогов." if mine else "📭 Активных диалогов нет."
+    flag = int(mine)
+    navigation = []
+    if page > 0:
+        navigation.append(("◀️", f"dlg:{page - 1}:{flag}"))
+    navigation.append((f"{page + 1}/{pages}", f"dlg:{page}:{flag}"))
+    if page + 1 < pages:
+        navigation.append(("▶️", f"dlg:{page + 1}:{flag}"))
+    toggle = ("👥 Все диалоги", "dlg:0:0") if mine else ("👤 Только мои", "dlg:0:1")
+    return text, keyboard_json([navigation, [toggle]])
+
+
+def search_results_text(records, total, limit, render=None):
+    """Text of a /search answer for archive records, newest first.
+
+    ``total`` equal to ``limit`` means there were at least that many matches.
+    """
+    render = render or get_render()
+    entries = []
+    for record in records:
+        text = record['text']
+        if len(text) > SEARCH_SNIPPET_LENGTH:
+            text = text[:SEARCH_SNIPPET_LENGTH] + "…"
+        entries.append(SEARCH_RESULT_TEMPLATE.format(
+            kind=SEARCH_RESULT_KINDS.get(record['kind'], '💬'),
+            date=time.strftime('%d.%m.%Y %H:%M', time.localtime(record['ts'])),
+            user_id=record['user_id'], category=render.category_name(record['category']),
+            text=text))
+    found = f"{total}+" if total >= limit else str(total)
+    return f"🔎 Найдено: {found}, показаны последние {len(records)}\n\n" + "\n\n".join(entries)
+
+
+def format_duration(seconds):
+    """Short Russian duration such as "45 с", "12 мин" or "3 ч 5 мин"."""
+    seconds = round(seconds)
+    if seconds < 60:
+        return f"{seconds} с"
+    minutes = seconds // 60
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 48:
+        return f"{hours} ч {minutes} мин" if minutes else f"{hours} ч"
+    return f"{hours // 24} д {hours % 24} ч"
+
+
+def _timing_text(timing):
+    if timing is None:
+        return "нет данных"
+    return f"медиана {format_duration(timing['median'])}, 90% — {format_duration(timing['p90'])}"
+
+
+def stats_text(summary, render=None):
+    """Text of the /stats answer for SupportStats.summary()."""
+    render = render or get_render()
+    total = summary['total']
+    lines = [
+        f"📈 Статистика с {time.strftime('%d.%m.%Y %H:%M', time.localtime(summary['started_at']))}",
+        "",
+        f"Обращений: {total['tickets']}, диалогов: {total['dialogs_started']} "
+        f"(завершено {total['dialogs_closed']}), ответов админов: {total['replies']}",
+        f"⏱ Первый ответ: {_timing_text(total['first_response'])}",
+        f"💬 Длительность диалога: {_timing_text(total['dialog_duration'])}",
+        "",
+        "📂 По категориям:",
+    ]
+    categories = summary['categories']
+    for key in list(render.categories) + sorted(set(categories) - set(render.categories)):
+        group = categories.get(key)
+        if group is None:
+            lines.append(f"• {render.category_name(key)}: 0")
+            continue
+        line = (f"• {render.category_name(key)}: {group['tickets']} обр., "
+                f"{group['dialogs_started']} диал.")
+        if group['first_response']:
+            line += f", первый ответ ~{format_duration(group['first_response']['median'])}"
+        lines.append(line)
+    lines += ["", "👥 По администраторам:"]
+    if not summary['admins']:
+        lines.append("• пока нет ответов")
+    for admin_id, group in sorted(summary['admins'].items(),
+                                  key=lambda item: -item[1]['dialogs_started']):
+        line = (f"• {admin_id}: {group['dialogs_started']} диал. "
+                f"(завершено {group['dialogs_closed']}), {group['replies']} отв.")
+        if group['first_response']:
+            line += f", первый ответ {_timing_text(group['first_response'])}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def broadcast_status_text(state):
+    """Progress of a /broadcast for the admin's status message."""
+    done = state['sent'] + state['failed']
+    if state['cancelled']:
+        status = "⏹ Рассылка остановлена"
+    elif state['finished_at']:
+        status = "✅ Рассылка завершена"
+    else:
+        status = "📣 Идёт рассылка"
+    return (f"{status}\n\n"
+            f"Обработано: {done} из {max(done, state['total'])}\n"
+            f"Доставлено: {state['sent']}, ошибок: {state['failed']}")
+
+
+class MenuRender:
+    """Menus and texts derived from the category config, built once.
+
+    Instances are immutable; a config change produces a new instance.
+    """
+
+    __slots__ = ('fingerprint', 'categories', 'main_menu_keyboard',
+                 'category_screens', 'user_help_categories')
+
+    def __init__(self, categories, instructions):
+        self.fingerprint = _fingerprint(categories, instructions)
+        self.categories = MappingProxyType(dict(categories))
+        self.main_menu_keyboard = keyboard_json(
+            [[(name, key)] for key, name in categories.items()])
+        self.category_screens = MappingProxyType({
+            key: CATEGORY_SCREEN_TEMPLATE.format(
+                category=name, instruction=instructions.get(key, DEFAULT_INSTRUCTION))
+            for key, name in categories.items()
+        })
+        self.user_help_categories = '\n'.join(f"• {name}" for name in categories.values())
+
+    def category_name(self, key):
+        return self.categories.get(key, 'Прочее')
+
+
+# Category keys are sent back as callback data (at most 64 bytes) and must
+# not clash with the other buttons
+CATEGORY_KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+RESERVED_CALLBACKS = ('back_to_menu', 'end_dialog')
+
+
+def read_menu(path):
+    """Validated ``(categories, instructions)`` from a JSON menu file.
+
+    The file holds ``{"categories": {key: name}, "instructions": {key: text}}``;
+    raises ValueError (or OSError) describing the first problem found.
+    """
+    with open(path, encoding='utf-8') as f:
+        menu = json.load(f)
+    if not isinstance(menu, dict):
+        raise ValueError(f"{path}: expected an object with categories and instructions")
+    categories = menu.get('categories')
+    instructions = menu.get('instructions', {})
+    if not isinstance(categories, dict) or not categories:
+        raise ValueError(f"{path}: categories must be a non-empty object")
+    if not isinstance(instructions, dict):
+        raise ValueError(f"{path}: instructions must be an object")
+    for key, name in categories.items():
+        if not CATEGORY_KEY_PATTERN.match(key) or key in RESERVED_CALLBACKS:
+            raise ValueError(f"{path}: invalid category key {key!r}")
+        if not isinstance(name, str) or not name.strip():
+            raise ValueError(f"{path}: category {key!r} needs a name")
+    for key, instruction in instructions.items():
+        if key not in categories:
+            raise ValueError(f"{path}: instruction for unknown category {key!r}")
+        if not isinstance(instruction, str):
+            raise ValueError(f"{path}: instruction for {key!r} must be text")
+    return categories, instructions
+
+
+def _fingerprint(categories, instructions):
+    return hash((tuple(categories.items()), tuple(instructions.items())))
+
+
+_current = MenuRender(CATEGORIES, CATEGORY_INSTRUCTIONS)
+_lock = threading.Lock()
+
+
+def get_render():
+    """Return the menus built from the current category config."""
+    return _current
+
+
+def rebuild_render(categories, instructions):
+    """Rebuild the menus if the config changed; returns the current render.
+
+    The new render is complete before it replaces the old one, so an update
+    sees either the old menus or the new ones.
+    """
+    global _current
+    with _lock:
+        if _fingerprint(categories, instructions) != _current.fingerprint:
+            _current = MenuRender(categories, instructions)
+        return _current
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Replay a recorded update capture against a fresh bot to compare versions.
+
+Updates from a capture written by capture.UpdateRecorder (CAPTURE_PATH) are
+fed into the dispatcher of a bot built by create_bot(); all outbound Bot API
+calls go to the local fake server. Reports throughput, per-update latency
+(queue wait + processing) and dispatcher CPU time.
+
+    python replay.py capture.jsonl.gz --speed max
+    python replay.py capture.jsonl --speed 10 --output results.json
+"""
+import argparse
+import json
+import threading
+import time
+
+from benchmark import add_rate_arguments, percentile, prepare_environment
+from capture import read_capture
+from fake_telegram import FakeTelegramServer
+
+# Marker put on the update queue after the last update
+END_OF_REPLAY = 'end-of-replay'
+
+
+def parse_speed(value):
+    """'max' for no pacing, otherwise a positive speed multiplier (1 = real time)."""
+    if value == 'max':
+        return 0.0
+    speed = float(value.rstrip('x'))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('speed must be positive or "max"')
+    return speed
+
+
+class ReplayProbe:
+    """Dispatcher hooks measuring latency and CPU time of every update."""
+
+    def __init__(self):
+        self.enqueued = {}
+        self.started = {}
+        self.latencies = []
+        self.cpu_times = []
+        self.finished = threading.Event()
+
+    def begin(self, update, context):
+        self.started[update.update_id] = time.thread_time()
+
+    def end(self, update, context):
+        cpu_start = self.started.pop(update.update_id, None)
+        if cpu_start is not None:
+            self.cpu_times.append(time.thread_time() - cpu_start)
+        enqueued = self.enqueued.pop(update.update_id, None)
+        if enqueued is not None:
+            self.latencies.append(time.perf_counter() - enqueued)
+
+    def mark_finished(self, marker, context):
+        if marker == END_OF_REPLAY:
+            self.finished.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('capture', help='capture file (.jsonl or .jsonl.gz)')
+    parser.add_argument('--speed', type=parse_speed, default=1.0,
+                        help='1 for real time, N for N times faster, "max" for no pacing')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='fake Bot API latency per request (seconds)')
+    parser.add_argument('--limit', type=int, default=0, help='replay only the first N updates')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    add_rate_arguments(parser)
+    args = parser.parse_args()
+
+    prepare_environment(args.chat_rate, args.global_rate)
+
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    from logsetup import setup_logging
+    from bot import create_bot
+    from handlers import fanout
+
+    setup_logging()
+    server = FakeTelegramServer(latency=args.latency).start()
+    bot = create_bot(base_url=server.base_url, capture_path='')
+    probe = ReplayProbe()
+    bot.dispatcher.add_handler(TypeHandler(Update, probe.begin), group=-100)
+    bot.dispatcher.add_handler(TypeHandler(Update, probe.end), group=100)
+    bot.dispatcher.add_handler(TypeHandler(str, probe.mark_finished), group=-100)
+
+    bot.store.start()
+    bot.archive.start()
+    bot.updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=bot.dispatcher.start, name='dispatcher',
+                                         daemon=True)
+    dispatcher_thread.start()
+
+    count = 0
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    first_timestamp = None
+    try:
+        for timestamp, data in read_capture(args.capture):
+            if args.limit and count >= args.limit:
+                break
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            if args.speed:
+                delay = (timestamp - first_timestamp) / args.speed - (time.perf_counter() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            update = Update.de_json(data, bot.updater.bot)
+            probe.enqueued[update.update_id] = time.perf_counter()
+            bot.dispatcher.update_queue.put(update)
+            count += 1
+        bot.dispatcher.update_queue.put(END_OF_REPLAY)
+        probe.finished.wait()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+    finally:
+        bot.dispatcher.stop()
+        bot.updater.job_queue.stop()
+        fanout.shutdown(wait=True)
+        bot.store.close()
+        bot.archive.close()
+        server.stop()
+
+    results = {
+        'capture': args.capture,
+        'speed': args.speed or 'max',
+        'updates': count,
+        'wall_seconds': round(wall, 3),
+        'updates_per_second': round(count / wall, 1) if wall else None,
+        'process_cpu_seconds': round(cpu, 3),
+        'dispatcher_cpu_ms_per_update': round(
+            sum(probe.cpu_times) / len(probe.cpu_times) * 1000, 3) if probe.cpu_times else None,
+        'latency_p50_ms': round(percentile(probe.latencies, 0.5) * 1000, 2),
+        'latency_p99_ms': round(percentile(probe.latencies, 0.99) * 1000, 2),
+        'api_calls': dict(server.calls),
+    }
+    for key, value in results.items():
+        print(f"{key}: {value}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
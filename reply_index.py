@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from config import REPLY_INDEX_TTL, REPLY_INDEX_MAX_SIZE
+
+# Compact record describing which user a forwarded message belongs to
+ReplyRecord = namedtuple(
+    'ReplyRecord', ['user_id', 'original_message_id', 'category', 'created_at'])
+
+
+class ReplyIndex:
+    """Bounded, expiring index of forwarded messages that admins reply to.
+
+    Entries are keyed by (admin chat id, message id) and evicted once they
+    are older than ``ttl`` seconds or when the index grows past ``max_size``
+    (least recently used first).
+    """
+
+    def __init__(self, ttl=REPLY_INDEX_TTL, max_size=REPLY_INDEX_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.store = None
+
+    def attach_store(self, store):
+        """Write mappings through to a StateStore and read misses from it."""
+        self.store = store
+
+    def add(self, chat_id, message_id, user_id, original_message_id,
+            category='other', created_at=None):
+        """Remember that a message in an admin chat belongs to a user."""
+        record = ReplyRecord(user_id, original_message_id, category,
+                             created_at or time.time())
+        key = (chat_id, message_id)
+        with self._lock:
+            self._entries[key] = record
+            self._entries.move_to_end(key)
+            self._prune(time.time())
+        if self.store is not None:
+            self.store.save_reply(chat_id, message_id, record)
+        return record
+
+    def get(self, chat_id, message_id):
+        """Return the record for an admin message or None if unknown/expired."""
+        key = (chat_id, message_id)
+        now = time.time()
+        with self._lock:
+            record = self._entries.get(key)
+            if record is not None and now - record.created_at > self.ttl:
+                del self._entries[key]
+                self.expirations += 1
+                record = None
+            if record is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return record
+        if self.store is not None:
+            record = self.store.get_reply(chat_id, message_id)
+            if record is not None and now - record.created_at <= self.ttl:
+                with self._lock:
+                    self._entries[key] = record
+                    self._prune(now)
+                    self.hits += 1
+                return record
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _prune(self, now):
+        """Drop expired entries from the cold end and enforce the size cap."""
+        entries = self._entries
+        while entries:
+            key, record = next(iter(entries.items()))
+            if now - record.created_at > self.ttl:
+                entries.popitem(last=False)
+                self.expirations += 1
+            elif len(entries) > self.max_size:
+                entries.popitem(last=False)
+                self.evictions += 1
+            else:
+                break
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Return size and hit/miss counters."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
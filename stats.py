@@ -0,0 +1,218 @@
+import math
+import threading
+import time
+from bisect import bisect_right, insort
+
+# Key of the saved statistics in the state store's meta table
+STATS_KEY = 'stats'
+
+
+class P2Quantile:
+    """Streaming quantile estimate with the P² algorithm (Jain & Chlamtac).
+
+    Keeps five markers whatever the number of observations; the middle one
+    tracks the ``p`` quantile. The first five values are kept exactly.
+    """
+
+    __slots__ = ('p', 'count', 'heights', 'positions', 'desired')
+
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+
+    def add(self, value):
+        self.count += 1
+        q = self.heights
+        if len(q) < 5:
+            insort(q, value)
+            return
+
+        if value < q[0]:
+            q[0] = value
+            k = 0
+        elif value >= q[4]:
+            q[4] = value
+            k = 3
+        else:
+            k = bisect_right(q, value) - 1
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        p = self.p
+        for i, increment in enumerate((0, p / 2, p, (1 + p) / 2, 1)):
+            self.desired[i] += increment
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    # Parabolic estimate out of order: fall back to linear
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def value(self):
+        """Current estimate, or None before the first observation."""
+        if not self.count:
+            return None
+        if self.count <= 5:
+            # Nearest rank on the exact values
+            return self.heights[max(0, math.ceil(self.p * self.count) - 1)]
+        return self.heights[2]
+
+    def dump(self):
+        return [self.count, self.heights, self.positions, self.desired]
+
+    def load(self, data):
+        self.count, self.heights, self.positions, self.desired = data
+
+
+class _Timing:
+    """Count, mean, median and 90th percentile of a duration."""
+
+    __slots__ = ('total', 'median', 'p90')
+
+    def __init__(self):
+        self.total = 0.0
+        self.median = P2Quantile(0.5)
+        self.p90 = P2Quantile(0.9)
+
+    def add(self, seconds):
+        self.total += seconds
+        self.median.add(seconds)
+        self.p90.add(seconds)
+
+    @property
+    def count(self):
+        return self.median.count
+
+    def summary(self):
+        if not self.count:
+            return None
+        return {'count': self.count, 'mean': self.total / self.count,
+                'median': self.median.value(), 'p90': self.p90.value()}
+
+    def dump(self):
+        return [self.total, self.median.dump(), self.p90.dump()]
+
+    def load(self, data):
+        self.total = data[0]
+        self.median.load(data[1])
+        self.p90.load(data[2])
+
+
+class _Group:
+    """Counters and timings of one category or admin (or of all of them)."""
+
+    __slots__ = ('tickets', 'dialogs_started', 'dialogs_closed', 'replies',
+                 'first_response', 'dialog_duration')
+
+    def __init__(self):
+        self.tickets = 0
+        self.dialogs_started = 0
+        self.dialogs_closed = 0
+        self.replies = 0
+        self.first_response = _Timing()
+        self.dialog_duration = _Timing()
+
+    def summary(self):
+        return {'tickets': self.tickets, 'dialogs_started': self.dialogs_started,
+                'dialogs_closed': self.dialogs_closed, 'replies': self.replies,
+                'first_response': self.first_response.summary(),
+                'dialog_duration': self.dialog_duration.summary()}
+
+    def dump(self):
+        return [self.tickets, self.dialogs_started, self.dialogs_closed, self.replies,
+                self.first_response.dump(), self.dialog_duration.dump()]
+
+    def load(self, data):
+        (self.tickets, self.dialogs_started, self.dialogs_closed, self.replies,
+         first_response, dialog_duration) = data
+        self.first_response.load(first_response)
+        self.dialog_duration.load(dialog_duration)
+
+
+class SupportStats:
+    """Ticket and dialog statistics updated as events happen.
+
+    Totals are kept overall, per category and per admin. Quantiles are P²
+    estimates, so memory per category and admin stays the same however
+    many tickets and dialogs there were. The numbers are saved to the
+    state store by ``save`` and restored by ``attach_store``.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.total = _Group()
+        self.categories = {}
+        self.admins = {}
+        self.store = None
+        self._lock = threading.Lock()
+
+    def attach_store(self, store):
+        """Restore saved statistics and save further ones to a StateStore."""
+        self.store = store
+        data = store.load_meta(STATS_KEY)
+        if data:
+            with self._lock:
+                self.started_at = data['started_at']
+                self.total.load(data['total'])
+                for key, values in data['categories'].items():
+                    self._group(self.categories, key).load(values)
+                for key, values in data['admins'].items():
+                    self._group(self.admins, int(key)).load(values)
+
+    def save(self):
+        if self.store is None:
+            return
+        with self._lock:
+            data = {'started_at': self.started_at, 'total': self.total.dump(),
+                    'categories': {key: group.dump() for key, group in self.categories.items()},
+                    'admins': {key: group.dump() for key, group in self.admins.items()}}
+        self.store.save_meta(STATS_KEY, data)
+
+    @staticmethod
+    def _group(groups, key):
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = _Group()
+        return group
+
+    def ticket(self, category):
+        with self._lock:
+            self.total.tickets += 1
+            self._group(self.categories, category).tickets += 1
+
+    def reply(self, admin_id, category, started, first_response=None):
+        """An admin answered; ``first_response`` is the seconds a new ticket waited."""
+        with self._lock:
+            groups = (self.total, self._group(self.categories, category),
+                      self._group(self.admins, admin_id))
+            for group in groups:
+                group.replies += 1
+                if started:
+                    group.dialogs_started += 1
+                if first_response is not None:
+                    group.first_response.add(max(0.0, first_response))
+
+    def dialog_closed(self, dialog):
+        duration = time.time() - dialog.started_at
+        with self._lock:
+            for group in (self.total, self._group(self.categories, dialog.category),
+                          self._group(self.admins, dialog.admin_id)):
+                group.dialogs_closed += 1
+                group.dialog_duration.add(duration)
+
+    def summary(self):
+        """Plain-data view of all statistics for rendering."""
+        with self._lock:
+            return {'started_at': self.started_at, 'total': self.total.summary(),
+                    'categories': {key: group.summary() for key, group in self.categories.items()},
+                    'admins': {key: group.summary() for key, group in self.admins.items()}}
@@ -0,0 +1,382 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from telegram.ext import BasePersistence
+from config import (STATE_DB_PATH, STATE_FLUSH_INTERVAL, STATE_FLUSH_BATCH,
+                    REPLY_INDEX_TTL, OUTBOX_KEY_TTL)
+from reply_index import ReplyRecord
+from dialogs import Dialog
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dialogs (
+    user_id INTEGER PRIMARY KEY,
+    admin_id INTEGER NOT NULL,
+    category TEXT NOT NULL,
+    started_at REAL NOT NULL DEFAULT 0,
+    last_activity REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS replies (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    original_message_id TEXT NOT NULL,
+    category TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS replies_created_at ON replies (created_at);
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    method TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    params TEXT NOT NULL,
+    callback TEXT,
+    callback_args TEXT,
+    created_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS outbox_sent_at ON outbox (sent_at);
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    conv_key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (name, conv_key)
+) WITHOUT ROWID;
+"""
+
+# Columns added after a table was first created: (table, column, definition)
+MIGRATIONS = [
+    ('dialogs', 'started_at', 'REAL NOT NULL DEFAULT 0'),
+    ('dialogs', 'last_activity', 'REAL NOT NULL DEFAULT 0'),
+]
+
+# How often expired reply mappings and outbox keys are removed from disk (seconds)
+REPLY_PRUNE_INTERVAL = 60 * 60
+
+
+class StateStore:
+    """SQLite-backed store for dialogs, reply mappings and user data.
+
+    Writes are coalesced in memory and flushed by a background thread in
+    batches (write-behind), so handlers never wait for a disk sync.
+    The database runs in WAL mode, which lets reads proceed during a flush.
+    """
+
+    def __init__(self, path=STATE_DB_PATH, flush_interval=STATE_FLUSH_INTERVAL,
+                 batch_size=STATE_FLUSH_BATCH):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._db_lock = threading.Lock()
+        # Pending writes keyed by row identity so repeated updates collapse
+        self._pending = OrderedDict()
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._last_prune = 0.0
+
+    def _migrate(self):
+        """Add columns missing from databases created by older versions."""
+        for table, column, definition in MIGRATIONS:
+            columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def start(self):
+        """Start the background flush thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop,
+                                            name="StateStoreFlusher",
+                                            daemon=True)
+            self._thread.start()
+            logger.info(f"State store started ({self.path})")
+
+    def close(self):
+        """Flush pending writes and close the database."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+        logger.info("State store closed")
+
+    # Write-behind queue
+
+    def _enqueue(self, key, sql, params):
+        with self._pending_lock:
+            self._pending[key] = (sql, params)
+            self._pending.move_to_end(key)
+            pending = len(self._pending)
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def _flush_loop(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if time.time() - self._last_prune > REPLY_PRUNE_INTERVAL:
+                    self.prune_replies()
+                    self.prune_outbox()
+            except Exception as e:
+                logger.error(f"Failed to flush state store: {e}")
+
+    def flush(self):
+        """Write all pending changes in a single transaction."""
+        with self._pending_lock:
+            if not self._pending:
+                return
+            batch = list(self._pending.items())
+            self._pending.clear()
+        with self._db_lock:
+            try:
+                self._conn.execute("BEGIN")
+                for _, (sql, params) in batch:
+                    self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                # Put the batch back unless newer writes superseded it
+                with self._pending_lock:
+                    for key, value in reversed(batch):
+                        if key not in self._pending:
+                            self._pending[key] = value
+                            self._pending.move_to_end(key, last=False)
+                raise
+
+    def prune_replies(self, max_age=REPLY_INDEX_TTL):
+        """Delete reply mappings older than ``max_age`` seconds."""
+        self._last_prune = time.time()
+        with self._db_lock:
+            self._conn.execute("DELETE FROM replies WHERE created_at < ?",
+                               (self._last_prune - max_age,))
+
+    def _query(self, sql, params=()):
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    # Dialogs
+
+    def save_dialog(self, dialog):
+        self._enqueue(('dialog', dialog.user_id),
+                      "INSERT OR REPLACE INTO dialogs (user_id, admin_id, category, "
+                      "started_at, last_activity) VALUES (?, ?, ?, ?, ?)",
+                      (dialog.user_id, dialog.admin_id, dialog.category,
+                       dialog.started_at, dialog.last_activity))
+
+    def delete_dialog(self, user_id):
+        self._enqueue(('dialog', user_id),
+                      "DELETE FROM dialogs WHERE user_id = ?", (user_id,))
+
+    def load_dialogs(self):
+        """Return persisted dialogs as Dialog objects."""
+        rows = self._query("SELECT user_id, admin_id, category, started_at, "
+                           "last_activity FROM dialogs")
+        return [Dialog(*row) for row in rows]
+
+    # Reply mappings
+
+    def save_reply(self, chat_id, message_id, record):
+        self._enqueue(('reply', chat_id, message_id),
+                      "INSERT OR REPLACE INTO replies (chat_id, message_id, user_id, "
+                      "original_message_id, category, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                      (chat_id, message_id) + tuple(record))
+
+    def get_reply(self, chat_id, message_id):
+        """Return a ReplyRecord for an admin message or None."""
+        with self._pending_lock:
+            pending = self._pending.get(('reply', chat_id, message_id))
+        if pending:
+            return ReplyRecord(*pending[1][2:])
+        rows = self._query(
+            "SELECT user_id, original_message_id, category, created_at "
+            "FROM replies WHERE chat_id = ? AND message_id = ?",
+            (chat_id, message_id))
+        return ReplyRecord(*rows[0]) if rows else None
+
+    # Outbox of Bot API calls (used by outbox.Outbox)
+
+    def add_outbox(self, key, method, chat_id, params, callback=None, callback_args=None):
+        """Store a call right away; returns its id, or None if ``key`` was already stored."""
+        with self._db_lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO outbox (key, method, chat_id, params, callback, "
+                "callback_args, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, method, chat_id, json.dumps(params, ensure_ascii=False), callback,
+                 json.dumps(callback_args, ensure_ascii=False), time.time()))
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def mark_outbox_sent(self, outbox_id):
+        """Mark a call as done; its key is kept to reject repeats until pruned."""
+        self._enqueue(('outbox', outbox_id),
+                      "UPDATE outbox SET sent_at = ? WHERE id = ?", (time.time(), outbox_id))
+
+    def load_outbox(self):
+        """Calls not done yet: ``[(id, method, chat_id, params, callback, callback_args)]``."""
+        with self._pending_lock:
+            done = {key[1] for key in self._pending if key[0] == 'outbox'}
+        rows = self._query("SELECT id, method, chat_id, params, callback, callback_args "
+                           "FROM outbox WHERE sent_at IS NULL ORDER BY id")
+        return [(outbox_id, method, chat_id, json.loads(params), callback, json.loads(callback_args))
+                for outbox_id, method, chat_id, params, callback, callback_args in rows
+                if outbox_id not in done]
+
+    def prune_outbox(self, max_age=OUTBOX_KEY_TTL):
+        """Delete calls that were done more than ``max_age`` seconds ago."""
+        with self._db_lock:
+            self._conn.execute("DELETE FROM outbox WHERE sent_at < ?", (time.time() - max_age,))
+
+    # Users who ever wrote to the bot (recipients of /broadcast)
+
+    def save_user(self, user_id):
+        now = time.time()
+        self._enqueue(('user', user_id),
+                      "INSERT INTO users (user_id, first_seen, last_seen) VALUES (?, ?, ?) "
+                      "ON CONFLICT (user_id) DO UPDATE SET last_seen = excluded.last_seen",
+                      (user_id, now, now))
+
+    def count_users(self):
+        return self._query("SELECT count(*) FROM users")[0][0]
+
+    def users_after(self, user_id, limit):
+        """Up to ``limit`` user ids greater than ``user_id``, in ascending order."""
+        return [row[0] for row in self._query(
+            "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+            (user_id, limit))]
+
+    # Small named values such as the polling offset
+
+    def save_meta(self, name, value):
+        """Store a JSON value right away (not through the write-behind queue)."""
+        with self._db_lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                               (name, json.dumps(value)))
+
+    def load_meta(self, name, default=None):
+        rows = self._query("SELECT value FROM meta WHERE name = ?", (name,))
+        return json.loads(rows[0][0]) if rows else default
+
+    # User data and conversation states (used by SQLitePersistence)
+
+    def save_user_data(self, user_id, data):
+        self._enqueue(('user_data', user_id),
+                      "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                      (user_id, json.dumps(data, ensure_ascii=False)))
+
+    def load_user_data(self):
+        rows = self._query("SELECT user_id, data FROM user_data")
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    def save_conversation(self, name, key, state):
+        conv_key = json.dumps(list(key))
+        if state is None:
+            self._enqueue(('conversation', name, conv_key),
+                          "DELETE FROM conversations WHERE name = ? AND conv_key = ?",
+                          (name, conv_key))
+        else:
+            self._enqueue(('conversation', name, conv_key),
+                          "INSERT OR REPLACE INTO conversations (name, conv_key, state) "
+                          "VALUES (?, ?, ?)", (name, conv_key, json.dumps(state)))
+
+    def load_conversations(self, name):
+        rows = self._query("SELECT conv_key, state FROM conversations WHERE name = ?",
+                           (name,))
+        return {tuple(json.loads(conv_key)): json.loads(state)
+                for conv_key, state in rows}
+
+
+class SQLitePersistence(BasePersistence):
+    """PTB persistence that keeps user_data and conversation states in a StateStore."""
+
+    def __init__(self, store):
+        super().__init__(store_user_data=True, store_chat_data=False,
+                         store_bot_data=False)
+        self.store = store
+        self._user_data = None
+        self._conversations = {}
+
+    def _load_user_data(self):
+        if self._user_data is None:
+            self._user_data = defaultdict(dict, self.store.load_user_data())
+        return self._user_data
+
+    def get_user_data(self):
+        return self._load_user_data()
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        if name not in self._conversations:
+            self._conversations[name] = self.store.load_conversations(name)
+        # ConversationHandler changes the dict it gets before calling
+        # update_conversation, so it must not be our record of what is saved
+        return dict(self._conversations[name])
+
+    def update_conversation(self, name, key, new_state):
+        conversations = self._conversations.setdefault(name, {})
+        if conversations.get(key) == new_state:
+            return
+        if new_state is None:
+            del conversations[key]
+        else:
+            conversations[key] = new_state
+        self.store.save_conversation(name, key, new_state)
+
+    def update_user_data(self, user_id, data):
+        user_data = self._load_user_data()
+        if user_data.get(user_id) == data:
+            return
+        user_data[user_id] = data
+        self.store.save_user_data(user_id, data)
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def refresh_user_data(self, user_id, user_data):
+        pass
+
+    def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    def refresh_bot_data(self, bot_data):
+        pass
+
+    def flush(self):
+        self.store.flush()
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+from config import (BOT_TOKEN, OWNER_IDS, STATE_DB_PATH, ARCHIVE_DIR, ASSIGNMENT_MODE,
+                    CATEGORY_ADMINS, MENU_FILE)
+from reply_index import ReplyIndex
+from dialogs import DialogRegistry
+from expiry import DialogExpiry
+from outbox import Outbox
+from broadcast import Broadcaster
+from assignment import TicketAssigner
+from digest import DigestBuffer
+from floodcontrol import FloodControl
+from stats import SupportStats
+from media import AlbumCollector, album_media
+from render import MenuRender, get_render, read_menu, rebuild_render
+
+logger = logging.getLogger(__name__)
+
+# Every tenant created in this process, for metrics summed over all bots
+tenants = []
+
+
+class Tenant:
+    """One feedback bot served by this process: its token, admins, menus and state.
+
+    Handlers find the tenant of an update with ``tenant_of(context)``;
+    nothing in here is shared with other tenants except the FanoutSender
+    passed in. A tenant without its own categories or ``menu_file`` uses
+    the menus of the process (see render.get_render), read from MENU_FILE.
+    """
+
+    def __init__(self, sender, name='', token=BOT_TOKEN, owner_ids=OWNER_IDS,
+                 categories=None, instructions=None, assignment_mode=ASSIGNMENT_MODE,
+                 category_admins=CATEGORY_ADMINS, state_db_path=None, archive_dir=None,
+                 menu_file=None):
+        self.name = name
+        self.token = token
+        self.owner_ids = list(owner_ids)
+        self._render = MenuRender(categories, instructions or {}) if categories else None
+        # Menus given inline in the tenant config are not reloaded
+        self.menu_file = menu_file or (None if categories else MENU_FILE)
+        self.menu_mtime = None
+        self.state_db_path = state_db_path or tenant_path(STATE_DB_PATH, name)
+        self.archive_dir = archive_dir or (os.path.join(ARCHIVE_DIR, name) if name else ARCHIVE_DIR)
+
+        # Registry of active dialogs (user_id -> Dialog)
+        self.active_dialogs = DialogRegistry()
+        # Closes dialogs left inactive (see expiry.py); driven by expire_dialogs
+        self.dialog_expiry = DialogExpiry(self.active_dialogs)
+        # Index of forwarded messages admins can reply to:
+        # (admin_chat_id, message_id) -> ReplyRecord
+        self.reply_index = ReplyIndex()
+        # Durable queue in front of the fan-out sender; messages survive errors and restarts
+        self.outbox = Outbox(sender)
+        # Paced, resumable announcements to all users (see broadcast.py)
+        self.broadcaster = Broadcaster(sender)
+        # Chooses the admin a new ticket goes to (see assignment.py)
+        self.ticket_assigner = TicketAssigner(self.active_dialogs, assignment_mode,
+                                              self.owner_ids, category_admins)
+        # Tickets assigned to one admin, summarized for the others by send_digest
+        self.ticket_digest = DigestBuffer("📋 Новые обращения, назначенные коллегам:")
+        # Dialog starts and ends, summarized for the admins not involved
+        self.status_digest = DigestBuffer("📊 Диалоги коллег:")
+        # Per-user rate limit and duplicate suppression in front of all handlers
+        self.flood_control = FloodControl()
+        # Ticket and dialog counters shown by /stats (see stats.py)
+        self.support_stats = SupportStats()
+        # Albums being collected before they are relayed as one batch (see media.py)
+        self.album_collector = AlbumCollector()
+        # Persistent state store and ticket archive, attached by the bot at startup
+        self.state_store = None
+        self.ticket_archive = None
+
+        self.outbox.register_callback("remember_reply", self.remember_reply)
+        self.outbox.register_callback("remember_copy", self.remember_copy)
+        self.outbox.register_callback("remember_album", self.remember_album)
+        self.outbox.register_method("send_album", self.send_album)
+        tenants.append(self)
+
+    @property
+    def render(self):
+        return self._render or get_render()
+
+    def reload_menu(self):
+        """Read the menu file again and swap in the new menus; returns the render.
+
+        Raises ValueError or OSError, keeping the current menus, if the file
+        is missing or invalid.
+        """
+        if self.menu_file is None:
+            raise ValueError("the menu is set in the tenants file")
+        # Taken before reading, so a write during the read is picked up next time
+        self.menu_mtime = os.stat(self.menu_file).st_mtime
+        categories, instructions = read_menu(self.menu_file)
+        if self._render is None and self.menu_file == MENU_FILE:
+            return rebuild_render(categories, instructions)
+        self._render = MenuRender(categories, instructions)
+        return self._render
+
+    def menu_changed(self):
+        """True if the menu file exists and changed since it was last read."""
+        if self.menu_file is None:
+            return False
+        try:
+            return os.stat(self.menu_file).st_mtime != self.menu_mtime
+        except OSError:
+            return False
+
+    def attach_bot(self, bot):
+        self.outbox.attach_bot(bot)
+        self.broadcaster.attach_bot(bot)
+
+    def attach_store(self, store):
+        """Restore dialogs from the store and persist further changes to it."""
+        self.state_store = store
+        self.active_dialogs.attach_store(store)
+        self.reply_index.attach_store(store)
+        self.outbox.attach_store(store)
+        self.support_stats.attach_store(store)
+        self.broadcaster.attach_store(store)
+        for dialog in self.active_dialogs.snapshot():
+            self.dialog_expiry.watch(dialog)
+        logger.info(f"Restored {len(self.active_dialogs)} active dialogs from storage"
+                    + (f" for {self.name}" if self.name else ""))
+
+    def attach_archive(self, archive):
+        """Archive tickets and dialog messages from now on."""
+        self.ticket_archive = archive
+
+    # Outbox callbacks
+
+    def remember_reply(self, sent_message, user_id, original_message_id, category):
+        """Let the admin reply to a message forwarded to them."""
+        self.reply_index.add(sent_message.chat_id, sent_message.message_id,
+                             user_id, original_message_id, category)
+
+    def remember_copy(self, message_id, chat_id, user_id, original_message_id, category):
+        """Callback for copy_message, which returns only the new message id."""
+        self.reply_index.add(chat_id, message_id.message_id, user_id, original_message_id, category)
+
+    def remember_album(self, sent_messages, user_id, original_message_id, category):
+        """Let the admin reply to any message of a relayed album."""
+        for sent_message in sent_messages:
+            self.remember_reply(sent_message, user_id, original_message_id, category)
+
+    def send_album(self, chat_id, media):
+        """Outbox method sending album items again by file_id."""
+        return self.outbox.bot.send_media_group(chat_id, album_media(media))
+
+
+def tenant_of(context):
+    """The Tenant whose bot received the update (or runs the job)."""
+    return context.bot_data['tenant']
+
+
+def tenant_path(path, name):
+    """``path`` with the tenant name added before the extension."""
+    if not name:
+        return path
+    base, extension = os.path.splitext(path)
+    return f"{base}-{name}{extension}"
+
+
+def load_tenants(path):
+    """Tenant configs from a JSON file: a list of objects with ``name``, ``token``,
+    ``owner_ids`` and optionally ``categories`` and ``instructions`` (or a
+    reloadable ``menu_file``), ``assignment_mode`` and ``category_admins``."""
+    with open(path, encoding='utf-8') as f:
+        configs = json.load(f)
+    names = [config['name'] for config in configs]
+    if len(set(names)) != len(names) or not all(names):
+        raise ValueError(f"Tenants in {path} need unique, non-empty names")
+    for config in configs:
+        if 'category_admins' in config:
+            config['category_admins'] = {
+                category: [int(admin_id) for admin_id in admins]
+                for category, admins in config['category_admins'].items()}
+        config['owner_ids'] = [int(owner_id) for owner_id in config['owner_ids']]
+    return configs
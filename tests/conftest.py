@@ -0,0 +1,19 @@
+import os
+
+import pytest
+
+from benchmark import prepare_environment
+
+# The bot reads its configuration at import time; point it at throwaway
+# state and lift the fan-out limits before any test imports it
+prepare_environment(chat_rate=1000.0, global_rate=1000.0)
+# Stopping a bot waits for the running getUpdates
+os.environ['POLL_TIMEOUT'] = '1'
+
+
+@pytest.fixture
+def server():
+    from fake_telegram import FakeTelegramServer
+    server = FakeTelegramServer().start()
+    yield server
+    server.stop()
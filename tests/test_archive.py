@@ -0,0 +1,47 @@
+import json
+import os
+
+from archive import TicketArchive, _segment_name
+
+
+def search_total(directory, terms):
+    archive = TicketArchive(str(directory))
+    try:
+        return archive.search(terms)[1]
+    finally:
+        archive.close()
+
+
+def append_and_close(directory, *texts):
+    archive = TicketArchive(str(directory))
+    for text in texts:
+        archive.append('ticket', 1000, 'other', text)
+    archive.close()
+
+
+def test_restarts_do_not_index_records_again(tmp_path):
+    append_and_close(tmp_path, 'printer is broken', 'keyboard is broken')
+    # Records the index has not seen yet, as after a crash before indexing
+    with open(tmp_path / _segment_name(1), 'ab') as f:
+        f.write(b'{"ts":1,"kind":"ticket","user_id":1000,"category":"other","text":"mouse lost"}\n')
+    for _ in range(3):
+        assert search_total(tmp_path, ['broken']) == 2
+        assert search_total(tmp_path, ['mouse']) == 1
+
+
+def test_incomplete_last_record_is_dropped(tmp_path):
+    append_and_close(tmp_path, 'printer is broken')
+    segment = tmp_path / _segment_name(1)
+    size = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(b'{"ts":1,"kind":"ticket","user_id":1000,"te')
+
+    append_and_close(tmp_path, 'keyboard is broken')
+    with open(segment, 'rb') as f:
+        f.seek(size)
+        assert json.loads(f.readline())['text'] == 'keyboard is broken'
+    assert search_total(tmp_path, ['broken']) == 2
+
+    # The whole segment is readable again when the index is rebuilt
+    os.remove(tmp_path / 'index.db')
+    assert search_total(tmp_path, ['broken']) == 2
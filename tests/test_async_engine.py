@@ -0,0 +1,32 @@
+import json
+
+from async_engine import AsyncEngine
+
+
+def body(chat_id, text):
+    return json.dumps({'chat_id': chat_id, 'text': text}).encode('utf-8')
+
+
+def test_calls_reuse_connections(server):
+    engine = AsyncEngine(max_connections=4).start()
+    url = f"{server.base_url}TOKEN/sendMessage"
+    try:
+        for i in range(5):
+            status, data = engine.call(1, url, body(1, f'call {i}'), timeout=5)
+            assert status == 200
+            assert json.loads(data)['result']['text'] == f'call {i}'
+        assert sum(len(idle) for idle in engine.pool._idle.values()) == 1
+    finally:
+        engine.stop()
+
+
+def test_deferred_calls_keep_their_order_per_chat(server):
+    engine = AsyncEngine(max_connections=8).start()
+    url = f"{server.base_url}TOKEN/sendMessage"
+    for i in range(30):
+        for chat_id in (1, 2):
+            engine.defer(chat_id, url, body(chat_id, str(i)), timeout=5)
+    engine.stop()
+    for chat_id in (1, 2):
+        texts = [message['text'] for method, chat, message in server.sent if chat == chat_id]
+        assert texts == [str(i) for i in range(30)]
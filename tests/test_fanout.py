@@ -0,0 +1,23 @@
+import time
+
+from fanout import FanoutSender
+
+
+def test_bots_do_not_share_rate_limits():
+    sender = FanoutSender(workers=4, global_rate=1, chat_rate=1, chat_burst=1)
+    sent = []
+    try:
+        start = time.monotonic()
+        futures = [sender.send(lambda chat_id, **kwargs: sent.append(chat_id), 1, token=token)
+                   for token in ('111:AAAA', '222:BBBB', '333:CCCC')]
+        for future in futures:
+            future.result(timeout=5)
+        # One bot's budget would allow one send per second
+        assert time.monotonic() - start < 0.5
+        assert sent == [1, 1, 1]
+
+        start = time.monotonic()
+        sender.send(lambda chat_id, **kwargs: None, 2, token='111:AAAA').result(timeout=5)
+        assert time.monotonic() - start > 0.5
+    finally:
+        sender.shutdown()
@@ -0,0 +1,53 @@
+import threading
+import time
+
+from telegram import Update
+
+from benchmark import FIRST_USER_ID, callback_update, message_update
+from lanes import BULK, FAST, Lanes, lane_of
+
+
+class RecordingDispatcher:
+    """Stands in for LaneDispatcher; tickets take a while to handle."""
+
+    def __init__(self):
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def handle(self, update):
+        if update.message and not update.message.text.startswith('/'):
+            time.sleep(0.05)
+        with self.lock:
+            self.handled.append(update.update_id)
+
+
+def make_updates(*dicts):
+    return [Update.de_json(dict(data, update_id=update_id), None)
+            for update_id, data in enumerate(dicts, 1)]
+
+
+def test_lane_of():
+    ticket, start, press = make_updates(message_update(FIRST_USER_ID, 1, 'Ticket'),
+                                        message_update(FIRST_USER_ID, 2, '/start'),
+                                        callback_update(FIRST_USER_ID, 'other', None))
+    assert (lane_of(ticket), lane_of(start), lane_of(press)) == (BULK, FAST, FAST)
+
+
+def test_updates_of_a_user_keep_their_order_across_lanes():
+    user, other = FIRST_USER_ID, FIRST_USER_ID + 1
+    updates = make_updates(message_update(user, 1, 'First ticket'),
+                           callback_update(user, 'end_dialog', None),
+                           message_update(user, 2, 'Second ticket'),
+                           message_update(user, 3, '/start'),
+                           callback_update(other, 'other', None))
+    lanes = Lanes(fast_workers=2, bulk_workers=2)
+    dispatcher = RecordingDispatcher()
+    try:
+        for update in updates:
+            lanes.submit(dispatcher, update)
+        lanes.wait_idle(dispatcher)
+    finally:
+        lanes.shutdown()
+    assert [update_id for update_id in dispatcher.handled if update_id != 5] == [1, 2, 3, 4]
+    # Another user's button press does not wait for the first user's tickets
+    assert dispatcher.handled[0] == 5
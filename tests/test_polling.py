@@ -0,0 +1,98 @@
+import time
+
+from telegram import Update
+
+from benchmark import (BOT_USER, CATEGORY, FIRST_USER_ID, Tracker, callback_update,
+                       message_update, push_backlog)
+from polling import OFFSET_KEY, fold_backlog
+
+USER_ID = FIRST_USER_ID
+
+
+def updates_of(*dicts):
+    return [Update.de_json(dict(data, update_id=update_id), None)
+            for update_id, data in enumerate(dicts, 1)]
+
+
+def menu_message(message_id):
+    return {'message_id': message_id, 'date': 0, 'from': BOT_USER, 'text': '',
+            'chat': {'id': USER_ID, 'type': 'private'}}
+
+
+def wait_until(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def start_bot(server, tmp_path):
+    from bot import TelegramBot
+    from handlers import fanout
+    from tenant import Tenant
+    tenant = Tenant(fanout, state_db_path=str(tmp_path / 'state.db'),
+                    archive_dir=str(tmp_path / 'archive'))
+    bot = TelegramBot(tenant, base_url=server.base_url, capture_path='')
+    bot.store.start()
+    bot.archive.start()
+    bot.start_polling()
+    return bot
+
+
+def stop_bot(bot):
+    bot.shutdown()
+    bot.close()
+
+
+def test_fold_keeps_press_followed_by_message():
+    updates = updates_of(callback_update(USER_ID, CATEGORY, menu_message(1)),
+                         message_update(USER_ID, 2, 'Ticket'))
+    kept, stale, folded = fold_backlog(updates, set())
+    assert kept == updates
+    assert (stale, folded) == (0, 0)
+
+
+def test_fold_drops_press_replaced_on_same_message():
+    updates = updates_of(callback_update(USER_ID, CATEGORY, menu_message(1)),
+                         callback_update(USER_ID, 'back_to_menu', menu_message(1)),
+                         callback_update(USER_ID, CATEGORY, menu_message(2)))
+    kept, stale, folded = fold_backlog(updates, set())
+    assert [update.update_id for update in kept] == [2, 3]
+    assert stale == 1
+
+
+def test_fold_repeated_texts_across_batches():
+    seen = set()
+    first = updates_of(message_update(USER_ID, 1, 'hello there'), message_update(USER_ID, 2, '👍'))
+    second = updates_of(message_update(USER_ID, 3, 'Hello there!'), message_update(USER_ID, 4, '❤️'))
+    assert fold_backlog(first, seen)[0] == first
+    kept, stale, folded = fold_backlog(second, seen)
+    assert [update.message.text for update in kept] == ['❤️']
+    assert folded == 1
+
+
+def test_backlog_tickets_are_delivered_and_offset_persisted(server, tmp_path):
+    from config import OWNER_IDS
+    tracker = Tracker(OWNER_IDS)
+    server.listeners.append(tracker)
+    users = [USER_ID + i for i in range(20)]
+    backlog = push_backlog(server, users)
+
+    bot = start_bot(server, tmp_path)
+    try:
+        assert server.wait_for(lambda _: all(user_id in tracker.forwards for user_id in users),
+                               timeout=30)
+        assert wait_until(lambda: bot.poller.offset == backlog + 1)
+    finally:
+        stop_bot(bot)
+
+    # A restarted bot continues after the confirmed updates
+    pushed = server.push_update(message_update(USER_ID, 10, '/start'))
+    bot = start_bot(server, tmp_path)
+    try:
+        assert bot.store.load_meta(OFFSET_KEY) == backlog + 1
+        assert wait_until(lambda: bot.poller.offset == pushed['update_id'] + 1)
+    finally:
+        stop_bot(bot)